@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PREP_CELLBENDER = os.path.join(REPO_DIR, "cellbender", "prep-cellbender.py")
+POSTPROCESS = os.path.join(
+    REPO_DIR, "cellranger", "scripts", "postprocess-cellranger-multi.py"
+)
+
+MULTI_METRICS_HEADER = (
+    "Category,Library Type,Grouped By,Group Name,Metric Name,Metric Value\n"
+)
+COUNT_METRICS = (
+    "Estimated Number of Cells,Mean Reads per Cell,Median Genes per Cell,"
+    "Valid Barcodes,Sequencing Saturation\n"
+    '"{cells:,}","{reads:,}","{genes:,}",97.1%,{saturation}%\n'
+)
+
+# Stage timings go through this logger; the scripts under test log through
+# the root logger, which is kept at WARNING so they do not skew timings
+logger = logging.getLogger("benchmark")
+
+
+def load_script(path, name):
+    """Import a hyphenated script as a module."""
+    sys.path.insert(0, os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # Registered so process pools in the script can pickle its functions
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def touch(path, content=""):
+    """Create a file and any missing parent directories."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def multi_metrics_csv(index):
+    """Return a realistic per-sample metrics_summary.csv for a multi run."""
+    cells = 2000 + (index * 37) % 8000
+    rows = [
+        f'Cells,Gene Expression,,,Cells,"{cells:,}"',
+        f'Cells,Gene Expression,,,Median UMI counts per cell,"{3000 + index % 900:,}"',
+        f'Cells,Gene Expression,,,Median genes per cell,"{1500 + index % 700:,}"',
+        f'Cells,Gene Expression,,,Median reads per cell,"{20000 + index % 5000:,}"',
+        f"Cells,Gene Expression,,,Confidently mapped reads in cells,{80 + index % 15}.{index % 100:02d}%",
+        f'Cells,Gene Expression,,,Total genes detected,"{20000 + index % 3000:,}"',
+        f'Cells,Gene Expression,,,Number of reads from cells called from this sample,"{cells * 25000:,}"',
+        f'Library,Gene Expression,Physical library ID,GEX_1,Number of reads,"{400_000_000 + index:,}"',
+        f'Library,Gene Expression,Physical library ID,GEX_1,Estimated number of cells,"{cells * 8:,}"',
+        f"Library,Gene Expression,Physical library ID,GEX_1,Sequencing saturation,{40 + index % 50}.1%",
+        "Library,Gene Expression,Physical library ID,GEX_1,Valid barcodes,96.5%",
+        "Library,Gene Expression,Physical library ID,GEX_1,Q30 RNA read,94.2%",
+        f'Library,Gene Expression,,,Mean reads per cell,"{30000 + index % 4000:,}"',
+        f'Library,Gene Expression,Fastq ID,GEX_fq,Number of reads,"{400_000_000 + index:,}"',
+    ]
+    return MULTI_METRICS_HEADER + "\n".join(rows) + "\n"
+
+
+def generate_tree(root, n_samples, samples_per_run):
+    """Generate a synthetic project with count and multi CellRanger outputs.
+
+    Layout under root/analysis/cellranger:
+      cr_count_bench/<sample>/outs/ - n_samples count runs
+      cr_multi_bench_<r>/RUN<r>/outs/per_sample_outs/ - n_samples multi
+        samples across runs of samples_per_run, each run also holding an
+        SC_*_CS directory that discovery must prune
+    Raw h5 files are empty placeholders.
+    """
+    cellranger_dir = os.path.join(root, "analysis", "cellranger")
+
+    count_root = os.path.join(cellranger_dir, "cr_count_bench")
+    for i in range(n_samples):
+        outs = os.path.join(count_root, f"C{i:05d}", "outs")
+        touch(os.path.join(outs, "raw_feature_bc_matrix.h5"))
+        touch(
+            os.path.join(outs, "metrics_summary.csv"),
+            COUNT_METRICS.format(
+                cells=3000 + i % 5000,
+                reads=40000 + i % 9000,
+                genes=1800 + i % 600,
+                saturation=50 + i % 40,
+            ),
+        )
+
+    multi_runs = []
+    n_runs = max(1, -(-n_samples // samples_per_run))
+    for r in range(n_runs):
+        run_dir = os.path.join(cellranger_dir, f"cr_multi_bench_{r:04d}", f"RUN{r:04d}")
+        per_sample = os.path.join(run_dir, "outs", "per_sample_outs")
+        first = r * samples_per_run
+        for i in range(first, min(first + samples_per_run, n_samples)):
+            sample_dir = os.path.join(per_sample, f"S{i:05d}")
+            touch(
+                os.path.join(sample_dir, "count", "sample_raw_feature_bc_matrix.h5")
+            )
+            touch(os.path.join(sample_dir, "metrics_summary.csv"), multi_metrics_csv(i))
+        touch(
+            os.path.join(
+                per_sample, f"SC_{r}_CS", "count", "sample_raw_feature_bc_matrix.h5"
+            )
+        )
+        multi_runs.append(run_dir)
+
+    return {
+        "project_dir": root,
+        "count_root": count_root,
+        "cellranger_dir": cellranger_dir,
+        "multi_runs": multi_runs,
+    }
+
+
+def timed(func, repeat):
+    """Run func repeat times and return (best seconds, last result)."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark_size(n_samples, args, prep, post, work_dir):
+    """Run every benchmark stage for one sample count."""
+    results = []
+
+    def record(stage, seconds, **extra):
+        results.append(
+            {
+                "samples": n_samples,
+                "stage": stage,
+                "seconds": round(seconds, 6),
+                "samples_per_second": round(n_samples / seconds, 1) if seconds else None,
+                **extra,
+            }
+        )
+        logger.info(f"{n_samples:>6} samples  {stage:<28} {seconds:9.4f}s")
+
+    tree_root = os.path.join(work_dir, f"tree_{n_samples}")
+    seconds, tree = timed(
+        lambda: generate_tree(tree_root, n_samples, args.samples_per_run), 1
+    )
+    logger.info(f"Generated {n_samples}-sample tree in {seconds:.2f}s")
+
+    # Discovery: count layout (run dirs at top level) and multi layout
+    # (run dirs two levels down, with SC_*_CS pruning)
+    for stage, input_dir in [
+        ("discovery_count", tree["count_root"]),
+        ("discovery_multi_nested", tree["cellranger_dir"]),
+    ]:
+        stats = Counter()
+        seconds, found = timed(
+            lambda: prep.find_raw_h5_files(
+                input_dir, workers=args.discovery_workers, stats=stats
+            ),
+            args.repeat,
+        )
+        record(
+            stage,
+            seconds,
+            found=len(found),
+            directories_scanned=stats["directories_scanned"] // args.repeat,
+        )
+
+    # Script generation for every multi sample
+    multi_samples = prep.find_raw_h5_files(
+        tree["cellranger_dir"], workers=args.discovery_workers
+    )
+    multi_samples = [s for s in multi_samples if s["type"] == "multi"]
+    params = {
+        "project": "bench",
+        "walltime": "1:00",
+        "queue": "gpu",
+        "cores": "2",
+        "memory": "16G",
+        "email": "bench@example.com",
+        "conda_env": "cellbender",
+        "gpu_model": "a100",
+        "gpu_num": "1",
+        "cuda_version": "11.8",
+    }
+    scripts_dir = os.path.join(work_dir, f"scripts_{n_samples}")
+
+    def generate_scripts():
+        shutil.rmtree(scripts_dir, ignore_errors=True)
+        for sample_info in multi_samples:
+            prep.generate_lsf_script_multi(sample_info, scripts_dir, params, "bench")
+
+    seconds, _ = timed(generate_scripts, args.repeat)
+    record("script_generation", seconds, scripts=len(multi_samples))
+
+    # Metrics aggregation per multi run and across the project
+    metrics_dir = os.path.join(work_dir, f"metrics_{n_samples}")
+
+    def process_runs():
+        for run_dir in tree["multi_runs"]:
+            post.process_metrics_summaries(
+                os.path.join(run_dir, "outs"),
+                os.path.join(metrics_dir, os.path.basename(run_dir)),
+                args.metrics_workers,
+            )
+
+    seconds, _ = timed(process_runs, args.repeat)
+    record("metrics_per_run", seconds, runs=len(tree["multi_runs"]))
+
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        logger.info("pyarrow not installed; skipping project aggregation")
+    else:
+        seconds, project_df = timed(
+            lambda: post.aggregate_project_metrics(
+                tree["project_dir"],
+                os.path.join(metrics_dir, "project_metrics.parquet"),
+                "parquet",
+                args.metrics_workers,
+            ),
+            args.repeat,
+        )
+        record("metrics_project", seconds, rows=len(project_df))
+
+    if not args.keep_trees:
+        shutil.rmtree(tree_root, ignore_errors=True)
+        shutil.rmtree(scripts_dir, ignore_errors=True)
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+    return results
+
+
+def compare_to_baseline(results, baseline_path, tolerance):
+    """Return stages that are slower than the baseline by more than tolerance."""
+    with open(baseline_path, "r") as f:
+        baseline = {
+            (r["samples"], r["stage"]): r["seconds"] for r in json.load(f)["results"]
+        }
+
+    regressions = []
+    for result in results:
+        previous = baseline.get((result["samples"], result["stage"]))
+        if previous and result["seconds"] > previous * tolerance:
+            regressions.append({**result, "baseline_seconds": previous})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark discovery, script generation and metrics "
+        "aggregation on synthetic CellRanger output trees"
+    )
+    parser.add_argument(
+        "--sizes",
+        default="10,100,1000,10000",
+        help="Comma-separated sample counts (default: 10,100,1000,10000)",
+    )
+    parser.add_argument(
+        "--samples-per-run",
+        type=int,
+        default=24,
+        help="Samples per synthetic multi run (default: 24)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Repetitions per stage; the fastest is reported (default: 3)",
+    )
+    parser.add_argument(
+        "--discovery-workers",
+        type=int,
+        default=8,
+        help="Discovery threads (default: 8)",
+    )
+    parser.add_argument(
+        "--metrics-workers",
+        type=int,
+        default=8,
+        help="Metrics reader workers (default: 8)",
+    )
+    parser.add_argument(
+        "--work-dir",
+        default=None,
+        help="Directory for synthetic trees (default: a temporary directory)",
+    )
+    parser.add_argument(
+        "--keep-trees",
+        action="store_true",
+        help="Keep generated trees and outputs for inspection",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Write JSON results to this file (default: stdout)",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="Earlier JSON results to compare against; exits non-zero on "
+        "regressions",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.5,
+        help="Slowdown factor over the baseline counted as a regression "
+        "(default: 1.5)",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    logger.setLevel(logging.INFO)
+
+    prep = load_script(PREP_CELLBENDER, "prep_cellbender")
+    post = load_script(POSTPROCESS, "postprocess_cellranger_multi")
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="cellranger_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+
+    # Silence print() calls in the scripts under test
+    results = []
+    with open(os.devnull, "w") as devnull:
+        stdout = sys.stdout
+        for n_samples in [int(size) for size in args.sizes.split(",")]:
+            sys.stdout = devnull
+            try:
+                results.extend(benchmark_size(n_samples, args, prep, post, work_dir))
+            finally:
+                sys.stdout = stdout
+
+    if not args.work_dir and not args.keep_trees:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+
+    if args.baseline:
+        report["regressions"] = compare_to_baseline(
+            results, args.baseline, args.tolerance
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Results written to {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
+
+    if report.get("regressions"):
+        for regression in report["regressions"]:
+            logger.error(
+                f"Regression: {regression['stage']} at {regression['samples']}"
+                f" samples took {regression['seconds']:.4f}s"
+                f" (baseline {regression['baseline_seconds']:.4f}s)"
+            )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
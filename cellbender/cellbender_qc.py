@@ -0,0 +1,478 @@
+"""QC summaries and exports for CellBender remove-background outputs.
+
+Everything is computed from a single read of the output h5: the count
+matrix's per-barcode totals plus the droplet latents CellBender stores
+alongside it (cell probability and background fraction). Both the v0.3
+layout (droplet_latents/...) and the older v0.2 layout
+(matrix/latent_...) are understood.
+
+Cohort collection (read_output_summary) skips the count matrix and reads
+only the latents, the training curve tail and scalar global latents, so
+that many finished outputs can be summarised quickly after the fact.
+"""
+
+import csv
+import fcntl
+import gzip
+import json
+import os
+import re
+import shutil
+from datetime import datetime
+
+try:
+    import h5py
+    import numpy as np
+except ImportError:
+    h5py = None
+    np = None
+
+CELL_PROBABILITY_THRESHOLD = 0.5
+
+QC_COLUMNS = [
+    "sample",
+    "output_file",
+    "barcodes_analyzed",
+    "cells_kept",
+    "ambient_fraction",
+    "counts_in_cells",
+    "median_counts_per_cell",
+    "median_genes_per_cell",
+    "mean_cell_probability",
+]
+
+OUTPUT_SUFFIX = "_cellbender_output.h5"
+LOSS_TAIL_EPOCHS = 10
+
+COHORT_COLUMNS = [
+    "sample",
+    "run_dir",
+    "output_file",
+    "status",
+    "exit_code",
+    "barcodes_analyzed",
+    "cells_kept",
+    "mean_cell_probability",
+    "median_cell_probability_in_cells",
+    "ambient_fraction",
+    "ambient_counts_per_droplet",
+    "epochs",
+    "final_train_elbo",
+    "train_elbo_tail_change",
+    "started",
+    "finished",
+    "runtime_minutes",
+    "error",
+]
+
+# Training ELBO per epoch, v0.3 then v0.2 layout
+LOSS_LAYOUTS = ["metadata/learning_curve_train_elbo", "matrix/training_elbo_per_epoch"]
+# Log-normal location of the empty-droplet size prior (v0.3 only)
+EMPTY_SIZE_LOC = "global_latents/empty_droplet_size_lognormal_loc"
+
+# Lines the generated job scripts write to output_{sample}.stdout
+START_LINE = re.compile(r"^Starting CellBender for sample .* at (.+)$", re.M)
+END_LINE = re.compile(r"^Completed CellBender for sample .* at (.+)$", re.M)
+STDOUT_EDGE_BYTES = 64 * 1024
+
+# (cell probability, background fraction, barcode indices) per layout
+LATENT_LAYOUTS = [
+    (
+        "droplet_latents/cell_probability",
+        "droplet_latents/background_fraction",
+        "droplet_latents/barcode_indices_for_latents",
+    ),
+    (
+        "matrix/latent_cell_probability",
+        "matrix/latent_background_fraction",
+        "matrix/barcode_indices_for_latents",
+    ),
+]
+
+
+def _decode_strings(values):
+    """Decode an array of HDF5 byte strings."""
+    return [v.decode() if isinstance(v, bytes) else str(v) for v in values]
+
+
+def output_prefix(output_h5):
+    """Return the path prefix shared by a sample's CellBender outputs."""
+    if output_h5.endswith("_output.h5"):
+        return output_h5[: -len("_output.h5")]
+    return os.path.splitext(output_h5)[0]
+
+
+def read_droplets(output_h5, with_matrix=False):
+    """Read per-barcode totals and droplet latents from a CellBender output.
+
+    Returns a dict of arrays covering the barcodes CellBender analysed:
+    barcodes, columns (matrix column of each), cell_probability,
+    background_fraction (None if absent), counts and genes; plus the
+    matrix indptr and data for exports. with_matrix also reads the row
+    indices and features that export_filtered_mtx needs, in the same pass.
+    """
+    with h5py.File(output_h5, "r") as f:
+        matrix = f["matrix"]
+        indptr = matrix["indptr"][()]
+        data = matrix["data"][()]
+        cumulative = np.concatenate([[0], np.cumsum(data, dtype=np.float64)])
+        counts = cumulative[indptr[1:]] - cumulative[indptr[:-1]]
+        genes = np.diff(indptr)
+
+        for probability_key, background_key, index_key in LATENT_LAYOUTS:
+            if probability_key in f:
+                probability = f[probability_key][()]
+                background = (
+                    f[background_key][()] if background_key in f else None
+                )
+                columns = (
+                    f[index_key][()]
+                    if index_key in f
+                    else np.arange(len(probability))
+                )
+                break
+        else:
+            raise KeyError(f"No cell probabilities found in {output_h5}")
+
+        barcodes = _decode_strings(matrix["barcodes"][()][columns])
+
+        droplets = {
+            "barcodes": barcodes,
+            "columns": columns,
+            "cell_probability": probability,
+            "background_fraction": background,
+            "counts": counts[columns],
+            "genes": genes[columns],
+            "indptr": indptr,
+            "data": data,
+        }
+        if with_matrix:
+            features = matrix["features"]
+            droplets["indices"] = matrix["indices"][()]
+            droplets["feature_ids"] = _decode_strings(features["id"][()])
+            droplets["feature_names"] = _decode_strings(features["name"][()])
+            droplets["feature_types"] = (
+                _decode_strings(features["feature_type"][()])
+                if "feature_type" in features
+                else ["Gene Expression"] * len(droplets["feature_ids"])
+            )
+
+    return droplets
+
+
+def summarize_droplets(
+    sample_name, output_h5, droplets, threshold=CELL_PROBABILITY_THRESHOLD
+):
+    """Compute the per-sample QC summary row from read_droplets output."""
+    is_cell = droplets["cell_probability"] > threshold
+    cell_counts = droplets["counts"][is_cell]
+    summary = {
+        "sample": sample_name,
+        "output_file": os.path.abspath(output_h5),
+        "barcodes_analyzed": int(len(is_cell)),
+        "cells_kept": int(is_cell.sum()),
+        "ambient_fraction": None,
+        "counts_in_cells": int(cell_counts.sum()),
+        "median_counts_per_cell": None,
+        "median_genes_per_cell": None,
+        "mean_cell_probability": round(float(droplets["cell_probability"].mean()), 4)
+        if len(is_cell)
+        else None,
+    }
+    if is_cell.any():
+        summary["median_counts_per_cell"] = float(np.median(cell_counts))
+        summary["median_genes_per_cell"] = float(np.median(droplets["genes"][is_cell]))
+        if droplets["background_fraction"] is not None:
+            summary["ambient_fraction"] = round(
+                float(droplets["background_fraction"][is_cell].mean()), 4
+            )
+    return summary
+
+
+def write_barcode_table(path, droplets, threshold=CELL_PROBABILITY_THRESHOLD):
+    """Write per-barcode counts, genes and latents as a gzipped TSV."""
+    background = droplets["background_fraction"]
+    lines = ["barcode\tcell_probability\tbackground_fraction\tcounts\tgenes\tis_cell"]
+    for i, barcode in enumerate(droplets["barcodes"]):
+        probability = droplets["cell_probability"][i]
+        lines.append(
+            f"{barcode}\t{probability:.4f}"
+            f"\t{'' if background is None else f'{background[i]:.4f}'}"
+            f"\t{int(droplets['counts'][i])}\t{int(droplets['genes'][i])}"
+            f"\t{int(probability > threshold)}"
+        )
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with gzip.open(tmp_path, "wt", compresslevel=4) as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+
+def export_filtered_mtx(droplets, out_dir, threshold=CELL_PROBABILITY_THRESHOLD):
+    """Export the cell barcodes' counts as a 10x-style Matrix Market directory.
+
+    droplets must come from read_droplets(..., with_matrix=True). Writes
+    matrix.mtx.gz, barcodes.tsv.gz and features.tsv.gz (readable by
+    Seurat's Read10X) into a temp directory and renames it into place.
+    """
+    is_cell = droplets["cell_probability"] > threshold
+    columns = droplets["columns"][is_cell]
+    indptr = droplets["indptr"]
+    starts = indptr[columns]
+    lengths = indptr[columns + 1] - starts
+    # Positions of every stored entry of the selected columns, in order
+    offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+    take = np.arange(lengths.sum()) + offsets
+
+    rows = droplets["indices"][take] + 1
+    feature_ids = droplets["feature_ids"]
+    feature_names = droplets["feature_names"]
+    feature_types = droplets["feature_types"]
+    values = droplets["data"][take]
+    cells = np.repeat(np.arange(1, len(columns) + 1), lengths)
+
+    tmp_dir = f"{out_dir}.tmp.{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    integer = np.issubdtype(values.dtype, np.integer)
+    with gzip.open(os.path.join(tmp_dir, "matrix.mtx.gz"), "wt", compresslevel=4) as f:
+        f.write(
+            f"%%MatrixMarket matrix coordinate {'integer' if integer else 'real'} general\n"
+            f"{len(feature_ids)} {len(columns)} {len(values)}\n"
+        )
+        np.savetxt(
+            f,
+            np.column_stack([rows, cells, values]),
+            fmt="%d %d %d" if integer else "%d %d %.6g",
+        )
+    barcodes = [b for b, keep in zip(droplets["barcodes"], is_cell) if keep]
+    with gzip.open(os.path.join(tmp_dir, "barcodes.tsv.gz"), "wt") as f:
+        f.write("".join(f"{barcode}\n" for barcode in barcodes))
+    with gzip.open(os.path.join(tmp_dir, "features.tsv.gz"), "wt") as f:
+        f.write(
+            "".join(
+                f"{i}\t{n}\t{t}\n"
+                for i, n, t in zip(feature_ids, feature_names, feature_types)
+            )
+        )
+
+    if os.path.isdir(out_dir):
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+def update_cohort_table(table_path, summary):
+    """Insert or replace a sample's row in a shared cohort QC table.
+
+    Concurrent jobs serialise on an fcntl lock next to the table; the
+    table is rewritten atomically so readers never see a partial file.
+    """
+    with open(f"{table_path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        rows = []
+        if os.path.exists(table_path):
+            with open(table_path, "r", newline="") as f:
+                rows = [
+                    row
+                    for row in csv.DictReader(f)
+                    if row["output_file"] != summary["output_file"]
+                ]
+        rows.append({key: "" if value is None else value for key, value in summary.items()})
+        rows.sort(key=lambda row: row["sample"])
+
+        tmp_path = f"{table_path}.tmp.{os.getpid()}"
+        with open(tmp_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=QC_COLUMNS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(tmp_path, table_path)
+
+
+def write_summary_json(path, summary):
+    """Write a sample's QC summary as JSON."""
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(summary, f, indent=2)
+        f.write("\n")
+    os.replace(tmp_path, path)
+
+
+def find_cellbender_outputs(output_dir):
+    """Find every CellBender output under a prep-cellbender output directory.
+
+    Sample directories sit one level down (SAMPLE_DATE) or two levels
+    down for multi runs (LIB_DATE/SAMPLE), as in prep-cellbender.py.
+    Returns sorted (sample name, output h5, sample directory) tuples.
+    """
+    found = []
+    pending = [(output_dir, 0)]
+    while pending:
+        dir_path, depth = pending.pop()
+        try:
+            entries = list(os.scandir(dir_path))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.endswith(OUTPUT_SUFFIX) and entry.is_file():
+                found.append(
+                    (entry.name[: -len(OUTPUT_SUFFIX)], entry.path, dir_path)
+                )
+            elif (
+                depth < 2
+                and not entry.name.endswith("_filtered_mtx")
+                and ".tmp." not in entry.name
+                and entry.is_dir(follow_symlinks=False)
+            ):
+                pending.append((entry.path, depth + 1))
+    return sorted(found, key=lambda item: item[1])
+
+
+def _tail(dataset, count):
+    """Read the last count values of a 1-d dataset without loading the rest."""
+    return dataset[max(0, dataset.shape[0] - count) :]
+
+
+def read_output_summary(
+    output_h5, threshold=CELL_PROBABILITY_THRESHOLD, loss_tail=LOSS_TAIL_EPOCHS
+):
+    """Read cohort QC fields from a CellBender output without the count matrix.
+
+    Only the droplet latents, the tail of the training ELBO curve and
+    scalar global latents are read. Fields absent from the file's layout
+    are None.
+    """
+    summary = {}
+    with h5py.File(output_h5, "r") as f:
+        for probability_key, background_key, _ in LATENT_LAYOUTS:
+            if probability_key in f:
+                probability = f[probability_key][()]
+                background = f[background_key][()] if background_key in f else None
+                break
+        else:
+            raise KeyError(f"No cell probabilities found in {output_h5}")
+
+        is_cell = probability > threshold
+        summary["barcodes_analyzed"] = int(len(probability))
+        summary["cells_kept"] = int(is_cell.sum())
+        if len(probability):
+            summary["mean_cell_probability"] = round(float(probability.mean()), 4)
+        if is_cell.any():
+            summary["median_cell_probability_in_cells"] = round(
+                float(np.median(probability[is_cell])), 4
+            )
+            if background is not None:
+                summary["ambient_fraction"] = round(
+                    float(background[is_cell].mean()), 4
+                )
+
+        if EMPTY_SIZE_LOC in f:
+            summary["ambient_counts_per_droplet"] = round(
+                float(np.exp(np.ravel(f[EMPTY_SIZE_LOC][()])[0])), 2
+            )
+
+        for loss_key in LOSS_LAYOUTS:
+            if loss_key in f:
+                loss = f[loss_key]
+                tail = _tail(loss, loss_tail)
+                summary["epochs"] = int(loss.shape[0])
+                if len(tail):
+                    summary["final_train_elbo"] = round(float(tail[-1]), 4)
+                    summary["train_elbo_tail_change"] = round(
+                        float(tail[-1] - tail[0]), 4
+                    )
+                break
+    return summary
+
+
+def _parse_date(text):
+    """Parse the output of date(1) in the C locale, dropping the time zone."""
+    parts = text.split()
+    if len(parts) == 6:
+        del parts[4]
+    try:
+        return datetime.strptime(" ".join(parts), "%a %b %d %H:%M:%S %Y")
+    except ValueError:
+        return None
+
+
+def read_runtime(sample_dir, sample_name):
+    """Return (started, finished) datetimes for a sample's CellBender run.
+
+    Parsed from the Starting/Completed lines the job scripts write to
+    output_{sample}.stdout; only the head and tail of the file are read.
+    Packed jobs write the Completed line to the batch log instead, so
+    the sample's exit code file marks the end there. Either value may
+    be None.
+    """
+    stdout_path = os.path.join(sample_dir, f"output_{sample_name}.stdout")
+    try:
+        with open(stdout_path, "rb") as f:
+            head = f.read(STDOUT_EDGE_BYTES)
+            size = os.fstat(f.fileno()).st_size
+            if size > STDOUT_EDGE_BYTES:
+                f.seek(max(STDOUT_EDGE_BYTES, size - STDOUT_EDGE_BYTES))
+                tail = head + f.read()
+            else:
+                tail = head
+    except OSError:
+        return None, None
+
+    start = START_LINE.search(head.decode(errors="replace"))
+    ends = END_LINE.findall(tail.decode(errors="replace"))
+    started = _parse_date(start.group(1)) if start else None
+    finished = _parse_date(ends[-1]) if ends else None
+    if finished is None:
+        try:
+            finished = datetime.fromtimestamp(
+                os.stat(os.path.join(sample_dir, f"exit_code_{sample_name}.txt")).st_mtime
+            )
+        except OSError:
+            pass
+    return started, finished
+
+
+def read_exit_code(sample_dir, sample_name):
+    """Return the exit code packed jobs record for a sample, or None."""
+    try:
+        with open(os.path.join(sample_dir, f"exit_code_{sample_name}.txt"), "r") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def collect_sample_qc(
+    sample_name,
+    output_h5,
+    sample_dir,
+    output_dir,
+    threshold=CELL_PROBABILITY_THRESHOLD,
+    loss_tail=LOSS_TAIL_EPOCHS,
+):
+    """Build one cohort QC row for a CellBender output.
+
+    An unreadable output (e.g. still being written) gives a row with
+    status "unreadable" and the error instead of failing the collection.
+    """
+    row = {column: None for column in COHORT_COLUMNS}
+    row.update(
+        {
+            "sample": sample_name,
+            "run_dir": os.path.relpath(sample_dir, output_dir),
+            "output_file": os.path.abspath(output_h5),
+            "status": "ok",
+            "exit_code": read_exit_code(sample_dir, sample_name),
+        }
+    )
+    try:
+        row.update(read_output_summary(output_h5, threshold, loss_tail))
+    except (OSError, KeyError) as e:
+        row["status"] = "unreadable"
+        row["error"] = str(e)
+
+    started, finished = read_runtime(sample_dir, sample_name)
+    if started:
+        row["started"] = started.strftime("%Y-%m-%d %H:%M:%S")
+    if finished:
+        row["finished"] = finished.strftime("%Y-%m-%d %H:%M:%S")
+    if started and finished and finished >= started:
+        row["runtime_minutes"] = round((finished - started).total_seconds() / 60, 1)
+    return row
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from cellbender_qc import (
+    CELL_PROBABILITY_THRESHOLD,
+    COHORT_COLUMNS,
+    LOSS_TAIL_EPOCHS,
+    collect_sample_qc,
+    find_cellbender_outputs,
+    h5py,
+)
+
+COHORT_TABLE_NAME = "cellbender_cohort_qc.csv"
+
+
+def collect_cohort(
+    output_dir, workers=8, threshold=CELL_PROBABILITY_THRESHOLD, loss_tail=LOSS_TAIL_EPOCHS
+):
+    """Summarise every CellBender output under output_dir concurrently.
+
+    Returns one row dict per output, in discovery (path) order.
+    """
+    outputs = find_cellbender_outputs(output_dir)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(
+            executor.map(
+                lambda item: collect_sample_qc(
+                    item[0], item[1], item[2], output_dir, threshold, loss_tail
+                ),
+                outputs,
+            )
+        )
+
+
+def write_cohort_table(path, rows):
+    """Write the cohort table atomically."""
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=COHORT_COLUMNS)
+        writer.writeheader()
+        writer.writerows(
+            {key: "" if value is None else value for key, value in row.items()}
+            for row in rows
+        )
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Collect QC summaries of every CellBender output under a "
+        "prep-cellbender output directory into one cohort table"
+    )
+    parser.add_argument(
+        "--output-dir",
+        required=True,
+        help="Output directory given to prep-cellbender.py (containing "
+        "SAMPLE_DATE or LIB_DATE/SAMPLE directories)",
+    )
+    parser.add_argument(
+        "--table",
+        default=None,
+        help=f"Cohort table to write (default: OUTPUT_DIR/{COHORT_TABLE_NAME})",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of outputs to read concurrently (default: 8)",
+    )
+    parser.add_argument(
+        "--cell-threshold",
+        type=float,
+        default=CELL_PROBABILITY_THRESHOLD,
+        help="Cell probability above which a barcode counts as a cell "
+        f"(default: {CELL_PROBABILITY_THRESHOLD})",
+    )
+    parser.add_argument(
+        "--loss-tail",
+        type=int,
+        default=LOSS_TAIL_EPOCHS,
+        help="Number of final training epochs over which the ELBO change is "
+        f"reported (default: {LOSS_TAIL_EPOCHS})",
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+
+    if h5py is None:
+        logging.error("h5py and numpy are required to read CellBender outputs")
+        sys.exit(1)
+    output_dir = os.path.abspath(args.output_dir)
+    if not os.path.isdir(output_dir):
+        logging.error(f"Output directory not found: {output_dir}")
+        sys.exit(1)
+
+    rows = collect_cohort(
+        output_dir, args.workers, args.cell_threshold, args.loss_tail
+    )
+    if not rows:
+        logging.error(f"No *_cellbender_output.h5 files found under {output_dir}")
+        sys.exit(1)
+
+    table = args.table or os.path.join(output_dir, COHORT_TABLE_NAME)
+    write_cohort_table(table, rows)
+
+    unreadable = [row for row in rows if row["status"] != "ok"]
+    for row in unreadable:
+        logging.warning(f"Could not read {row['output_file']}: {row['error']}")
+    print(f"Collected QC for {len(rows)} CellBender outputs into {table}")
+    if unreadable:
+        print(f"{len(unreadable)} outputs could not be read")
+
+
+if __name__ == "__main__":
+    main()
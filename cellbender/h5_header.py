@@ -0,0 +1,126 @@
+"""Lazy header reader for 10x raw/filtered feature matrix h5 files.
+
+Only HDF5 attributes, dataset shapes and the small feature_type column
+are read; the count matrix itself is never loaded. Results are cached in
+a JSON file keyed by absolute path and validated against the file's size
+and mtime, so unchanged files are not reopened over GPFS.
+"""
+
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+def _decode(value):
+    """Convert HDF5 attribute values (bytes, numpy scalars/arrays) to JSON types."""
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    if hasattr(value, "tolist"):
+        return _decode(value.tolist())
+    if isinstance(value, (list, tuple)):
+        return [_decode(v) for v in value]
+    return value
+
+
+def file_signature(h5_path):
+    """Return the [size, mtime_ns] signature used to validate cache entries."""
+    st = os.stat(h5_path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def read_h5_header(h5_path):
+    """Read summary fields from a 10x h5 file without loading the matrix.
+
+    Returns a dict with n_barcodes, n_features, nnz, chemistry,
+    library_ids and feature_types, or None if h5py is unavailable or the
+    file is not a readable 10x matrix.
+    """
+    if h5py is None:
+        return None
+    try:
+        with h5py.File(h5_path, "r") as f:
+            matrix = f["matrix"]
+            features = matrix["features"]
+            header = {
+                "n_barcodes": matrix["barcodes"].shape[0],
+                "n_features": features["id"].shape[0],
+                "nnz": matrix["data"].shape[0],
+                "chemistry": _decode(f.attrs.get("chemistry_description")),
+                "library_ids": _decode(f.attrs.get("library_ids")),
+                "feature_types": [],
+            }
+            if "feature_type" in features:
+                header["feature_types"] = sorted(
+                    set(_decode(features["feature_type"][()]))
+                )
+            return header
+    except (OSError, KeyError) as e:
+        logging.warning(f"Could not read h5 header from {h5_path}: {e}")
+        return None
+
+
+def load_header_cache(cache_path):
+    """Load the header cache, treating a missing or corrupt file as empty."""
+    if not cache_path or not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, "r") as f:
+            return json.load(f)
+    except (json.JSONDecodeError, OSError) as e:
+        logging.warning(f"Ignoring unreadable h5 header cache {cache_path}: {e}")
+        return {}
+
+
+def save_header_cache(cache_path, cache):
+    """Write the header cache atomically via a temp file and rename."""
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    tmp_path = f"{cache_path}.tmp.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, cache_path)
+
+
+def read_h5_headers(h5_paths, cache=None, workers=8, stats=None):
+    """Read headers for many h5 files concurrently, using cache when valid.
+
+    cache is a dict as returned by load_header_cache and is updated in
+    place with any newly read headers. stats, if given, is a Counter that
+    receives header_cache_hits and header_reads. Returns a dict of
+    absolute path -> header (None for unreadable files).
+    """
+    if cache is None:
+        cache = {}
+    lock = threading.Lock()
+
+    def read_one(h5_path):
+        h5_path = os.path.abspath(h5_path)
+        try:
+            signature = file_signature(h5_path)
+        except FileNotFoundError:
+            return h5_path, None
+
+        entry = cache.get(h5_path)
+        if entry and entry["signature"] == signature:
+            with lock:
+                if stats is not None:
+                    stats["header_cache_hits"] += 1
+            return h5_path, entry["header"]
+
+        header = read_h5_header(h5_path)
+        with lock:
+            if stats is not None:
+                stats["header_reads"] += 1
+            if header is not None:
+                cache[h5_path] = {"signature": signature, "header": header}
+        return h5_path, header
+
+    unique_paths = list(dict.fromkeys(h5_paths))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(executor.map(read_one, unique_paths))
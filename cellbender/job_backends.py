@@ -0,0 +1,478 @@
+"""Scheduler backends for submitting and polling generated job scripts.
+
+A backend is a dict of coroutines built by one of the make_*_backend
+functions:
+
+    submit(script_path) -> job_id
+    poll(job_ids) -> {job_id: state}, one scheduler call per interval
+    read_errors(job) -> error log text used to decide whether to retry
+
+States are normalised to PENDING, RUNNING, DONE and FAILED. Job-array
+elements are folded into a single state for the whole array.
+
+Besides the cluster schedulers there is a local backend, which runs the
+scripts on this machine with a cap on concurrent jobs and one GPU slot
+per device, and a fake backend that only simulates jobs.
+"""
+
+import asyncio
+import glob
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import signal
+import subprocess
+
+from job_templates import SCHEDULERS
+
+PENDING = "PENDING"
+RUNNING = "RUNNING"
+DONE = "DONE"
+FAILED = "FAILED"
+
+DEFAULT_RETRY_CONFIG = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "cellranger",
+    "cluster",
+    "config",
+    "retry.json",
+)
+
+LSF_STATES = {
+    "PEND": PENDING,
+    "PSUSP": PENDING,
+    "WAIT": PENDING,
+    "RUN": RUNNING,
+    "USUSP": RUNNING,
+    "SSUSP": RUNNING,
+    "PROV": RUNNING,
+    "UNKWN": RUNNING,
+    "DONE": DONE,
+    "EXIT": FAILED,
+    "ZOMBI": FAILED,
+}
+
+SLURM_STATES = {
+    "PENDING": PENDING,
+    "REQUEUED": PENDING,
+    "RESIZING": PENDING,
+    "RUNNING": RUNNING,
+    "CONFIGURING": RUNNING,
+    "COMPLETING": RUNNING,
+    "SUSPENDED": RUNNING,
+    "COMPLETED": DONE,
+}
+
+# Directives naming a job's stderr file, and the job/array id tokens they use
+STDERR_DIRECTIVES = {
+    "lsf": (re.compile(r"^#BSUB\s+-eo?\s+(\S+)", re.M), {"%J": "{id}", "%I": "*"}),
+    "slurm": (
+        re.compile(r"^#SBATCH\s+(?:--error=|-e\s+)(\S+)", re.M),
+        {"%j": "{id}", "%A": "{id}", "%a": "*"},
+    ),
+    "sge": (
+        re.compile(r"^#\$\s+-e\s+(\S+)", re.M),
+        {"$JOB_ID": "{id}", "$TASK_ID": "*"},
+    ),
+    "local": (
+        re.compile(r"^#LOCAL\s+--error=(\S+)", re.M),
+        {"%j": "{id}", "%a": "*"},
+    ),
+}
+LOCAL_DIRECTIVE = re.compile(r"^#LOCAL\s+--([a-z-]+)=(\S+)", re.M)
+LOCAL_ARRAY_SPEC = re.compile(r"^(\d+)-(\d+)(?:%(\d+))?$")
+EXEC_STDERR = re.compile(r'^exec 2> "?([^"$\s]+)"?', re.M)
+ERROR_TAIL_BYTES = 64 * 1024
+
+
+def load_retry_config(config_path=DEFAULT_RETRY_CONFIG):
+    """Load default_retries and compiled retry_on patterns from a retry.json."""
+    with open(config_path, "r") as f:
+        config = json.load(f)
+    return {
+        "default_retries": config.get("default_retries", 0),
+        "retry_on": [re.compile(p, re.M) for p in config.get("retry_on", [])],
+    }
+
+
+def is_retryable(error_text, retry_config):
+    """Check whether error output matches any retry_on pattern."""
+    return any(pattern.search(error_text) for pattern in retry_config["retry_on"])
+
+
+def combine_states(states):
+    """Fold the states of a job's array elements into one state."""
+    states = set(states)
+    if RUNNING in states:
+        return RUNNING
+    if PENDING in states:
+        return PENDING
+    if FAILED in states:
+        return FAILED
+    return DONE
+
+
+async def run_command(cmd, stdin_path=None):
+    """Run a command without a shell and return (returncode, stdout, stderr)."""
+    stdin = open(stdin_path, "rb") if stdin_path else asyncio.subprocess.DEVNULL
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=stdin,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await process.communicate()
+    finally:
+        if stdin_path:
+            stdin.close()
+    return (
+        process.returncode,
+        stdout.decode(errors="replace"),
+        stderr.decode(errors="replace"),
+    )
+
+
+def stderr_paths(script_path, job_id, scheduler):
+    """Return the error log files a submitted job script writes to."""
+    with open(script_path, "r") as f:
+        script = f.read()
+    pattern, tokens = STDERR_DIRECTIVES[scheduler]
+    paths = []
+    for path in pattern.findall(script):
+        for token, value in tokens.items():
+            path = path.replace(token, value.format(id=job_id))
+        paths.extend(glob.glob(path))
+    paths.extend(path for path in EXEC_STDERR.findall(script) if os.path.exists(path))
+    return paths
+
+
+def read_error_logs(job, scheduler):
+    """Read the tail of every error log written by a job."""
+    texts = []
+    for path in stderr_paths(job["script"], job["job_id"], scheduler):
+        try:
+            with open(path, "rb") as f:
+                f.seek(max(0, os.path.getsize(path) - ERROR_TAIL_BYTES))
+                texts.append(f.read().decode(errors="replace"))
+        except OSError as e:
+            logging.warning(f"Could not read error log {path}: {e}")
+    return "\n".join(texts)
+
+
+def parse_job_id(scheduler, stdout):
+    """Extract the job id from a submission command's output."""
+    if scheduler == "lsf":
+        match = re.search(r"Job <(\d+)>", stdout)
+        return match.group(1) if match else None
+    job_id = stdout.strip().split(";")[0].split(".")[0]
+    return job_id or None
+
+
+def parse_lsf_states(stdout):
+    """Parse `bjobs -o "jobid stat" -noheader` output."""
+    states = {}
+    for line in stdout.splitlines():
+        fields = line.split()
+        if len(fields) >= 2:
+            states.setdefault(fields[0], []).append(LSF_STATES.get(fields[1], RUNNING))
+    return states
+
+
+def parse_slurm_states(stdout):
+    """Parse `sacct -n -X -P -o JobID,State` output."""
+    states = {}
+    for line in stdout.splitlines():
+        if "|" not in line:
+            continue
+        job_id, state = line.split("|", 1)
+        job_id = job_id.split("_")[0].split("+")[0]
+        state = state.split()[0] if state.strip() else ""
+        states.setdefault(job_id, []).append(SLURM_STATES.get(state, FAILED))
+    return states
+
+
+def parse_sge_states(stdout):
+    """Parse plain `qstat` output."""
+    states = {}
+    for line in stdout.splitlines():
+        fields = line.split()
+        if len(fields) < 5 or not fields[0].isdigit():
+            continue
+        code = fields[4]
+        if "E" in code:
+            state = FAILED
+        elif any(c in code for c in "rtRsS"):
+            state = RUNNING
+        else:
+            state = PENDING
+        states.setdefault(fields[0], []).append(state)
+    return states
+
+
+def make_scheduler_backend(scheduler):
+    """Build a backend that drives bsub/bjobs, sbatch/sacct or qsub/qstat.
+
+    SGE drops finished jobs from qstat and has no cheap batch history
+    query, so a job that disappears from qstat is reported DONE.
+    """
+    config = SCHEDULERS[scheduler]
+
+    async def submit(script_path):
+        if config["stdin"]:
+            cmd = [config["cmd"]] + config["args"]
+            returncode, stdout, stderr = await run_command(cmd, stdin_path=script_path)
+        else:
+            cmd = [config["cmd"]] + config["args"] + [script_path]
+            returncode, stdout, stderr = await run_command(cmd)
+        job_id = parse_job_id(scheduler, stdout) if returncode == 0 else None
+        if job_id is None:
+            raise RuntimeError(
+                f"{config['cmd']} failed for {script_path}: {stderr.strip() or stdout.strip()}"
+            )
+        return job_id
+
+    async def poll(job_ids):
+        if not job_ids:
+            return {}
+        if scheduler == "lsf":
+            cmd = ["bjobs", "-a", "-noheader", "-o", "jobid stat"] + list(job_ids)
+            parse = parse_lsf_states
+        elif scheduler == "slurm":
+            cmd = ["sacct", "-n", "-X", "-P", "-o", "JobID,State", "-j", ",".join(job_ids)]
+            parse = parse_slurm_states
+        else:
+            cmd = ["qstat"]
+            parse = parse_sge_states
+        _, stdout, _ = await run_command(cmd)
+        states = {
+            job_id: combine_states(element_states)
+            for job_id, element_states in parse(stdout).items()
+            if job_id in job_ids
+        }
+        if scheduler == "sge":
+            for job_id in job_ids:
+                states.setdefault(job_id, DONE)
+        return states
+
+    async def read_errors(job):
+        return read_error_logs(job, scheduler)
+
+    return {"name": scheduler, "submit": submit, "poll": poll, "read_errors": read_errors}
+
+
+def detect_gpus():
+    """Return the GPU device ids available to local jobs.
+
+    Uses CUDA_VISIBLE_DEVICES when set, otherwise the devices nvidia-smi
+    lists; an empty list means no GPUs (jobs then run without GPU slots).
+    """
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible is not None:
+        return [device for device in visible.split(",") if device.strip()]
+    if shutil.which("nvidia-smi") is None:
+        return []
+    result = subprocess.run(
+        ["nvidia-smi", "--query-gpu=index", "--format=csv,noheader"],
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.split() if result.returncode == 0 else []
+
+
+def parse_local_directives(script_path):
+    """Read the #LOCAL --name=value directives of a local job script."""
+    with open(script_path, "r") as f:
+        return dict(LOCAL_DIRECTIVE.findall(f.read()))
+
+
+def parse_walltime_seconds(walltime):
+    """Convert an H:MM or H:MM:SS walltime to seconds (None if unparseable)."""
+    try:
+        parts = [int(part) for part in walltime.split(":")]
+    except (AttributeError, ValueError):
+        return None
+    seconds = 0
+    for part, unit in zip(parts, (3600, 60, 1)):
+        seconds += part * unit
+    return seconds or None
+
+
+def terminate_process_group(process):
+    """Send SIGTERM to a local job's process group (the script and cellbender)."""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+def make_local_backend(max_jobs=0, gpus=None):
+    """Build a backend that runs job scripts on this machine with bash.
+
+    Every job, or job-array element, runs as its own process in the
+    script's --workdir with stdout and stderr in its --output and --error
+    files, in a process group of its own. At most max_jobs run at once (0 means no cap beyond GPUs).
+    Each element takes --gpus devices from gpus (default: detect_gpus())
+    and sees only those through CUDA_VISIBLE_DEVICES, waiting until
+    enough are free; without GPUs, CUDA_VISIBLE_DEVICES is left alone.
+    An element still running after its --time is terminated and fails.
+    """
+    if gpus is None:
+        gpus = detect_gpus()
+    free_gpus = list(gpus)
+    running = [0]
+    condition = asyncio.Condition()
+    jobs = {}
+    tasks = set()
+    counter = [0]
+
+    def slots_free(n_gpus):
+        return len(free_gpus) >= n_gpus and (max_jobs <= 0 or running[0] < max_jobs)
+
+    async def run_element(job_id, index, script_path, directives, limit):
+        element_states = jobs[job_id]
+        n_gpus = min(int(directives.get("gpus", 1)), len(gpus)) if gpus else 0
+        async with limit:
+            async with condition:
+                await condition.wait_for(lambda: slots_free(n_gpus))
+                devices = [free_gpus.pop(0) for _ in range(n_gpus)]
+                running[0] += 1
+            element_states[index] = RUNNING
+
+            env = dict(os.environ)
+            if gpus:
+                env["CUDA_VISIBLE_DEVICES"] = ",".join(devices)
+            if index is not None:
+                env["LOCAL_ARRAY_INDEX"] = str(index)
+            log_paths = [
+                directives.get(name, os.devnull)
+                .replace("%j", job_id)
+                .replace("%a", str(index))
+                for name in ("output", "error")
+            ]
+            returncode = None
+            try:
+                with open(log_paths[0], "w") as stdout, open(log_paths[1], "w") as stderr:
+                    process = await asyncio.create_subprocess_exec(
+                        "bash",
+                        script_path,
+                        cwd=directives.get("workdir"),
+                        env=env,
+                        stdin=asyncio.subprocess.DEVNULL,
+                        stdout=stdout,
+                        stderr=stderr,
+                        start_new_session=True,
+                    )
+                    try:
+                        returncode = await asyncio.wait_for(
+                            process.wait(), parse_walltime_seconds(directives.get("time"))
+                        )
+                    except asyncio.TimeoutError:
+                        terminate_process_group(process)
+                        await process.wait()
+                        stderr.write(f"Job killed: walltime {directives['time']} exceeded\n")
+                    except asyncio.CancelledError:
+                        terminate_process_group(process)
+                        raise
+            except OSError as e:
+                logging.error(f"Could not run {script_path}: {e}")
+            finally:
+                async with condition:
+                    free_gpus.extend(devices)
+                    running[0] -= 1
+                    condition.notify_all()
+        element_states[index] = DONE if returncode == 0 else FAILED
+
+    async def submit(script_path):
+        directives = parse_local_directives(script_path)
+        counter[0] += 1
+        job_id = str(counter[0])
+        indices = [None]
+        limit = asyncio.Semaphore(1)
+        if "array" in directives:
+            match = LOCAL_ARRAY_SPEC.match(directives["array"])
+            if match is None:
+                raise RuntimeError(f"Bad --array={directives['array']} in {script_path}")
+            first, last, cap = match.groups()
+            indices = list(range(int(first), int(last) + 1))
+            limit = asyncio.Semaphore(int(cap) if cap else len(indices))
+        jobs[job_id] = {index: PENDING for index in indices}
+        for index in indices:
+            task = asyncio.create_task(
+                run_element(job_id, index, script_path, directives, limit)
+            )
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        return job_id
+
+    async def poll(job_ids):
+        return {
+            job_id: combine_states(jobs[job_id].values())
+            for job_id in job_ids
+            if job_id in jobs
+        }
+
+    async def read_errors(job):
+        return read_error_logs(job, "local")
+
+    return {"name": "local", "submit": submit, "poll": poll, "read_errors": read_errors}
+
+
+def make_fake_backend(runtime=(1.0, 3.0), failure_rate=0.2, error_text="signal: killed", seed=None):
+    """Build an in-process backend that simulates a scheduler for testing.
+
+    Each job pends briefly, runs for a random time within runtime seconds
+    and fails with probability failure_rate, reporting error_text as its
+    error log.
+    """
+    rng = random.Random(seed)
+    jobs = {}
+    counter = [0]
+
+    def now():
+        return asyncio.get_running_loop().time()
+
+    async def submit(script_path):
+        if not os.path.exists(script_path):
+            raise RuntimeError(f"fake submit failed: {script_path} does not exist")
+        counter[0] += 1
+        job_id = str(counter[0])
+        start = now() + rng.uniform(0, runtime[0] / 2)
+        jobs[job_id] = {
+            "start": start,
+            "end": start + rng.uniform(*runtime),
+            "fails": rng.random() < failure_rate,
+        }
+        return job_id
+
+    async def poll(job_ids):
+        current = now()
+        states = {}
+        for job_id in job_ids:
+            job = jobs.get(job_id)
+            if job is None:
+                continue
+            if current < job["start"]:
+                states[job_id] = PENDING
+            elif current < job["end"]:
+                states[job_id] = RUNNING
+            else:
+                states[job_id] = FAILED if job["fails"] else DONE
+        return states
+
+    async def read_errors(job):
+        return error_text
+
+    return {"name": "fake", "submit": submit, "poll": poll, "read_errors": read_errors}
+
+
+def make_backend(name, local_options=None, **fake_options):
+    """Build the backend for a scheduler name, or the fake backend."""
+    if name == "fake":
+        return make_fake_backend(**fake_options)
+    if name == "local":
+        return make_local_backend(**(local_options or {}))
+    return make_scheduler_backend(name)
@@ -0,0 +1,226 @@
+"""Compiled job-script templates for LSF, SLURM, SGE and local runs.
+
+Templates are plain job scripts with __NAME__ placeholders, in the style
+of the Martian lsf.template. Each template is parsed once into literal
+and placeholder segments, so rendering thousands of scripts is a join
+over a precompiled list. Scripts are written atomically via a temp file
+and rename.
+"""
+
+import os
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+import pipeline_metrics
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+# Submission commands mirror the jobmodes in
+# cellranger/cluster/config/config.json
+SCHEDULERS = {
+    "lsf": {
+        "extension": "lsf",
+        "cmd": "bsub",
+        "args": [],
+        "stdin": True,
+        "job_id": "%J",
+        "array_job_id": "%J_%I",
+        "array_index": "LSB_JOBINDEX",
+        "directive": "#BSUB",
+    },
+    "slurm": {
+        "extension": "slurm",
+        "cmd": "sbatch",
+        "args": ["--parsable"],
+        "stdin": False,
+        "job_id": "%j",
+        "array_job_id": "%A_%a",
+        "array_index": "SLURM_ARRAY_TASK_ID",
+        "directive": "#SBATCH",
+    },
+    "sge": {
+        "extension": "sge",
+        "cmd": "qsub",
+        "args": ["-terse"],
+        "stdin": False,
+        "job_id": "$JOB_ID",
+        "array_job_id": "$JOB_ID.$TASK_ID",
+        "array_index": "SGE_TASK_ID",
+        "directive": "#$",
+    },
+    # Runs on this machine through job_backends.make_local_backend; plain
+    # bash works too, running the jobs one after another
+    "local": {
+        "extension": "local",
+        "cmd": "bash",
+        "args": [],
+        "stdin": False,
+        "job_id": "%j",
+        "array_job_id": "%j_%a",
+        "array_index": "LOCAL_ARRAY_INDEX",
+        "directive": "#LOCAL",
+    },
+}
+
+PLACEHOLDER = re.compile(r"__([A-Z][A-Z0-9]*(?:_[A-Z0-9]+)*)__")
+
+CompiledTemplate = namedtuple("CompiledTemplate", ["literals", "names", "path"])
+
+# Used after the directives of a plain job script that has no placeholders
+DEFAULT_BODY = """__EXTRA_DIRECTIVES__
+__DESCRIPTION__
+__EXPORTS__source /hpc/users/tastac01/micromamba/etc/profile.d/conda.sh
+conda init bash
+conda activate __CONDA_ENV__
+
+# Load CUDA module if needed
+ml cuda/__CUDA_VERSION__
+
+__COMMANDS__
+"""
+
+# Per-job LSF options rewritten when adapting a plain script such as
+# gpu_template.lsf; all other directives are kept as written
+LSF_JOB_OPTIONS = {
+    "-J": "__JOB_NAME__",
+    "-o": "__STDOUT__",
+    "-e": "__STDERR__",
+    "-eo": "__STDERR__",
+    "-cwd": "__WORK_DIR__",
+}
+
+
+def compile_template(text, path=None):
+    """Split template text into alternating literal and placeholder segments."""
+    parts = PLACEHOLDER.split(text)
+    return CompiledTemplate(tuple(parts[0::2]), tuple(parts[1::2]), path)
+
+
+def render_template(template, context):
+    """Render a compiled template; every placeholder must be in context."""
+    try:
+        values = [str(context[name]) for name in template.names]
+    except KeyError as e:
+        raise ValueError(
+            f"Template {template.path or '<string>'} uses unknown placeholder"
+            f" __{e.args[0]}__"
+        ) from None
+    pieces = [template.literals[0]]
+    for value, literal in zip(values, template.literals[1:]):
+        pieces.append(value)
+        pieces.append(literal)
+    return "".join(pieces)
+
+
+def adapt_plain_lsf_script(text):
+    """Turn a plain LSF job script (e.g. gpu_template.lsf) into a template.
+
+    The shebang, #BSUB directives and export lines are kept, with job
+    name, log paths and working directory replaced by placeholders; the
+    rest of the script's body is replaced by the default CellBender body.
+    """
+    header = []
+    exports = []
+    has_cwd = False
+    for line in text.splitlines():
+        if line.startswith("export "):
+            exports.append(line)
+        elif line.startswith("#!"):
+            header.append(line)
+        elif line.startswith("#BSUB"):
+            fields = line.split(None, 2)
+            if len(fields) == 3 and fields[1] in LSF_JOB_OPTIONS:
+                line = f"#BSUB {fields[1]} {LSF_JOB_OPTIONS[fields[1]]}"
+                has_cwd = has_cwd or fields[1] == "-cwd"
+            header.append(line)
+    if not has_cwd:
+        header.append("#BSUB -cwd __WORK_DIR__")
+    exports = "\n".join(exports) + "\n\n" if exports else ""
+    return "\n".join(header) + "\n" + DEFAULT_BODY.replace("__EXPORTS__", exports)
+
+
+@lru_cache(maxsize=None)
+def load_template(path=None, scheduler="lsf"):
+    """Load and compile a template once per process.
+
+    With no path the bundled template for the scheduler is used. A plain
+    LSF script without any placeholders is adapted with
+    adapt_plain_lsf_script.
+    """
+    if path is None:
+        path = os.path.join(TEMPLATE_DIR, f"cellbender.{SCHEDULERS[scheduler]['extension']}")
+    with open(path, "r") as f:
+        text = f.read()
+    if not PLACEHOLDER.search(text):
+        if scheduler != "lsf":
+            raise ValueError(f"Template {path} has no __NAME__ placeholders")
+        text = adapt_plain_lsf_script(text)
+    return compile_template(text, path)
+
+
+def format_walltime(walltime, scheduler):
+    """Format an H:MM walltime for the scheduler (H:MM:SS outside LSF)."""
+    if scheduler == "lsf" or walltime.count(":") != 1:
+        return walltime
+    return f"{walltime}:00"
+
+
+def array_directives(scheduler, job_name, n_tasks, limit=0):
+    """Return (job_name, extra_directives) for an array of n_tasks elements.
+
+    limit caps the number of elements running at once (0 means no cap).
+    """
+    if scheduler == "lsf":
+        spec = f"[1-{n_tasks}]" + (f"%{limit}" if limit > 0 else "")
+        return f"{job_name}{spec}", ""
+    if scheduler == "slurm":
+        spec = f"1-{n_tasks}" + (f"%{limit}" if limit > 0 else "")
+        return job_name, f"#SBATCH --array={spec}\n"
+    if scheduler == "local":
+        # Run directly with bash, the script runs every element in turn
+        spec = f"1-{n_tasks}" + (f"%{limit}" if limit > 0 else "")
+        return job_name, f"""#LOCAL --array={spec}
+if [ -z "$LOCAL_ARRAY_INDEX" ]; then
+    array_exit=0
+    for index in $(seq 1 {n_tasks}); do
+        LOCAL_ARRAY_INDEX=$index bash "$0" || array_exit=1
+    done
+    exit $array_exit
+fi
+"""
+    directives = f"#$ -t 1-{n_tasks}\n"
+    if limit > 0:
+        directives += f"#$ -tc {limit}\n"
+    return job_name, directives
+
+
+def submit_command(scheduler, script_path):
+    """Return the shell command that submits script_path."""
+    config = SCHEDULERS[scheduler]
+    command = " ".join([config["cmd"]] + config["args"])
+    if config["stdin"]:
+        return f"{command} < {script_path}"
+    return f"{command} {script_path}"
+
+
+def write_text_atomic(path, content, mode=None):
+    """Write content to path via a temp file in the same directory and rename."""
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with pipeline_metrics.timed("file_writes"):
+        with open(tmp_path, "w", buffering=1 << 16) as f:
+            f.write(content)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    pipeline_metrics.count("files_written")
+    pipeline_metrics.count("bytes_written", len(content))
+
+
+def write_files_atomic(items, mode=None):
+    """Write an iterable of (path, content) pairs atomically."""
+    paths = []
+    for path, content in items:
+        write_text_atomic(path, content, mode)
+        paths.append(path)
+    return paths
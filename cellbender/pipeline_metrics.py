@@ -0,0 +1,103 @@
+"""Per-stage timings and counters for the prep-cellbender pipeline.
+
+Timings and counters are process-wide so that deep helpers (run-ID
+lookups, template rendering, file writes) can record into them without
+threading a stats object through every call. A report can be written as
+JSON or as a Prometheus textfile-collector file.
+"""
+
+import json
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+timings = defaultdict(float)
+calls = Counter()
+counters = Counter()
+_lock = threading.Lock()
+
+PROMETHEUS_PREFIX = "prep_cellbender"
+
+
+def reset():
+    """Clear all recorded timings and counters."""
+    with _lock:
+        timings.clear()
+        calls.clear()
+        counters.clear()
+
+
+def count(name, amount=1):
+    """Increment a named counter; safe to call from worker threads."""
+    with _lock:
+        counters[name] += amount
+
+
+@contextmanager
+def timed(stage):
+    """Add the wall time of the enclosed block to a stage's total."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            timings[stage] += elapsed
+            calls[stage] += 1
+
+
+def build_report(extra_counters=None):
+    """Return the recorded metrics as a JSON-serialisable dict.
+
+    extra_counters (e.g. the discovery stats Counter) are merged into the
+    counters. When a "total" stage was timed, each counter is also
+    reported as a rate per second of total wall time.
+    """
+    with _lock:
+        report = {
+            "stages": {
+                stage: {"seconds": round(seconds, 6), "calls": calls[stage]}
+                for stage, seconds in timings.items()
+            },
+            "counters": dict(counters),
+        }
+    for name, value in (extra_counters or {}).items():
+        report["counters"][name] = report["counters"].get(name, 0) + value
+    total = report["stages"].get("total", {}).get("seconds")
+    if total:
+        report["rates"] = {
+            f"{name}_per_second": round(value / total, 3)
+            for name, value in report["counters"].items()
+        }
+    return report
+
+
+def format_prometheus(report):
+    """Format a report in the Prometheus text exposition format."""
+    lines = [
+        f"# HELP {PROMETHEUS_PREFIX}_stage_seconds Wall time spent in each pipeline stage",
+        f"# TYPE {PROMETHEUS_PREFIX}_stage_seconds gauge",
+    ]
+    for stage, values in sorted(report["stages"].items()):
+        lines.append(f'{PROMETHEUS_PREFIX}_stage_seconds{{stage="{stage}"}} {values["seconds"]}')
+    lines += [
+        f"# HELP {PROMETHEUS_PREFIX}_stage_calls Number of times each stage ran",
+        f"# TYPE {PROMETHEUS_PREFIX}_stage_calls gauge",
+    ]
+    for stage, values in sorted(report["stages"].items()):
+        lines.append(f'{PROMETHEUS_PREFIX}_stage_calls{{stage="{stage}"}} {values["calls"]}')
+    lines += [
+        f"# HELP {PROMETHEUS_PREFIX}_events Pipeline event counts from the last run",
+        f"# TYPE {PROMETHEUS_PREFIX}_events gauge",
+    ]
+    for name, value in sorted(report["counters"].items()):
+        lines.append(f'{PROMETHEUS_PREFIX}_events{{name="{name}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def format_report(report, report_format="json"):
+    """Format a report as JSON or Prometheus text."""
+    if report_format == "prometheus":
+        return format_prometheus(report)
+    return json.dumps(report, indent=2, sort_keys=True) + "\n"
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+import sys
+
+from cellbender_qc import (
+    CELL_PROBABILITY_THRESHOLD,
+    export_filtered_mtx,
+    h5py,
+    output_prefix,
+    read_droplets,
+    summarize_droplets,
+    update_cohort_table,
+    write_barcode_table,
+    write_summary_json,
+)
+
+
+def postprocess_output(
+    sample_name,
+    output_h5,
+    qc_table=None,
+    export_mtx=False,
+    threshold=CELL_PROBABILITY_THRESHOLD,
+    final_output=None,
+):
+    """Summarise one CellBender output and write its QC files.
+
+    Writes {prefix}_qc.json and {prefix}_barcodes.tsv.gz next to the
+    output, optionally a {prefix}_filtered_mtx directory, and updates the
+    cohort table if one is given. final_output, if given, is the path
+    recorded for the output (e.g. where a staged copy will end up).
+    Returns the summary dict.
+    """
+    prefix = output_prefix(output_h5)
+    droplets = read_droplets(output_h5, with_matrix=export_mtx)
+    summary = summarize_droplets(
+        sample_name, final_output or output_h5, droplets, threshold
+    )
+
+    write_summary_json(f"{prefix}_qc.json", summary)
+    write_barcode_table(f"{prefix}_barcodes.tsv.gz", droplets, threshold)
+    if export_mtx:
+        export_filtered_mtx(droplets, f"{prefix}_filtered_mtx", threshold)
+    if qc_table:
+        update_cohort_table(qc_table, summary)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Summarise a CellBender output right after it is written: "
+        "QC summary, per-barcode counts, optional filtered-matrix export and "
+        "a row in the cohort QC table"
+    )
+    parser.add_argument(
+        "--output-h5", required=True, help="CellBender output h5 file"
+    )
+    parser.add_argument("--sample", required=True, help="Sample name")
+    parser.add_argument(
+        "--qc-table",
+        default=None,
+        help="Cohort QC table (CSV) to add this sample's summary to",
+    )
+    parser.add_argument(
+        "--final-output",
+        default=None,
+        help="Path the output h5 will be copied to, recorded in the QC "
+        "summary instead of --output-h5 (used when staging through scratch)",
+    )
+    parser.add_argument(
+        "--export-mtx",
+        action="store_true",
+        help="Also export the cell barcodes as a 10x-style Matrix Market "
+        "directory",
+    )
+    parser.add_argument(
+        "--cell-threshold",
+        type=float,
+        default=CELL_PROBABILITY_THRESHOLD,
+        help="Cell probability above which a barcode counts as a cell "
+        f"(default: {CELL_PROBABILITY_THRESHOLD})",
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+
+    if h5py is None:
+        logging.error("h5py and numpy are required for CellBender post-processing")
+        sys.exit(1)
+    if not os.path.exists(args.output_h5):
+        logging.error(f"CellBender output not found: {args.output_h5}")
+        sys.exit(1)
+
+    summary = postprocess_output(
+        args.sample,
+        args.output_h5,
+        qc_table=args.qc_table,
+        export_mtx=args.export_mtx,
+        threshold=args.cell_threshold,
+        final_output=args.final_output,
+    )
+    logging.info(
+        f"{args.sample}: {summary['cells_kept']} cells kept of"
+        f" {summary['barcodes_analyzed']} barcodes analysed,"
+        f" ambient fraction {summary['ambient_fraction']}"
+    )
+
+
+if __name__ == "__main__":
+    main()
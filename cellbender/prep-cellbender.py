@@ -1,12 +1,61 @@
 #!/usr/bin/env python3
 
 import argparse
-import glob
+import cProfile
+import hashlib
+import json
 import logging
 import os
-import re
+import pstats
+import signal
+import subprocess
+import textwrap
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+import pipeline_metrics
+from job_templates import (
+    SCHEDULERS,
+    array_directives,
+    format_walltime,
+    load_template,
+    render_template,
+    submit_command,
+    write_files_atomic,
+    write_text_atomic,
+)
+from h5_header import (
+    file_signature,
+    h5py,
+    load_header_cache,
+    read_h5_headers,
+    save_header_cache,
+)
+from runtime_history import (
+    HISTORY_MARGIN,
+    MIN_HISTORY_RUNS,
+    TIMING_SUFFIX,
+    collect_timing_records,
+    fit_runtime_model,
+    load_runtime_history,
+    predict_resources,
+    save_runtime_history,
+    summarize_gpu_hours,
+)
+from run_watcher import (
+    FAILED,
+    FINISHED,
+    add_watches,
+    close_inotify,
+    load_watch_state,
+    open_inotify,
+    run_state,
+    save_watch_state,
+    wait_for_changes,
+)
+
 
 def should_skip_directory(dir_path):
     """Check if a directory should be skipped (SC_*_CS directories)."""
@@ -25,34 +74,81 @@ def is_in_skip_path(file_path):
     return False
 
 
-def create_result_dict(sample_name, file_path, result_type, run_id):
-    """Create a standardized result dictionary."""
-    return {
+def create_result_dict(sample_name, file_path, result_type, run_id, metadata=None):
+    """Create a standardized result dictionary.
+
+    metadata, if given, holds h5 header fields (see h5_header) and is
+    carried through to the generated scripts.
+    """
+    result = {
         "sample_name": sample_name,
         "file_path": os.path.abspath(file_path),
         "type": result_type,
         "run_id": run_id,
     }
+    if metadata is not None:
+        result["metadata"] = metadata
+    return result
+
+
+RAW_H5_NAMES = [
+    "sample_raw_feature_bc_matrix.h5",
+    "raw_feature_bc_matrix.h5",
+]
+
+
+_stats_lock = threading.Lock()
+
+
+def count_stat(stats, key, amount=1):
+    """Increment a discovery counter; safe to call from worker threads.
+
+    stat_calls_saved counts the os.path.exists/os.path.isdir calls the
+    serial os.listdir traversal made for the same lookups; those are now
+    answered from scandir listings without a stat of their own.
+    """
+    if stats is None:
+        return
+    with _stats_lock:
+        stats[key] += amount
+
 
+def scan_directory(dir_path, stats=None):
+    """List a directory with a single os.scandir pass.
 
-def find_h5_in_count_directory(count_dir, sample_dir, run_id):
+    Returns a dict of name -> DirEntry in scan order, or an empty dict if
+    the directory does not exist. The cached DirEntry type information is
+    used instead of separate os.path.exists/os.path.isdir calls.
+    """
+    try:
+        with os.scandir(dir_path) as it:
+            entries = {entry.name: entry for entry in it}
+    except (FileNotFoundError, NotADirectoryError):
+        entries = {}
+    count_stat(stats, "directories_scanned")
+    return entries
+
+
+def entry_is_dir(entries, name):
+    """Check whether a scanned entry exists and is a directory."""
+    entry = entries.get(name)
+    return entry is not None and entry.is_dir()
+
+
+def find_h5_in_count_directory(count_dir, sample_dir, run_id, stats=None):
     """Search for h5 files in a count directory with different naming patterns."""
-    h5_patterns = [
-        "sample_raw_feature_bc_matrix.h5",
-        "raw_feature_bc_matrix.h5",
-    ]
+    entries = scan_directory(count_dir, stats)
 
     # Check for standard naming patterns first
-    for pattern in h5_patterns:
-        h5_path = os.path.join(count_dir, pattern)
-        if os.path.exists(h5_path):
+    for pattern in RAW_H5_NAMES:
+        count_stat(stats, "stat_calls_saved")
+        if pattern in entries:
+            h5_path = os.path.join(count_dir, pattern)
             return create_result_dict(sample_dir, h5_path, "multi", run_id)
 
     # Fall back to searching for any h5 file containing "raw"
     h5_files = [
-        f
-        for f in os.listdir(count_dir)
-        if f.endswith(".h5") and "raw" in f.lower()
+        f for f in entries if f.endswith(".h5") and "raw" in f.lower()
     ]
     if h5_files:
         h5_path = os.path.join(count_dir, h5_files[0])
@@ -61,133 +157,953 @@ def find_h5_in_count_directory(count_dir, sample_dir, run_id):
     return None
 
 
-def find_raw_h5_files_in_run(run_dir):
+def walk_per_sample_outs(per_sample_path, entries, run_id, stats=None):
+    """Recursively search per_sample_outs for raw h5 files.
+
+    Replaces a full os.walk with scandir passes that prune SC_*_CS
+    directories before descending into them. The sample name is the first
+    path component below per_sample_outs.
+    """
+    results = []
+    if is_in_skip_path(per_sample_path):
+        return results
+
+    count_stat(stats, "fallback_walks")
+
+    stack = [(per_sample_path, entries, None)]
+    while stack:
+        root, root_entries, sample_name = stack.pop(0)
+        subdirs = []
+        for name, entry in root_entries.items():
+            if entry.is_dir():
+                if not should_skip_directory(name):
+                    subdirs.append(name)
+            elif name in RAW_H5_NAMES:
+                results.append(
+                    create_result_dict(
+                        sample_name if sample_name is not None else name,
+                        os.path.join(root, name),
+                        "multi",
+                        run_id,
+                    )
+                )
+
+        # Depth-first in scan order, matching os.walk's top-down traversal
+        stack[0:0] = [
+            (
+                os.path.join(root, name),
+                scan_directory(os.path.join(root, name), stats),
+                sample_name if sample_name is not None else name,
+            )
+            for name in subdirs
+        ]
+
+    return results
+
+
+def find_raw_h5_files_in_run(run_dir, stats=None):
     """Find all raw feature matrix h5 files in a specific CellRanger run directory."""
     results = []
     run_id = os.path.basename(run_dir)
 
     # Check for traditional CellRanger count output
-    raw_h5_path = os.path.join(run_dir, "outs", "raw_feature_bc_matrix.h5")
-    if os.path.exists(raw_h5_path):
+    outs_dir = os.path.join(run_dir, "outs")
+    outs_entries = scan_directory(outs_dir, stats)
+    count_stat(stats, "stat_calls_saved")
+    if "raw_feature_bc_matrix.h5" in outs_entries:
+        raw_h5_path = os.path.join(outs_dir, "raw_feature_bc_matrix.h5")
         results.append(create_result_dict(run_id, raw_h5_path, "count", run_id))
         return results
 
     # Check for CellRanger multi output
-    per_sample_path = os.path.join(run_dir, "outs", "per_sample_outs")
-    if not os.path.exists(per_sample_path):
+    count_stat(stats, "stat_calls_saved")
+    if not entry_is_dir(outs_entries, "per_sample_outs"):
         return results
+    per_sample_path = os.path.join(outs_dir, "per_sample_outs")
+    per_sample_entries = scan_directory(per_sample_path, stats)
 
     # Process each sample directory
-    sample_dirs = [
-        d
-        for d in os.listdir(per_sample_path)
-        if os.path.isdir(os.path.join(per_sample_path, d))
-        and not should_skip_directory(d)
-    ]
+    for sample_dir, entry in per_sample_entries.items():
+        count_stat(stats, "stat_calls_saved")
+        if not entry.is_dir() or should_skip_directory(sample_dir):
+            continue
 
-    for sample_dir in sample_dirs:
-        count_dir = os.path.join(per_sample_path, sample_dir, "count")
-        if not os.path.exists(count_dir):
+        sample_path = os.path.join(per_sample_path, sample_dir)
+        count_stat(stats, "stat_calls_saved")
+        if not entry_is_dir(scan_directory(sample_path, stats), "count"):
             continue
 
-        result = find_h5_in_count_directory(count_dir, sample_dir, run_id)
+        count_dir = os.path.join(sample_path, "count")
+        result = find_h5_in_count_directory(count_dir, sample_dir, run_id, stats)
         if result:
             results.append(result)
 
     # If no results found, try a focused search
     if not results:
-        for root, dirs, files in os.walk(per_sample_path):
-            if is_in_skip_path(root):
-                continue
+        results = walk_per_sample_outs(
+            per_sample_path, per_sample_entries, run_id, stats
+        )
 
-            dirs[:] = [d for d in dirs if not should_skip_directory(d)]
-
-            for file in files:
-                if file in [
-                    "sample_raw_feature_bc_matrix.h5",
-                    "raw_feature_bc_matrix.h5",
-                ]:
-                    file_path = os.path.join(root, file)
-                    parts = file_path.split(os.sep)
-                    try:
-                        sample_idx = parts.index("per_sample_outs") + 1
-                        if sample_idx < len(parts):
-                            sample_name = parts[sample_idx]
-                            results.append(
-                                create_result_dict(
-                                    sample_name, file_path, "multi", run_id
-                                )
-                            )
-                    except ValueError:
-                        continue
+    return results
+
+
+def find_run_directories(input_dir, entries, workers, stats=None):
+    """Find CellRanger run directories up to two levels below input_dir.
+
+    Child directories are listed concurrently. Each listing both answers
+    whether the child contains outs/ and is reused when looking one level
+    deeper, so no directory is listed twice.
+    """
+    child_dirs = [
+        os.path.join(input_dir, name)
+        for name in entries
+        if entry_is_dir(entries, name)
+    ]
+    count_stat(stats, "stat_calls_saved", len(entries))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        child_entries = list(
+            executor.map(lambda d: scan_directory(d, stats), child_dirs)
+        )
 
+        # Look for run directories at top level
+        potential_run_dirs = [
+            child_dir
+            for child_dir, listing in zip(child_dirs, child_entries)
+            if "outs" in listing
+        ]
+        count_stat(stats, "stat_calls_saved", len(child_dirs))
+
+        # Look one level deeper if nothing found
+        if not potential_run_dirs:
+            grandchild_dirs = [
+                os.path.join(child_dir, name)
+                for child_dir, listing in zip(child_dirs, child_entries)
+                for name in listing
+                if entry_is_dir(listing, name)
+            ]
+            # The serial traversal re-checked every top-level entry here
+            count_stat(
+                stats,
+                "stat_calls_saved",
+                len(entries) + sum(len(listing) for listing in child_entries),
+            )
+            grandchild_entries = executor.map(
+                lambda d: scan_directory(d, stats), grandchild_dirs
+            )
+            potential_run_dirs = [
+                grandchild_dir
+                for grandchild_dir, listing in zip(
+                    grandchild_dirs, grandchild_entries
+                )
+                if "outs" in listing
+            ]
+            count_stat(stats, "stat_calls_saved", len(grandchild_dirs))
+
+    return potential_run_dirs
+
+
+def run_signature(run_dir):
+    """Return the signature used to detect changes to a run directory.
+
+    The signature is the mtime and inode of outs/, the mtime of
+    outs/per_sample_outs when present, and the mtimes of each sample
+    directory there and its count/ directory, since a multi output that
+    lands in an existing sample directory touches none of the levels
+    above it. Returns None if outs/ does not exist.
+    """
+    try:
+        outs_stat = os.stat(os.path.join(run_dir, "outs"))
+    except FileNotFoundError:
+        return None
+    per_sample_path = os.path.join(run_dir, "outs", "per_sample_outs")
+    per_sample_mtime = None
+    sample_mtimes = {}
+    try:
+        per_sample_mtime = os.stat(per_sample_path).st_mtime_ns
+        with os.scandir(per_sample_path) as it:
+            for entry in it:
+                if not entry.is_dir():
+                    continue
+                try:
+                    count_mtime = os.stat(
+                        os.path.join(entry.path, "count")
+                    ).st_mtime_ns
+                except FileNotFoundError:
+                    count_mtime = None
+                sample_mtimes[entry.name] = [entry.stat().st_mtime_ns, count_mtime]
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return [outs_stat.st_mtime_ns, outs_stat.st_ino, per_sample_mtime, sample_mtimes]
+
+
+def load_discovery_index(index_path):
+    """Load a JSON-lines discovery index into a dict keyed by run directory.
+
+    Later lines override earlier ones. A missing or unreadable index is
+    treated as empty so discovery falls back to a full scan.
+    """
+    index = {}
+    if not index_path or not os.path.exists(index_path):
+        return index
+    with open(index_path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                index[record["run_dir"]] = record
+            except (json.JSONDecodeError, KeyError, TypeError):
+                logging.warning(f"Skipping malformed index line in {index_path}")
+    return index
+
+
+def save_discovery_index(index_path, index):
+    """Write the discovery index atomically via a temp file and rename."""
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    tmp_path = f"{index_path}.tmp.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        for run_dir in sorted(index):
+            f.write(json.dumps(index[run_dir]) + "\n")
+    os.replace(tmp_path, index_path)
+
+
+def discover_run(run_dir, stats=None, index=None):
+    """Find raw h5 files in a run, serving unchanged runs from the index."""
+    if index is None:
+        return find_raw_h5_files_in_run(run_dir, stats)
+
+    signature = run_signature(run_dir)
+    record = index.get(run_dir)
+    if signature is not None and record and record.get("signature") == signature:
+        count_stat(stats, "index_hits")
+        return record["results"]
+
+    count_stat(stats, "index_misses")
+    results = find_raw_h5_files_in_run(run_dir, stats)
+    index[run_dir] = {
+        "run_dir": run_dir,
+        "signature": signature,
+        "results": results,
+    }
     return results
 
 
-def find_raw_h5_files(input_dir):
-    """Find all raw feature matrix h5 files in the input directory."""
-    results = []
+def find_raw_h5_files(input_dir, workers=8, stats=None, index=None):
+    """Find all raw feature matrix h5 files in the input directory.
+
+    Run directories are processed across a thread pool of size workers;
+    results keep the same order as a serial traversal. If an index dict
+    is given, runs with an unchanged signature are served from it and
+    rescanned runs are written back into it.
+    """
     input_dir = os.path.abspath(input_dir)
+    if stats is None:
+        stats = Counter()
 
     # If input_dir is a specific CellRanger run directory
-    if os.path.exists(os.path.join(input_dir, "outs")):
-        return find_raw_h5_files_in_run(input_dir)
+    entries = scan_directory(input_dir, stats)
+    count_stat(stats, "stat_calls_saved")
+    if "outs" in entries:
+        count_stat(stats, "run_directories")
+        return discover_run(input_dir, stats, index)
 
     # Search for CellRanger outputs in subdirectories
-    potential_run_dirs = []
-
-    # Look for run directories at top level
-    for item in os.listdir(input_dir):
-        item_path = os.path.join(input_dir, item)
-        if os.path.isdir(item_path) and os.path.exists(
-            os.path.join(item_path, "outs")
-        ):
-            potential_run_dirs.append(item_path)
-
-    # Look one level deeper if nothing found
-    if not potential_run_dirs:
-        for item in os.listdir(input_dir):
-            item_path = os.path.join(input_dir, item)
-            if os.path.isdir(item_path):
-                for subitem in os.listdir(item_path):
-                    subitem_path = os.path.join(item_path, subitem)
-                    if os.path.isdir(subitem_path) and os.path.exists(
-                        os.path.join(subitem_path, "outs")
-                    ):
-                        potential_run_dirs.append(subitem_path)
+    potential_run_dirs = find_run_directories(input_dir, entries, workers, stats)
 
     # Process each potential run directory
-    for run_dir in potential_run_dirs:
-        results.extend(find_raw_h5_files_in_run(run_dir))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        run_results = executor.map(
+            lambda d: discover_run(d, stats, index), potential_run_dirs
+        )
+        results = [result for run in run_results for result in run]
 
+    count_stat(stats, "run_directories", len(potential_run_dirs))
     return results
 
 
-def extract_run_id_from_logs(file_path):
-    """Extract run ID from CellRanger log files if available."""
-    log_dir = os.path.join(
-        os.path.dirname(os.path.dirname(os.path.dirname(file_path))), "_log"
+DEFAULT_SIZING_MODEL = {
+    # Tiers are checked in order; the first whose max_nnz is not exceeded
+    # applies. A max_nnz of null matches everything.
+    "tiers": [
+        {
+            "max_nnz": 30_000_000,
+            "memory": "16G",
+            "walltime": "0:45",
+            "gpu_model": "a100",
+        },
+        {
+            "max_nnz": 150_000_000,
+            "memory": "32G",
+            "walltime": "1:30",
+            "gpu_model": "a100",
+        },
+        {
+            "max_nnz": None,
+            "memory": "64G",
+            "walltime": "3:00",
+            "gpu_model": "a10080g",
+        },
+    ],
+    # --total-droplets-included is expected cells times this factor, but at
+    # least expected cells plus min_empty_droplets and at most all barcodes
+    "droplets_per_expected_cell": 3,
+    "min_empty_droplets": 10000,
+}
+
+
+def load_sizing_model(model_path=None):
+    """Load a sizing model from JSON, falling back to the built-in default."""
+    model = dict(DEFAULT_SIZING_MODEL)
+    if model_path:
+        with open(model_path, "r") as f:
+            model.update(json.load(f))
+    return model
+
+
+def find_filtered_h5(raw_h5_path):
+    """Return the CellRanger filtered matrix next to a raw matrix, if any."""
+    dir_name, base_name = os.path.split(raw_h5_path)
+    filtered_path = os.path.join(dir_name, base_name.replace("raw", "filtered"))
+    if filtered_path != raw_h5_path and os.path.exists(filtered_path):
+        return filtered_path
+    return None
+
+
+def attach_h5_metadata(sample_files, cache_path=None, workers=8, stats=None):
+    """Read h5 headers for every sample and store them as sample_info["metadata"].
+
+    The CellRanger filtered matrix next to each raw matrix is read as well
+    and its barcode count recorded as n_filtered_barcodes. Headers are
+    served from the cache file at cache_path when the file is unchanged.
+    """
+    if h5py is None:
+        logging.warning("h5py is not installed; skipping h5 metadata")
+        return
+
+    filtered_paths = {
+        sample_info["file_path"]: find_filtered_h5(sample_info["file_path"])
+        for sample_info in sample_files
+    }
+    cache = load_header_cache(cache_path)
+    headers = read_h5_headers(
+        [info["file_path"] for info in sample_files]
+        + [path for path in filtered_paths.values() if path],
+        cache=cache,
+        workers=workers,
+        stats=stats,
     )
-    if os.path.exists(log_dir):
-        log_files = glob.glob(os.path.join(log_dir, "*.log"))
-        for log_file in log_files:
-            with open(log_file, "r") as f:
-                content = f.read()
-                match = re.search(r"Run ID: ([a-zA-Z0-9_-]+)", content)
-                if match:
-                    return match.group(1)
-    return f"cellranger_run_{datetime.now().strftime('%Y-%m-%d')}"
+    if cache_path:
+        save_header_cache(cache_path, cache)
+
+    for sample_info in sample_files:
+        header = headers.get(sample_info["file_path"])
+        if header is None:
+            continue
+        metadata = dict(header)
+        filtered_header = headers.get(filtered_paths[sample_info["file_path"]])
+        if filtered_header is not None:
+            metadata["n_filtered_barcodes"] = filtered_header["n_barcodes"]
+        sample_info["metadata"] = metadata
+
+
+def size_sample(sample_info, model):
+    """Derive per-sample LSF resources and CellBender droplet arguments.
+
+    Uses the h5 header in sample_info["metadata"]. Returns a dict of
+    resource overrides (memory, walltime, gpu_model), plus
+    expected_cells/total_droplets when the CellRanger filtered matrix was
+    found. Returns an empty dict if no metadata is available.
+    """
+    metadata = sample_info.get("metadata")
+    if not metadata:
+        return {}
+
+    tier = model["tiers"][-1]
+    for candidate in model["tiers"]:
+        max_nnz = candidate["max_nnz"]
+        if max_nnz is None or metadata["nnz"] <= max_nnz:
+            tier = candidate
+            break
+
+    resources = {
+        "memory": tier["memory"],
+        "walltime": tier["walltime"],
+        "gpu_model": tier["gpu_model"],
+    }
+
+    if "n_filtered_barcodes" in metadata:
+        expected_cells = metadata["n_filtered_barcodes"]
+        total_droplets = max(
+            expected_cells * model["droplets_per_expected_cell"],
+            expected_cells + model["min_empty_droplets"],
+        )
+        resources["expected_cells"] = expected_cells
+        resources["total_droplets"] = min(total_droplets, metadata["n_barcodes"])
+
+    return resources
+
+
+def size_samples(sample_files, model):
+    """Attach sizing results to each sample_info as sample_info["resources"]."""
+    for sample_info in sample_files:
+        resources = size_sample(sample_info, model)
+        sample_info["resources"] = resources
+        if resources:
+            metadata = sample_info["metadata"]
+            logging.info(
+                f"Sized {sample_info['sample_name']}:"
+                f" {metadata['n_barcodes']} barcodes,"
+                f" {metadata['nnz']} nnz -> {resources['memory']},"
+                f" {resources['walltime']}, {resources['gpu_model']}"
+            )
 
 
-def generate_lsf_script_multi(sample_info, parent_dir, params, multi_lib_id):
-    """Generate an LSF script for CellBender processing for multi samples."""
+def h5_cache_path(args):
+    """Return the h5 header cache file for this output directory."""
+    return args.h5_cache or os.path.join(
+        os.path.abspath(args.output_dir), ".cellbender_h5_cache.json"
+    )
+
+
+def update_runtime_history(args, history_path):
+    """Collect new timing records under OUTPUT_DIR into the history store.
+
+    New records get the nnz and barcode count of their input from the h5
+    header cache, so later fits can use them after the input is gone.
+    Returns the history dict and the number of new records.
+    """
+    history = load_runtime_history(history_path)
+    new_records = collect_timing_records(os.path.abspath(args.output_dir), history)
+    if not new_records:
+        return history, 0
+
+    inputs = [record["input_file"] for record in new_records if record.get("input_file")]
+    if h5py is not None and inputs:
+        cache = load_header_cache(h5_cache_path(args))
+        headers = read_h5_headers(inputs, cache=cache, workers=args.discovery_workers)
+        save_header_cache(h5_cache_path(args), cache)
+        for record in new_records:
+            header = headers.get(os.path.abspath(record.get("input_file") or ""))
+            if header is not None:
+                record["nnz"] = header["nnz"]
+                record["n_barcodes"] = header["n_barcodes"]
+    save_runtime_history(history_path, history)
+    return history, len(new_records)
+
+
+def plan_from_history(sample_files, records, default_gpu_model, min_runs, margin):
+    """Set walltime and memory requests from a fit to the runtime history.
+
+    Samples are predicted from their nnz when the history has enough runs
+    with nnz, otherwise from their input size; runs on the sample's GPU
+    model are preferred when there are enough of them. Predictions
+    override the tier sizing of --auto-resources. Returns the number of
+    samples planned.
+    """
+    models = {}
+
+    def model_for(gpu_model, feature):
+        if (gpu_model, feature) not in models:
+            same_gpu = [record for record in records if record.get("gpu_model") == gpu_model]
+            models[gpu_model, feature] = fit_runtime_model(
+                same_gpu, feature, min_runs
+            ) or fit_runtime_model(records, feature, min_runs)
+        return models[gpu_model, feature]
+
+    planned = 0
+    for sample_info in sample_files:
+        resources = sample_info.get("resources") or {}
+        gpu_model = resources.get("gpu_model", default_gpu_model)
+        metadata = sample_info.get("metadata") or {}
+        model = model_for(gpu_model, "nnz") if "nnz" in metadata else None
+        if model is not None:
+            value = metadata["nnz"]
+        else:
+            model = model_for(gpu_model, "input_bytes")
+            if model is None:
+                continue
+            value = os.path.getsize(sample_info["file_path"])
+
+        predicted = predict_resources(model, value, margin)
+        sample_info["resources"] = {**resources, **predicted}
+        planned += 1
+        logging.info(
+            f"Planned {sample_info['sample_name']} from {model['runs']} runs"
+            f" by {model['feature']}: walltime {predicted['walltime']},"
+            f" memory {predicted.get('memory', 'unchanged')}"
+        )
+    return planned
+
+
+def format_metadata_comment(sample_info):
+    """Format h5 header fields as a comment line for generated scripts."""
+    metadata = sample_info.get("metadata")
+    if not metadata:
+        return ""
+    feature_types = ", ".join(metadata.get("feature_types") or [])
+    return (
+        f"# Input matrix: {metadata['n_barcodes']} barcodes,"
+        f" {metadata['n_features']} features, {metadata['nnz']} nnz\n"
+        f"# Chemistry: {metadata.get('chemistry')}; feature types: {feature_types}\n"
+    )
+
+
+def parse_memory_mb(memory):
+    """Convert an LSF memory string such as 16G or 16000 to megabytes."""
+    units = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024 * 1024}
+    memory = str(memory).strip().upper().rstrip("B")
+    if memory and memory[-1] in units:
+        return float(memory[:-1]) * units[memory[-1]]
+    return float(memory)
+
+
+def parse_walltime_minutes(walltime):
+    """Convert an LSF H:MM (or plain minutes) walltime to minutes."""
+    if ":" in walltime:
+        hours, minutes = walltime.split(":", 1)
+        return int(hours) * 60 + int(minutes)
+    return int(walltime)
+
+
+def sample_params(params, sample_info):
+    """Return job parameters with any per-sample sizing applied."""
+    resources = sample_info.get("resources") or {}
+    return {
+        **params,
+        **{
+            key: resources[key]
+            for key in ("memory", "walltime", "gpu_model")
+            if key in resources
+        },
+    }
+
+
+def group_params(params, sample_infos):
+    """Return job parameters large enough for every sample in a group.
+
+    Uses the largest memory and walltime, and the GPU model of the sample
+    that needs the most memory.
+    """
+    per_sample = [sample_params(params, info) for info in sample_infos]
+    largest = max(per_sample, key=lambda p: parse_memory_mb(p["memory"]))
+    longest = max(
+        per_sample, key=lambda p: parse_walltime_minutes(p["walltime"])
+    )
+    return {
+        **params,
+        "memory": largest["memory"],
+        "gpu_model": largest["gpu_model"],
+        "walltime": longest["walltime"],
+    }
+
+
+def cellbender_extra_args(sample_info):
+    """Return sized CellBender arguments for a sample as a list of strings."""
+    resources = sample_info.get("resources") or {}
+    if "expected_cells" not in resources:
+        return []
+    return [
+        f"--expected-cells {resources['expected_cells']}",
+        f"--total-droplets-included {resources['total_droplets']}",
+    ]
+
+
+def format_extra_args(sample_info, indent="    "):
+    """Format sized CellBender arguments as shell continuation lines."""
+    return "".join(
+        f" \\\n{indent}{arg}" for arg in cellbender_extra_args(sample_info)
+    )
+
+
+FINGERPRINT_SUFFIX = "_cellbender_fingerprint.json"
+PARTIAL_HASH_BYTES = 1 << 20
+
+
+def partial_hash(file_path, chunk_size=PARTIAL_HASH_BYTES):
+    """Hash the size plus the first and last chunk_size bytes of a file."""
+    digest = hashlib.sha256()
+    size = os.path.getsize(file_path)
+    digest.update(str(size).encode())
+    with open(file_path, "rb") as f:
+        digest.update(f.read(chunk_size))
+        if size > chunk_size:
+            f.seek(max(chunk_size, size - chunk_size))
+            digest.update(f.read(chunk_size))
+    return digest.hexdigest()
+
+
+def sample_fingerprint(sample_info, params, with_hash=False):
+    """Build the input and CellBender parameter fingerprint for a sample."""
+    input_file = os.path.abspath(sample_info["file_path"])
+    size, mtime_ns = file_signature(input_file)
+    fingerprint = {
+        "input": {"path": input_file, "size": size, "mtime_ns": mtime_ns},
+        "params": {
+            "conda_env": params["conda_env"],
+            "cellbender_args": cellbender_extra_args(sample_info),
+        },
+    }
+    if with_hash:
+        fingerprint["input"]["partial_hash"] = partial_hash(input_file)
+    return fingerprint
+
+
+def attach_fingerprints(sample_files, params, with_hash=False, workers=8):
+    """Compute every sample's fingerprint as sample_info["fingerprint"]."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        fingerprints = executor.map(
+            lambda info: sample_fingerprint(info, params, with_hash), sample_files
+        )
+        for sample_info, fingerprint in zip(sample_files, fingerprints):
+            sample_info["fingerprint"] = fingerprint
+
+
+def fingerprints_match(recorded, current):
+    """Compare fingerprints; partial hashes count only when both have one."""
+    if recorded.get("params") != current["params"]:
+        return False
+    recorded_input = recorded.get("input") or {}
+    return all(
+        recorded_input.get(key) == value
+        for key, value in current["input"].items()
+        if key != "partial_hash" or "partial_hash" in recorded_input
+    )
+
+
+def output_is_complete(output_file, fingerprint_path):
+    """Check that a CellBender output exists, is readable and postdates its fingerprint.
+
+    The fingerprint is written when the job script is generated, so an
+    output older than it belongs to an earlier submission.
+    """
+    try:
+        if os.stat(output_file).st_mtime_ns < os.stat(fingerprint_path).st_mtime_ns:
+            return False
+    except FileNotFoundError:
+        return False
+    if h5py is None:
+        return os.path.getsize(output_file) > 0
+    try:
+        with h5py.File(output_file, "r") as f:
+            return "matrix" in f
+    except OSError:
+        return False
+
+
+def find_recorded_fingerprints(output_dir):
+    """Collect fingerprints of previous runs under output_dir.
+
+    Sample directories sit one level down (SAMPLE_DATE) or two levels
+    down for multi runs (LIB_DATE/SAMPLE). Returns a dict of input path ->
+    list of (fingerprint, output_file, fingerprint_path).
+    """
+    recorded = {}
+    pending = [(output_dir, 0)]
+    while pending:
+        dir_path, depth = pending.pop()
+        for entry in scan_directory(dir_path).values():
+            if entry.name.endswith(FINGERPRINT_SUFFIX):
+                try:
+                    with open(entry.path, "r") as f:
+                        fingerprint = json.load(f)
+                except (json.JSONDecodeError, OSError) as e:
+                    logging.warning(f"Ignoring unreadable fingerprint {entry.path}: {e}")
+                    continue
+                sample_name = entry.name[: -len(FINGERPRINT_SUFFIX)]
+                output_file = os.path.join(
+                    dir_path, f"{sample_name}_cellbender_output.h5"
+                )
+                recorded.setdefault(fingerprint["input"]["path"], []).append(
+                    (fingerprint, output_file, entry.path)
+                )
+            elif depth < 2 and entry.is_dir(follow_symlinks=False):
+                pending.append((entry.path, depth + 1))
+    return recorded
+
+
+def filter_completed_samples(sample_files, output_dir, params, stats=None):
+    """Drop samples whose fingerprint matches a complete earlier output.
+
+    Every sample must already carry sample_info["fingerprint"]. Returns
+    (remaining samples, list of (sample_info, existing output file)).
+    """
+    recorded = find_recorded_fingerprints(output_dir)
+    remaining = []
+    completed = []
+    for sample_info in sample_files:
+        fingerprint = sample_info["fingerprint"]
+        candidates = recorded.get(fingerprint["input"]["path"], [])
+        match = next(
+            (
+                output_file
+                for previous, output_file, fingerprint_path in candidates
+                if fingerprints_match(previous, fingerprint)
+                and output_is_complete(output_file, fingerprint_path)
+            ),
+            None,
+        )
+        if match is None:
+            remaining.append(sample_info)
+        else:
+            count_stat(stats, "samples_already_done")
+            completed.append((sample_info, match))
+    return remaining, completed
+
+
+def fingerprint_unchanged(fingerprint_path, fingerprint):
+    """Check whether fingerprint_path already records this fingerprint."""
+    try:
+        with open(fingerprint_path, "r") as f:
+            return json.load(f) == fingerprint
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+
+
+def write_fingerprints(sample_dirs):
+    """Record each sample's fingerprint next to its CellBender output.
+
+    An unchanged fingerprint is left alone, since rewriting it would make
+    an output that postdates it look stale to output_is_complete.
+    """
+    items = []
+    for sample_info, sample_dir in sample_dirs:
+        if "fingerprint" not in sample_info:
+            continue
+        fingerprint_path = os.path.join(
+            sample_dir, f"{sample_info['sample_name']}{FINGERPRINT_SUFFIX}"
+        )
+        if not fingerprint_unchanged(fingerprint_path, sample_info["fingerprint"]):
+            items.append(
+                (fingerprint_path, json.dumps(sample_info["fingerprint"], indent=2) + "\n")
+            )
+    write_files_atomic(items)
+
+
+def job_context(params, job_name, work_dir, log_name, description, commands, array=None):
+    """Build the template substitutions shared by every kind of job script.
+
+    array is None for a single job, or (n_tasks, limit) for a job array.
+    """
+    scheduler = params.get("scheduler", "lsf")
+    extra_directives = ""
+    job_id = SCHEDULERS[scheduler]["job_id"]
+    if array is not None:
+        job_name, extra_directives = array_directives(scheduler, job_name, *array)
+        job_id = SCHEDULERS[scheduler]["array_job_id"]
+
+    return {
+        "PROJECT": params["project"],
+        "JOB_NAME": job_name,
+        "WALLTIME": format_walltime(params["walltime"], scheduler),
+        "QUEUE": params["queue"],
+        "CORES": params["cores"],
+        "GPU_MODEL": params["gpu_model"],
+        "GPU_NUM": params["gpu_num"],
+        "MEMORY": params["memory"],
+        "EMAIL": params["email"],
+        "STDOUT": f"{work_dir}/output_{log_name}_{job_id}.stdout",
+        "STDERR": f"{work_dir}/error_{log_name}_{job_id}.stderr",
+        "WORK_DIR": work_dir,
+        "EXTRA_DIRECTIVES": extra_directives,
+        "DESCRIPTION": description,
+        "CONDA_ENV": params["conda_env"],
+        "CUDA_VERSION": params["cuda_version"],
+        "COMMANDS": commands,
+    }
+
+
+def render_job_script(params, context):
+    """Render a job script with the configured scheduler template."""
+    with pipeline_metrics.timed("script_rendering"):
+        template = load_template(params.get("template"), params.get("scheduler", "lsf"))
+        script = render_template(template, context)
+    pipeline_metrics.count("scripts_rendered")
+    return script
+
+
+def script_extension(params):
+    """Return the job-script file extension for the configured scheduler."""
+    return SCHEDULERS[params.get("scheduler", "lsf")]["extension"]
+
+
+QC_TABLE_NAME = "cellbender_qc_summary.csv"
+POSTPROCESS_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "postprocess-cellbender.py"
+)
+
+
+def post_stage_command(params, sample_name, output_file, final_output=None):
+    """Return the QC post-stage command for a sample, or "" if disabled.
+
+    sample_name and output_file may be shell variable references.
+    final_output is where a staged output will be copied to, recorded in
+    the QC table instead of the scratch path.
+    """
+    if not params.get("post_qc"):
+        return ""
+    args = [f'--output-h5 "{output_file}"', f'--sample "{sample_name}"']
+    if final_output:
+        args.append(f'--final-output "{final_output}"')
+    if params.get("qc_table"):
+        args.append(f'--qc-table "{params["qc_table"]}"')
+    if params.get("export_mtx"):
+        args.append("--export-mtx")
+    return (
+        f'python3 "{POSTPROCESS_SCRIPT}" {" ".join(args)}'
+        f' || echo "QC post-stage failed for sample {sample_name}" >&2'
+    )
+
+
+def format_post_stage(params, sample_name, output_file):
+    """Format the QC post-stage as a block that runs if CellBender succeeded.
+
+    Expects cellbender_exit to hold CellBender's exit status.
+    """
+    command = post_stage_command(params, sample_name, output_file)
+    if not command:
+        return ""
+    return f"""
+
+# QC post-stage on the fresh output, so no later job has to re-read it
+if [ $cellbender_exit -eq 0 ]; then
+    {command}
+fi"""
+
+
+# Shell helpers emitted into scripts that stage through node-local scratch
+STAGING_FUNCTIONS = """# Copy a file, reading the source once through tee, verify the copy's
+# checksum and rename it into place
+copy_verified () {
+    local src=$1 dest=$2 tmp="$2.tmp.$$" src_sum dest_sum
+    src_sum=$(tee "$tmp" < "$src" | sha256sum | cut -d' ' -f1) || return 1
+    dest_sum=$(sha256sum "$tmp" | cut -d' ' -f1)
+    if [ -z "$src_sum" ] || [ "$src_sum" != "$dest_sum" ]; then
+        echo "Checksum mismatch copying $src to $dest" >&2
+        rm -f "$tmp"
+        return 1
+    fi
+    mv -f "$tmp" "$dest"
+}
+
+# Copy every staged output back, the main output h5 last so that its
+# presence marks a complete set
+stage_out () {
+    local src_dir=$1 dest_dir=$2 main_output=$3 rel
+    while IFS= read -r rel; do
+        mkdir -p "$dest_dir/$(dirname "$rel")"
+        copy_verified "$src_dir/$rel" "$dest_dir/$rel" || return 1
+    done < <(cd "$src_dir" && find . -type f ! -path "./$main_output" | sed 's|^\\./||')
+    copy_verified "$src_dir/$main_output" "$dest_dir/$main_output"
+}
+"""
+
+
+# Shell helper emitted into scripts that record per-sample timing
+TIMING_FUNCTIONS = """# Run a command (under /usr/bin/time when installed, for peak memory) and
+# write a timing record for the sample; returns the command's exit code
+record_timing () {
+    local record=$1 sample=$2 input=$3 gpu_model=$4
+    local start end exit_code peak_kb input_bytes gpu_name gpus
+    shift 4
+    start=$(date +%s)
+    if [ -x /usr/bin/time ]; then
+        /usr/bin/time -f "%M" -o "$record.rss" "$@"
+        exit_code=$?
+        peak_kb=$(tail -n 1 "$record.rss" 2>/dev/null | grep -E '^[0-9]+$')
+        rm -f "$record.rss"
+    else
+        "$@"
+        exit_code=$?
+    fi
+    end=$(date +%s)
+    input_bytes=$(stat -c %s "$input" 2>/dev/null)
+    gpu_name=$(nvidia-smi --query-gpu=name --format=csv,noheader 2>/dev/null | head -n 1 | tr -d '"\\\\')
+    gpus=$(echo "${CUDA_VISIBLE_DEVICES:-0}" | tr ',' '\\n' | grep -c .)
+    printf '{"sample": "%s", "input_file": "%s", "input_bytes": %s, "gpu_model": "%s", "gpu_name": "%s", "gpus": %s, "host": "%s", "start": %s, "end": %s, "wall_seconds": %s, "peak_rss_kb": %s, "exit_code": %s}\\n' \\
+        "$sample" "$input" "${input_bytes:-null}" "$gpu_model" "$gpu_name" "$gpus" \\
+        "$(hostname)" "$start" "$end" "$((end - start))" "${peak_kb:-null}" "$exit_code" \\
+        > "$record.tmp.$$" && mv -f "$record.tmp.$$" "$record"
+    return $exit_code
+}
+"""
+
+
+def timing_prefix(
+    params, sample_name="${sample_name}", input_file="$input_file", sample_dir="$sample_dir"
+):
+    """Return the record_timing call to put before cellbender, or "" if disabled.
+
+    The arguments may be shell variable references.
+    """
+    if not params.get("record_timing"):
+        return ""
+    record = f"{sample_dir}/{sample_name}{TIMING_SUFFIX}"
+    return (
+        f'record_timing "{record}" "{sample_name}" "{input_file}"'
+        f' "{params["gpu_model"]}" '
+    )
+
+
+def timing_functions(params, standalone=False):
+    """Return the shell helpers record_timing needs, or "" if disabled.
+
+    The block is formatted to follow other helpers, or with standalone
+    to stand directly before the commands.
+    """
+    if not params.get("record_timing"):
+        return ""
+    return f"{TIMING_FUNCTIONS}\n" if standalone else f"\n{TIMING_FUNCTIONS}"
+
+
+def format_staged_run(params, extra_args, cuda_prefix=""):
+    """Format a CellBender run staged through node-local scratch.
+
+    Uses the shell variables sample_name, input_file, output_file and
+    sample_dir. The input is copied to a private scratch directory with
+    checksum verification, CellBender (and the QC post-stage) run there,
+    and the outputs are copied back only if CellBender succeeded. Sets
+    cellbender_exit; the scratch directory is removed on exit unless the
+    copy back failed, so the outputs can still be recovered from it.
+    """
+    scratch_dir = params.get("scratch_dir") or "${TMPDIR:-/tmp}"
+    post_stage = post_stage_command(
+        params, "$sample_name", "$local_output", final_output="$output_file"
+    )
+    if post_stage:
+        post_stage = f"\n    {post_stage}"
+    return f"""stage_dir=$(mktemp -d "{scratch_dir}/cellbender_${{sample_name}}.XXXXXX") || exit 1
+trap 'rm -rf "$stage_dir"' EXIT
+mkdir -p "$stage_dir/in" "$stage_dir/out" "$stage_dir/work"
+local_input="$stage_dir/in/$(basename "$input_file")"
+local_output="$stage_dir/out/$(basename "$output_file")"
+echo "Staging input to $local_input"
+copy_verified "$input_file" "$local_input" || exit 1
+
+cd "$stage_dir/work"
+{cuda_prefix}{timing_prefix(params)}cellbender remove-background \\
+    --cuda \\
+    --input "$local_input" \\
+    --output "$local_output"{extra_args}
+cellbender_exit=$?
+
+if [ $cellbender_exit -eq 0 ]; then{post_stage}
+    echo "Copying outputs back to $sample_dir"
+    if ! stage_out "$stage_dir/out" "$sample_dir" "$(basename "$output_file")"; then
+        cellbender_exit=1
+        trap - EXIT
+        echo "Copying outputs back failed; outputs kept in $stage_dir" >&2
+    fi
+fi
+cd "$sample_dir\""""
+
+
+def render_sample_script(sample_info, sample_dir, params):
+    """Render the CellBender job script for one sample.
+
+    Returns (script_path, script_content); nothing is written.
+    """
     sample_name = sample_info["sample_name"]
     input_file = sample_info["file_path"]
-    run_id = sample_info.get("run_id", extract_run_id_from_logs(input_file))
-
-    # Create sample-specific subdirectory
-    sample_dir = os.path.join(parent_dir, sample_name)
-    os.makedirs(sample_dir, exist_ok=True)
+    params = sample_params(params, sample_info)
 
     # Log the input/output mapping
     logging.info(f"Processing sample: {sample_name}")
@@ -195,41 +1111,33 @@ def generate_lsf_script_multi(sample_info, parent_dir, params, multi_lib_id):
     logging.info(f"Output directory: {sample_dir}")
 
     output_file = os.path.join(sample_dir, f"{sample_name}_cellbender_output.h5")
-    lsf_script_path = os.path.join(sample_dir, f"run_cellbender_{sample_name}.lsf")
-
-    script_content = f"""#BSUB -P {params['project']}
-#BSUB -J {sample_name}_cellbender
-#BSUB -W {params['walltime']}
-#BSUB -q {params['queue']}
-#BSUB -n {params['cores']}
-#BSUB -R span[hosts=1]
-#BSUB -R {params['gpu_model']}
-#BSUB -gpu num={params['gpu_num']}
-#BSUB -R rusage[mem={params['memory']}]
-#BSUB -u {params['email']}
-#BSUB -o {sample_dir}/output_{sample_name}_%J.stdout
-#BSUB -eo {sample_dir}/error_{sample_name}_%J.stderr
-#BSUB -L /bin/bash
-#BSUB -cwd {sample_dir}
-
-# Generated LSF submission script for CellBender
+    script_path = os.path.join(
+        sample_dir, f"run_cellbender_{sample_name}.{script_extension(params)}"
+    )
+
+    description = f"""# Generated {params.get('scheduler', 'lsf').upper()} submission script for CellBender
 # Sample: {sample_name}
 # Input file: {input_file}
 # Output file: {output_file}
+{format_metadata_comment(sample_info)}"""
 
-export http_proxy=http://172.28.7.1:3128
-export https_proxy=http://172.28.7.1:3128
-export all_proxy=http://172.28.7.1:3128
-export no_proxy=localhost,*.chimera.hpc.mssm.edu,172.28.0.0/16
-
-source /hpc/users/tastac01/micromamba/etc/profile.d/conda.sh
-conda init bash
-conda activate {params['conda_env']}
+    if params.get("stage_to_local"):
+        run_commands = f"""sample_name="{sample_name}"
+input_file="{input_file}"
+output_file="{output_file}"
+sample_dir="{sample_dir}"
 
-# Load CUDA module if needed
-ml cuda/{params['cuda_version']}
+{STAGING_FUNCTIONS}{timing_functions(params)}
+{format_staged_run(params, format_extra_args(sample_info))}"""
+    else:
+        timing = timing_prefix(params, sample_name, input_file, sample_dir)
+        run_commands = f"""{timing_functions(params, standalone=True)}{timing}cellbender remove-background \\
+    --cuda \\
+    --input {input_file} \\
+    --output {output_file}{format_extra_args(sample_info)}
+cellbender_exit=$?{format_post_stage(params, sample_name, output_file)}"""
 
-# Ensure we're in the sample directory
+    commands = f"""# Ensure we're in the sample directory
 cd {sample_dir}
 echo "Working directory: $(pwd)"
 
@@ -242,91 +1150,717 @@ echo "Input file: {input_file}"
 echo "Output file: {output_file}"
 echo "GPU devices available: $CUDA_VISIBLE_DEVICES"
 
-cellbender remove-background \\
-    --cuda \\
-    --input {input_file} \\
-    --output {output_file} \\
+{run_commands}
 
 echo "Completed CellBender for sample {sample_name} at $(date)"
-"""
+exit $cellbender_exit"""
+
+    context = job_context(
+        params, f"{sample_name}_cellbender", sample_dir, sample_name, description, commands
+    )
+    return script_path, render_job_script(params, context)
 
-    with open(lsf_script_path, "w") as f:
-        f.write(script_content)
 
-    return lsf_script_path
+def generate_sample_scripts(sample_dirs, params):
+    """Render every sample's job script in one pass, then write them all.
+
+    sample_dirs is a list of (sample_info, sample_output_dir) pairs.
+    Returns the script paths in the same order.
+    """
+    rendered = [
+        render_sample_script(sample_info, sample_dir, params)
+        for sample_info, sample_dir in sample_dirs
+    ]
+    return write_files_atomic(rendered)
+
+
+def generate_lsf_script_multi(sample_info, parent_dir, params, multi_lib_id):
+    """Generate a job script for CellBender processing for multi samples."""
+    # Create sample-specific subdirectory
+    sample_dir = os.path.join(parent_dir, sample_info["sample_name"])
+    os.makedirs(sample_dir, exist_ok=True)
+
+    return generate_sample_scripts([(sample_info, sample_dir)], params)[0]
 
 
 def generate_lsf_script_single(sample_info, output_dir, params):
-    """Generate an LSF script for CellBender processing for single samples."""
-    sample_name = sample_info["sample_name"]
-    input_file = sample_info["file_path"]
-    run_id = sample_info.get("run_id", extract_run_id_from_logs(input_file))
+    """Generate a job script for CellBender processing for single samples."""
+    return generate_sample_scripts([(sample_info, output_dir)], params)[0]
+
+
+def scale_walltime(walltime, factor):
+    """Multiply an LSF H:MM walltime by factor."""
+    total = parse_walltime_minutes(walltime) * factor
+    return f"{total // 60}:{total % 60:02d}"
+
+
+def generate_lsf_script_batch(batch, batch_dir, batch_name, params):
+    """Generate a job script that runs several CellBender samples in one job.
+
+    batch is a list of (sample_info, sample_output_dir) pairs. Samples are
+    distributed round-robin over one lane per GPU; each lane runs its
+    samples back to back on its own device, and lanes run concurrently.
+    Every sample keeps its own stdout/stderr and exit code file, and the
+    job exits non-zero if any sample failed.
+    """
+    params = group_params(params, [sample_info for sample_info, _ in batch])
+    gpu_num = max(1, int(params["gpu_num"]))
+    lanes = [batch[i::gpu_num] for i in range(gpu_num)]
+    lanes = [lane for lane in lanes if lane]
+    params["walltime"] = scale_walltime(
+        params["walltime"], max(len(lane) for lane in lanes)
+    )
 
-    # Log the input/output mapping
-    logging.info(f"Processing sample: {sample_name}")
-    logging.info(f"Input file: {input_file}")
-    logging.info(f"Output directory: {output_dir}")
-
-    output_file = os.path.join(output_dir, f"{sample_name}_cellbender_output.h5")
-    lsf_script_path = os.path.join(output_dir, f"run_cellbender_{sample_name}.lsf")
-
-    script_content = f"""#BSUB -P {params['project']}
-#BSUB -J {sample_name}_cellbender
-#BSUB -W {params['walltime']}
-#BSUB -q {params['queue']}
-#BSUB -n {params['cores']}
-#BSUB -R span[hosts=1]
-#BSUB -R {params['gpu_model']}
-#BSUB -gpu num={params['gpu_num']}
-#BSUB -R rusage[mem={params['memory']}]
-#BSUB -u {params['email']}
-#BSUB -o {output_dir}/output_{sample_name}_%J.stdout
-#BSUB -eo {output_dir}/error_{sample_name}_%J.stderr
-#BSUB -L /bin/bash
-#BSUB -cwd {output_dir}
-
-# Generated LSF submission script for CellBender
-# Sample: {sample_name}
-# Input file: {input_file}
-# Output file: {output_file}
+    script_path = os.path.join(
+        batch_dir, f"run_cellbender_{batch_name}.{script_extension(params)}"
+    )
+    status_file = os.path.join(batch_dir, f"{batch_name}_status.tsv")
 
-export http_proxy=http://172.28.7.1:3128
-export https_proxy=http://172.28.7.1:3128
-export all_proxy=http://172.28.7.1:3128
-export no_proxy=localhost,*.chimera.hpc.mssm.edu,172.28.0.0/16
+    lane_blocks = []
+    for lane_index, lane in enumerate(lanes):
+        calls = []
+        for sample_info, sample_dir in lane:
+            sample_name = sample_info["sample_name"]
+            input_file = sample_info["file_path"]
+            output_file = os.path.join(
+                sample_dir, f"{sample_name}_cellbender_output.h5"
+            )
+            logging.info(f"Packing sample {sample_name} into {batch_name}")
+            calls.append(
+                f'    run_sample "{sample_name}" "{input_file}" "{output_file}"'
+                f' "{sample_dir}" "$gpu"'
+                + "".join(f" {arg}" for arg in cellbender_extra_args(sample_info))
+            )
+        lane_blocks.append(
+            f"""(
+    gpu="${{GPUS[{lane_index}]:-{lane_index}}}"
+{chr(10).join(calls)}
+) &"""
+        )
 
-source /hpc/users/tastac01/micromamba/etc/profile.d/conda.sh
-conda init bash
-conda activate {params['conda_env']}
+    if params.get("stage_to_local"):
+        helper_functions = f"\n{STAGING_FUNCTIONS}{timing_functions(params)}"
+        sample_run = textwrap.indent(
+            format_staged_run(
+                params, ' \\\n    "$@"', cuda_prefix="CUDA_VISIBLE_DEVICES=$gpu "
+            )
+            + "\nexit $cellbender_exit",
+            " " * 8,
+        )
+    else:
+        helper_functions = timing_functions(params)
+        post_stage = post_stage_command(params, "$sample_name", "$output_file")
+        if post_stage:
+            post_stage = f" || exit $?\n        {post_stage}"
+        sample_run = f"""        CUDA_VISIBLE_DEVICES=$gpu {timing_prefix(params)}cellbender remove-background \\
+            --cuda \\
+            --input "$input_file" \\
+            --output "$output_file" \\
+            "$@"{post_stage}"""
+
+    sample_list = ", ".join(info["sample_name"] for info, _ in batch)
+    description = f"""# Generated {params.get('scheduler', 'lsf').upper()} batch script for CellBender
+# Batch: {batch_name}
+# Samples: {sample_list}
+"""
 
-# Load CUDA module if needed
-ml cuda/{params['cuda_version']}
+    commands = f"""cd {batch_dir}
+echo "Working directory: $(pwd)"
+echo "GPU devices available: $CUDA_VISIBLE_DEVICES"
+IFS=',' read -ra GPUS <<< "$CUDA_VISIBLE_DEVICES"
+
+printf "sample\\tgpu\\texit_code\\tstart\\tend\\n" > "{status_file}"
+{helper_functions}
+# Run one sample with its own stdout/stderr and exit code
+run_sample () {{
+    local sample_name=$1 input_file=$2 output_file=$3 sample_dir=$4 gpu=$5
+    local start end exit_code
+    shift 5
+    start=$(date '+%F %T')
+    (
+        cd "$sample_dir"
+        echo "Starting CellBender for sample $sample_name at $(date)"
+        echo "Input file: $input_file"
+        echo "Output file: $output_file"
+        echo "GPU device: $gpu"
+{sample_run}
+    ) > "$sample_dir/output_$sample_name.stdout" \\
+      2> "$sample_dir/error_$sample_name.stderr"
+    exit_code=$?
+    end=$(date '+%F %T')
+    echo "$exit_code" > "$sample_dir/exit_code_$sample_name.txt"
+    printf "%s\\t%s\\t%s\\t%s\\t%s\\n" "$sample_name" "$gpu" "$exit_code" "$start" "$end" >> "{status_file}"
+    echo "Completed CellBender for sample $sample_name with exit code $exit_code at $(date)"
+}}
+
+{chr(10).join(lane_blocks)}
+wait
+
+failed=$(awk -F'\\t' 'NR > 1 && $3 != 0' "{status_file}" | wc -l)
+echo "Batch {batch_name} finished with $failed failed samples at $(date)"
+[ "$failed" -eq 0 ]"""
+
+    context = job_context(
+        params, f"{batch_name}_cellbender", batch_dir, batch_name, description, commands
+    )
+    write_text_atomic(script_path, render_job_script(params, context))
+    return script_path
+
+
+SUBMIT_SCRIPT_NAME = "submit_cellbender_jobs.sh"
+
+
+def submission_script_path(directory, params):
+    """Return the path of the submission script to write in directory.
+
+    Jobs generated by --watch carry their run's label, so runs that share
+    a job directory keep separate submission scripts.
+    """
+    label = params.get("job_label")
+    name = f"submit_cellbender_jobs_{label}.sh" if label else SUBMIT_SCRIPT_NAME
+    return os.path.join(directory, name)
+
+
+def write_submission_script(path, comment, scripts, params, delay=0):
+    """Write an executable script that submits each job script in turn."""
+    scheduler = params.get("scheduler", "lsf")
+    lines = ["#!/bin/bash", "", f"# {comment}", ""]
+    for script in scripts:
+        lines.append(submit_command(scheduler, script))
+        if delay:
+            lines.append(f"sleep {delay}")
+    write_text_atomic(path, "\n".join(lines) + "\n", mode=0o755)
+    return path
+
+
+def write_packed_jobs(sample_dirs, batch_dir, params, pack, label):
+    """Write batch job scripts of up to pack samples plus a submission script.
+
+    sample_dirs is a list of (sample_info, sample_output_dir) pairs.
+    Returns the list of batch scripts and the submission script path.
+    """
+    os.makedirs(batch_dir, exist_ok=True)
+
+    scripts = []
+    for batch_index, start in enumerate(range(0, len(sample_dirs), pack), 1):
+        batch = sample_dirs[start : start + pack]
+        batch_name = f"{label}_batch{batch_index:03d}"
+        scripts.append(generate_lsf_script_batch(batch, batch_dir, batch_name, params))
+
+    submit_script_path = write_submission_script(
+        submission_script_path(batch_dir, params),
+        f"Submit packed CellBender jobs for: {label}",
+        scripts,
+        params,
+    )
+    return scripts, submit_script_path
+
+
+def generate_lsf_array_script(sample_dirs, job_dir, label, params, limit=0):
+    """Generate one job-array script covering every sample.
+
+    A tab-separated manifest maps each array index to a sample; the array
+    element looks up its row from the scheduler's array index variable.
+    limit caps the number of elements running at once (0 means no cap).
+    Returns the script and manifest paths.
+    """
+    manifest_lines = ["index\tsample_name\tinput_file\tsample_dir\tcellbender_args"]
+    for index, (sample_info, sample_dir) in enumerate(sample_dirs, 1):
+        logging.info(f"Array index {index}: sample {sample_info['sample_name']}")
+        manifest_lines.append(
+            f"{index}\t{sample_info['sample_name']}"
+            f"\t{sample_info['file_path']}\t{sample_dir}"
+            f"\t{' '.join(cellbender_extra_args(sample_info))}"
+        )
+    manifest_path = os.path.join(job_dir, f"{label}_manifest.tsv")
+    write_text_atomic(manifest_path, "\n".join(manifest_lines) + "\n")
+
+    params = group_params(params, [sample_info for sample_info, _ in sample_dirs])
+    index_var = SCHEDULERS[params.get("scheduler", "lsf")]["array_index"]
+    script_path = os.path.join(
+        job_dir, f"run_cellbender_{label}_array.{script_extension(params)}"
+    )
+
+    description = f"""# Generated {params.get('scheduler', 'lsf').upper()} job-array script for CellBender
+# Manifest: {manifest_path}
+# Samples: {len(sample_dirs)}
+"""
+
+    if params.get("stage_to_local"):
+        staged_run = format_staged_run(params, " \\\n    $cellbender_args")
+        run_commands = f"""{STAGING_FUNCTIONS}{timing_functions(params)}
+{staged_run}"""
+    else:
+        run_commands = f"""{timing_functions(params, standalone=True)}{timing_prefix(params)}cellbender remove-background \\
+    --cuda \\
+    --input "$input_file" \\
+    --output "$output_file" \\
+    $cellbender_args
+cellbender_exit=$?{format_post_stage(params, "$sample_name", "$output_file")}"""
+
+    commands = f"""# Resolve this element's sample from the manifest
+IFS=$'\\t' read -r _ sample_name input_file sample_dir cellbender_args < <(
+    awk -F'\\t' -v idx="${index_var}" '$1 == idx' "{manifest_path}"
+)
+if [ -z "$sample_name" ]; then
+    echo "No manifest entry for array index ${index_var}" >&2
+    exit 1
+fi
+output_file="$sample_dir/${{sample_name}}_cellbender_output.h5"
 
-# Ensure we're in the output directory
-cd {output_dir}
+# Ensure we're in the sample directory
+cd "$sample_dir"
 echo "Working directory: $(pwd)"
 
 # Redirect stdout and stderr using exec
-exec 1> "{output_dir}/output_{sample_name}.stdout"
-exec 2> "{output_dir}/error_{sample_name}.stderr"
+exec 1> "$sample_dir/output_$sample_name.stdout"
+exec 2> "$sample_dir/error_$sample_name.stderr"
 
-echo "Starting CellBender for sample {sample_name} at $(date)"
-echo "Input file: {input_file}"
-echo "Output file: {output_file}"
+echo "Starting CellBender for sample $sample_name at $(date)"
+echo "Input file: $input_file"
+echo "Output file: $output_file"
 echo "GPU devices available: $CUDA_VISIBLE_DEVICES"
 
-cellbender remove-background \\
-    --cuda \\
-    --input {input_file} \\
-    --output {output_file} \\
+{run_commands}
 
-echo "Completed CellBender for sample {sample_name} at $(date)"
-"""
+echo "Completed CellBender for sample $sample_name at $(date)"
+exit $cellbender_exit"""
+
+    context = job_context(
+        params,
+        f"{label}_cellbender",
+        job_dir,
+        label,
+        description,
+        commands,
+        array=(len(sample_dirs), limit),
+    )
+    write_text_atomic(script_path, render_job_script(params, context))
+    return script_path, manifest_path
+
+
+def write_array_job(sample_dirs, job_dir, params, limit, label):
+    """Write a job-array script, its manifest and a one-line submission script."""
+    os.makedirs(job_dir, exist_ok=True)
+    script, manifest_path = generate_lsf_array_script(
+        sample_dirs, job_dir, label, params, limit
+    )
+
+    submit_script_path = write_submission_script(
+        submission_script_path(job_dir, params),
+        f"Submit CellBender job array for: {label}",
+        [script],
+        params,
+    )
+    return [script], submit_script_path
+
+
+def write_grouped_jobs(args, sample_dirs, job_dir, params, label):
+    """Write packed or job-array scripts for samples sharing a submission.
+
+    Returns the submission script path.
+    """
+    if params.get("job_label"):
+        label = f"{label}_{params['job_label']}"
+    if args.array:
+        lsf_scripts, submit_script_path = write_array_job(
+            sample_dirs, job_dir, params, args.array_limit, label
+        )
+        logging.info(
+            f"Generated LSF job array for {len(sample_dirs)} samples:"
+            f" {lsf_scripts[0]}"
+        )
+    else:
+        lsf_scripts, submit_script_path = write_packed_jobs(
+            sample_dirs, job_dir, params, args.pack, label
+        )
+        logging.info(
+            f"Generated {len(lsf_scripts)} packed LSF scripts for"
+            f" {len(sample_dirs)} samples"
+        )
+    logging.info(f"Submission script created at: {submit_script_path}")
+    return submit_script_path
+
+
+def prepare_jobs(args, discovery_stats, input_dir=None, job_label=None):
+    """Discover samples and write their job and submission scripts.
+
+    input_dir defaults to --input-dir; job_label, if given, is added to
+    shared job and submission script names. Returns the submission
+    scripts written.
+    """
+    # Process directories and find files
+    input_dir = os.path.abspath(input_dir or args.input_dir)
+    submit_scripts = []
+    index_path = None
+    discovery_index = None
+    if not args.no_discovery_index:
+        index_path = args.discovery_index or os.path.join(
+            os.path.abspath(args.output_dir), ".cellbender_discovery_index.jsonl"
+        )
+        discovery_index = load_discovery_index(index_path)
+
+    with pipeline_metrics.timed("discovery"):
+        sample_files = find_raw_h5_files(
+            input_dir,
+            workers=args.discovery_workers,
+            stats=discovery_stats,
+            index=discovery_index,
+        )
+    pipeline_metrics.count("samples_discovered", len(sample_files))
+    print(
+        f"Discovery scanned {discovery_stats['directories_scanned']} directories"
+        f" across {discovery_stats['run_directories']} run directories,"
+        f" saving {discovery_stats['stat_calls_saved']} stat calls"
+        f" ({discovery_stats['fallback_walks']} fallback walks)"
+    )
+    if discovery_index is not None:
+        print(
+            f"Discovery index: {discovery_stats['index_hits']} runs unchanged,"
+            f" {discovery_stats['index_misses']} rescanned"
+        )
+        if discovery_stats["index_misses"]:
+            save_discovery_index(index_path, discovery_index)
+
+    if not sample_files:
+        print(f"No raw feature matrix h5 files found in {input_dir}")
+        return submit_scripts
+
+    if args.h5_metadata or args.auto_resources or args.plan_from_history:
+        with pipeline_metrics.timed("h5_metadata"):
+            attach_h5_metadata(
+                sample_files,
+                cache_path=h5_cache_path(args),
+                workers=args.discovery_workers,
+                stats=discovery_stats,
+            )
+        print(
+            f"h5 metadata: {discovery_stats['header_cache_hits']} cached,"
+            f" {discovery_stats['header_reads']} read"
+        )
+    if args.auto_resources:
+        size_samples(sample_files, load_sizing_model(args.sizing_model))
+
+    if args.record_timing or args.plan_from_history:
+        history_path = args.runtime_history or os.path.join(
+            os.path.abspath(args.output_dir), ".cellbender_runtime_history.jsonl"
+        )
+        with pipeline_metrics.timed("runtime_history"):
+            history, new_runs = update_runtime_history(args, history_path)
+        total_hours, by_gpu = summarize_gpu_hours(history.values())
+        print(
+            f"Runtime history: {len(history)} runs ({new_runs} new),"
+            f" {total_hours:.1f} GPU-hours"
+            + "".join(
+                f"; {name}: {runs} runs, {hours:.1f} GPU-hours"
+                for name, (runs, hours) in by_gpu.items()
+            )
+        )
+        if args.plan_from_history:
+            planned = plan_from_history(
+                sample_files,
+                list(history.values()),
+                args.gpu_model,
+                args.history_min_runs,
+                args.history_margin,
+            )
+            print(
+                f"Planned walltime and memory for {planned} of"
+                f" {len(sample_files)} samples from runtime history"
+            )
+
+    # Determine if this is a multi run
+    is_multi_run = any(sample["type"] == "multi" for sample in sample_files)
+
+    # Validate multi-lib-id requirement for multi runs
+    if is_multi_run and not args.multi_lib_id:
+        print("Error: --multi-lib-id is required for CellRanger multi outputs")
+        return submit_scripts
+
+    # Set up parameters dictionary
+    params = {
+        "project": args.project,
+        "walltime": args.walltime,
+        "queue": args.queue,
+        "cores": args.cores,
+        "memory": args.memory,
+        "email": args.email,
+        "conda_env": args.conda_env,
+        "gpu_model": args.gpu_model,
+        "gpu_num": args.gpu_num,
+        "cuda_version": args.cuda_version,
+        "scheduler": args.scheduler,
+        "template": args.template,
+        "post_qc": args.post_qc,
+        "stage_to_local": args.stage_to_local,
+        "scratch_dir": args.scratch_dir,
+        "export_mtx": args.export_mtx,
+        "record_timing": args.record_timing,
+        "job_label": job_label,
+    }
+
+    # Base output directory
+    base_output_dir = os.path.abspath(args.output_dir)
+    date_stamp = datetime.now().strftime("%Y-%m-%d")
+
+    if args.skip_done:
+        with pipeline_metrics.timed("fingerprints"):
+            attach_fingerprints(
+                sample_files, params, args.fingerprint_hash, args.discovery_workers
+            )
+        with pipeline_metrics.timed("skip_done_check"):
+            sample_files, completed = filter_completed_samples(
+                sample_files, base_output_dir, params, stats=discovery_stats
+            )
+        for sample_info, output_file in completed:
+            print(f"Skipping {sample_info['sample_name']}: up to date in {output_file}")
+        print(
+            f"Skip-if-done: {len(completed)} samples up to date,"
+            f" {len(sample_files)} to generate"
+        )
+        if not sample_files:
+            return submit_scripts
+
+    # Job generation covers directory creation, rendering and all writes
+    pipeline_metrics.count("samples_generated", len(sample_files))
+    with pipeline_metrics.timed("job_generation"):
+        # Handle multi and non-multi runs differently
+        if is_multi_run and args.multi_lib_id:
+            # For multi runs, create a single parent directory
+            parent_dir = os.path.join(base_output_dir, f"{args.multi_lib_id}_{date_stamp}")
+            os.makedirs(parent_dir, exist_ok=True)
+            params["qc_table"] = os.path.join(parent_dir, QC_TABLE_NAME)
+
+            # Setup logging for multi run
+            logging.basicConfig(
+                level=logging.INFO,
+                format="%(asctime)s - %(levelname)s - %(message)s",
+                handlers=[
+                    logging.FileHandler(os.path.join(parent_dir, "prep-cellbender.log")),
+                    logging.StreamHandler(),
+                ],
+            )
+
+            if args.pack > 0 or args.array:
+                sample_dirs = []
+                for sample_info in sample_files:
+                    sample_dir = os.path.join(parent_dir, sample_info["sample_name"])
+                    os.makedirs(sample_dir, exist_ok=True)
+                    sample_dirs.append((sample_info, sample_dir))
+
+                job_dir = os.path.join(parent_dir, "array" if args.array else "batches")
+                write_fingerprints(sample_dirs)
+                submit_scripts.append(
+                    write_grouped_jobs(args, sample_dirs, job_dir, params, args.multi_lib_id)
+                )
+                return submit_scripts
+
+            # Generate job scripts for all samples in the multi run
+            sample_dirs = []
+            for sample_info in sample_files:
+                # Create sample-specific subdirectory
+                sample_name = sample_info["sample_name"]
+                sample_dir = os.path.join(parent_dir, sample_name)
+                os.makedirs(sample_dir, exist_ok=True)
+                sample_dirs.append((sample_info, sample_dir))
+
+            # Render every sample's script in one pass
+            write_fingerprints(sample_dirs)
+            lsf_scripts = generate_sample_scripts(sample_dirs, params)
+
+            # Create a single submission script for all samples
+            submit_script_path = write_submission_script(
+                submission_script_path(parent_dir, params),
+                f"Submit CellBender jobs for CellRanger multi run: {args.multi_lib_id}",
+                lsf_scripts,
+                params,
+                delay=2,
+            )
+            submit_scripts.append(submit_script_path)
+
+            logging.info(f"\nGenerated {len(lsf_scripts)} LSF scripts for multi run")
+            logging.info(f"Submission script created at: {submit_script_path}")
+
+        elif args.pack > 0 or args.array:
+            # Packed and array non-multi runs keep per-sample output directories
+            # but share job scripts in one directory
+            job_kind = "array" if args.array else "batches"
+            params["qc_table"] = os.path.join(base_output_dir, QC_TABLE_NAME)
+            job_dir = os.path.join(base_output_dir, f"cellbender_{job_kind}_{date_stamp}")
+            os.makedirs(job_dir, exist_ok=True)
+            logging.basicConfig(
+                level=logging.INFO,
+                format="%(asctime)s - %(levelname)s - %(message)s",
+                handlers=[
+                    logging.FileHandler(os.path.join(job_dir, "prep-cellbender.log")),
+                    logging.StreamHandler(),
+                ],
+            )
 
-    with open(lsf_script_path, "w") as f:
-        f.write(script_content)
+            sample_dirs = []
+            for sample_info in sample_files:
+                sample_name = sample_info["sample_name"]
+                sample_output_dir = os.path.join(base_output_dir, f"{sample_name}_{date_stamp}")
+                os.makedirs(sample_output_dir, exist_ok=True)
+                sample_dirs.append((sample_info, sample_output_dir))
+
+            write_fingerprints(sample_dirs)
+            submit_scripts.append(
+                write_grouped_jobs(args, sample_dirs, job_dir, params, "samples")
+            )
+
+        else:
+            # For non-multi runs, create a separate directory for each sample
+            params["qc_table"] = os.path.join(base_output_dir, QC_TABLE_NAME)
+            for sample_info in sample_files:
+                sample_name = sample_info["sample_name"]
+                sample_output_dir = os.path.join(base_output_dir, f"{sample_name}_{date_stamp}")
+                os.makedirs(sample_output_dir, exist_ok=True)
+
+                # Setup logging for this sample
+                sample_log_handler = logging.FileHandler(os.path.join(sample_output_dir, "prep-cellbender.log"))
+                logging.basicConfig(
+                    level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s",
+                    handlers=[sample_log_handler, logging.StreamHandler()],
+                    force=True  # Reset handlers for each sample
+                )
+
+                # Generate LSF script for this sample
+                write_fingerprints([(sample_info, sample_output_dir)])
+                lsf_script = generate_lsf_script_single(sample_info, sample_output_dir, params)
+
+                # Create a submission script for this sample
+                submit_script_path = write_submission_script(
+                    submission_script_path(sample_output_dir, params),
+                    f"Submit CellBender job for sample: {sample_name}",
+                    [lsf_script],
+                    params,
+                )
+                submit_scripts.append(submit_script_path)
+
+                logging.info(f"Generated LSF script for sample {sample_name}")
+                logging.info(f"Submission script created at: {submit_script_path}")
+
+                # Close the log handler for this sample
+                sample_log_handler.close()
+                logging.getLogger().removeHandler(sample_log_handler)
+
+            print(f"\nGenerated LSF scripts for individual samples")
+            print("Each sample has its own directory with submission script")
+
+    return submit_scripts
+
+
+def find_watched_runs(input_dir, workers=8):
+    """Return the run directories under input_dir and the directories to watch.
+
+    The watched directories are input_dir and its subdirectories (where
+    new runs appear) plus each run directory and its outs/ (where
+    pipestance files and outputs change).
+    """
+    stats = Counter()
+    entries = scan_directory(input_dir, stats)
+    if "outs" in entries:
+        run_dirs = [input_dir]
+        parent_dirs = [input_dir]
+    else:
+        run_dirs = find_run_directories(input_dir, entries, workers, stats)
+        parent_dirs = [input_dir] + [
+            os.path.join(input_dir, name)
+            for name in entries
+            if entry_is_dir(entries, name)
+        ]
+    watched = parent_dirs + [
+        path
+        for run_dir in run_dirs
+        for path in (run_dir, os.path.join(run_dir, "outs"))
+    ]
+    return run_dirs, watched
+
+
+def submit_generated_jobs(submit_script):
+    """Run a generated submission script, logging the scheduler's reply."""
+    result = subprocess.run(
+        ["bash", submit_script], capture_output=True, text=True
+    )
+    for line in result.stdout.splitlines():
+        logging.info(line)
+    if result.returncode != 0:
+        logging.error(
+            f"Submission script {submit_script} failed with exit code"
+            f" {result.returncode}: {result.stderr.strip()}"
+        )
+        return False
+    pipeline_metrics.count("submission_scripts_run")
+    return True
 
-    return lsf_script_path
+
+def watch_runs(args, discovery_stats):
+    """Generate (and optionally submit) jobs for each run as it finishes.
+
+    Runs are handled once per run signature, recorded in a state file so a
+    restarted watcher does not regenerate them. Runs until interrupted or
+    terminated (e.g. when a scheduler job running the watcher ends).
+    """
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    input_dir = os.path.abspath(args.input_dir)
+    state_path = args.watch_state or os.path.join(
+        os.path.abspath(args.output_dir), ".cellbender_watch_state.json"
+    )
+    state = load_watch_state(state_path)
+    notifier = open_inotify()
+    print(
+        f"Watching {input_dir} for finished CellRanger runs"
+        f" ({'inotify, ' if notifier else ''}polling every {args.watch_interval:g}s);"
+        " press Ctrl-C to stop"
+    )
+
+    failed_runs = set()
+    try:
+        while True:
+            with pipeline_metrics.timed("watch_scan"):
+                run_dirs, watched = find_watched_runs(input_dir, args.discovery_workers)
+                add_watches(notifier, watched)
+                finished_runs = []
+                for run_dir in run_dirs:
+                    signature = run_signature(run_dir)
+                    if signature is None or state.get(run_dir) == signature:
+                        continue
+                    results = find_raw_h5_files_in_run(run_dir)
+                    status = run_state(
+                        run_dir, [result["file_path"] for result in results], args.settle_time
+                    )
+                    if status == FAILED and run_dir not in failed_runs:
+                        print(f"\nCellRanger run failed, not generating jobs: {run_dir}")
+                        failed_runs.add(run_dir)
+                    elif status == FINISHED and results:
+                        finished_runs.append(run_dir)
+            pipeline_metrics.count("watch_scans")
+
+            for run_dir in finished_runs:
+                print(f"\nCellRanger run finished: {run_dir}")
+                run_stats = Counter()
+                submit_scripts = prepare_jobs(
+                    args, run_stats, input_dir=run_dir, job_label=os.path.basename(run_dir)
+                )
+                discovery_stats.update(run_stats)
+                pipeline_metrics.count("runs_handled")
+                state[run_dir] = run_signature(run_dir)
+                save_watch_state(state_path, state)
+                if args.watch_submit:
+                    for submit_script in submit_scripts:
+                        submit_generated_jobs(submit_script)
+
+            wait_for_changes(notifier, args.watch_interval)
+    except KeyboardInterrupt:
+        print("\nStopped watching")
+    finally:
+        close_inotify(notifier)
 
 
 def main():
@@ -401,121 +1935,271 @@ def main():
         help="Conda environment name (default: cellbender)",
     )
 
-    args = parser.parse_args()
-
-    # Process directories and find files
-    input_dir = os.path.abspath(args.input_dir)
-    sample_files = find_raw_h5_files(input_dir)
-
-    if not sample_files:
-        print(f"No raw feature matrix h5 files found in {input_dir}")
-        return
-
-    # Determine if this is a multi run
-    is_multi_run = any(sample["type"] == "multi" for sample in sample_files)
-
-    # Validate multi-lib-id requirement for multi runs
-    if is_multi_run and not args.multi_lib_id:
-        print("Error: --multi-lib-id is required for CellRanger multi outputs")
-        return
+    # Scheduler parameters
+    scheduler_group = parser.add_argument_group("Scheduler parameters")
+    scheduler_group.add_argument(
+        "--scheduler",
+        choices=sorted(SCHEDULERS),
+        default="lsf",
+        help="Job scheduler to generate scripts for; 'local' scripts run on "
+        "this machine, one after another with bash or concurrently with GPU "
+        "slots through submit-cellbender.py --scheduler local (default: lsf)",
+    )
+    scheduler_group.add_argument(
+        "--template",
+        default=None,
+        help="Job script template with __NAME__ placeholders (default: the "
+        "bundled cellbender/templates/cellbender.<scheduler>). A plain LSF "
+        "script such as gpu_template.lsf is also accepted; its #BSUB "
+        "directives are kept and the CellBender commands appended",
+    )
 
-    # Set up parameters dictionary
-    params = {
-        "project": args.project,
-        "walltime": args.walltime,
-        "queue": args.queue,
-        "cores": args.cores,
-        "memory": args.memory,
-        "email": args.email,
-        "conda_env": args.conda_env,
-        "gpu_model": args.gpu_model,
-        "gpu_num": args.gpu_num,
-        "cuda_version": args.cuda_version,
-    }
+    # Resource sizing parameters
+    sizing_group = parser.add_argument_group("Resource sizing parameters")
+    sizing_group.add_argument(
+        "--h5-metadata",
+        action="store_true",
+        help="Read barcode/feature/nnz counts, chemistry and feature types "
+        "from each h5 header and record them in the generated scripts "
+        "(implied by --auto-resources; requires h5py)",
+    )
+    sizing_group.add_argument(
+        "--h5-cache",
+        default=None,
+        help="h5 header cache file "
+        "(default: OUTPUT_DIR/.cellbender_h5_cache.json)",
+    )
+    sizing_group.add_argument(
+        "--auto-resources",
+        action="store_true",
+        help="Size memory, walltime, GPU model and CellBender droplet "
+        "arguments per sample from raw h5 metadata (requires h5py)",
+    )
+    sizing_group.add_argument(
+        "--sizing-model",
+        default=None,
+        help="JSON file overriding the built-in sizing model",
+    )
 
-    # Base output directory
-    base_output_dir = os.path.abspath(args.output_dir)
-    date_stamp = datetime.now().strftime("%Y-%m-%d")
+    # Batching parameters
+    batch_group = parser.add_argument_group("Batching parameters")
+    batch_group.add_argument(
+        "--pack",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Pack up to N samples into each LSF job; samples run back to "
+        "back, or concurrently across GPUs when --gpu-num > 1. Walltime is "
+        "scaled by the number of samples per GPU (default: one job per sample)",
+    )
+    batch_group.add_argument(
+        "--array",
+        action="store_true",
+        help="Submit all samples as one LSF job array driven by a manifest",
+    )
+    batch_group.add_argument(
+        "--array-limit",
+        type=int,
+        default=0,
+        metavar="K",
+        help="Maximum number of array elements running at once "
+        "(default: no limit)",
+    )
 
-    # Handle multi and non-multi runs differently
-    if is_multi_run and args.multi_lib_id:
-        # For multi runs, create a single parent directory
-        parent_dir = os.path.join(base_output_dir, f"{args.multi_lib_id}_{date_stamp}")
-        os.makedirs(parent_dir, exist_ok=True)
-
-        # Setup logging for multi run
-        logging.basicConfig(
-            level=logging.INFO,
-            format="%(asctime)s - %(levelname)s - %(message)s",
-            handlers=[
-                logging.FileHandler(os.path.join(parent_dir, "prep-cellbender.log")),
-                logging.StreamHandler(),
-            ],
-        )
+    # Discovery parameters
+    discovery_group = parser.add_argument_group("Discovery parameters")
+    discovery_group.add_argument(
+        "--discovery-workers",
+        type=int,
+        default=8,
+        help="Threads used to scan run directories in parallel (default: 8)",
+    )
+    discovery_group.add_argument(
+        "--discovery-index",
+        default=None,
+        help="JSON-lines index of previously discovered runs "
+        "(default: OUTPUT_DIR/.cellbender_discovery_index.jsonl)",
+    )
+    discovery_group.add_argument(
+        "--no-discovery-index",
+        action="store_true",
+        help="Rescan every run directory and do not read or update the index",
+    )
 
-        # Generate LSF scripts for all samples in the multi run
-        lsf_scripts = []
-        for sample_info in sample_files:
-            # Create sample-specific subdirectory
-            sample_name = sample_info["sample_name"]
-            sample_dir = os.path.join(parent_dir, sample_name)
-            os.makedirs(sample_dir, exist_ok=True)
+    # Completeness parameters
+    done_group = parser.add_argument_group("Completeness parameters")
+    done_group.add_argument(
+        "--skip-done",
+        action="store_true",
+        help="Skip samples whose input and CellBender parameters match the "
+        "fingerprint recorded next to a complete output under OUTPUT_DIR; "
+        "fingerprints are only computed and recorded with this option",
+    )
+    done_group.add_argument(
+        "--fingerprint-hash",
+        action="store_true",
+        help="Include a hash of the first and last MiB of each raw h5 in "
+        "fingerprints, in addition to its path, size and mtime",
+    )
 
-            # Generate LSF script
-            lsf_script = generate_lsf_script_multi(sample_info, parent_dir, params, args.multi_lib_id)
-            lsf_scripts.append(lsf_script)
+    # Post-processing parameters
+    post_group = parser.add_argument_group("Post-processing parameters")
+    post_group.add_argument(
+        "--post-qc",
+        action="store_true",
+        help="Run a QC post-stage in each job after CellBender succeeds: "
+        "per-sample QC summary, per-barcode counts and a row in "
+        "cellbender_qc_summary.csv (requires h5py and numpy in the job env)",
+    )
+    post_group.add_argument(
+        "--export-mtx",
+        action="store_true",
+        help="With --post-qc, also export each sample's cells as a "
+        "10x-style Matrix Market directory",
+    )
 
-        # Create a single submission script for all samples
-        submit_script_path = os.path.join(parent_dir, "submit_cellbender_jobs.sh")
-        with open(submit_script_path, "w") as f:
-            f.write("#!/bin/bash\n\n")
-            f.write(f"# Submit CellBender jobs for CellRanger multi run: {args.multi_lib_id}\n\n")
-            for script in lsf_scripts:
-                f.write(f"bsub < {script}\n")
-                f.write("sleep 2\n")
+    # Staging parameters
+    staging_group = parser.add_argument_group("Staging parameters")
+    staging_group.add_argument(
+        "--stage-to-local",
+        action="store_true",
+        help="Copy each raw h5 to node-local scratch, run CellBender there "
+        "and copy the outputs back with checksum verification",
+    )
+    staging_group.add_argument(
+        "--scratch-dir",
+        default=None,
+        help="Node-local scratch directory for --stage-to-local, evaluated "
+        "in the job (default: ${TMPDIR:-/tmp})",
+    )
 
-        os.chmod(submit_script_path, 0o755)
+    # Runtime history parameters
+    history_group = parser.add_argument_group("Runtime history parameters")
+    history_group.add_argument(
+        "--record-timing",
+        action="store_true",
+        help="Have each job write a timing record per sample (wall time, "
+        f"peak memory via /usr/bin/time, GPU, input size) as *{TIMING_SUFFIX}; "
+        "records are collected into the runtime history on the next run",
+    )
+    history_group.add_argument(
+        "--runtime-history",
+        default=None,
+        help="JSON-lines runtime history store "
+        "(default: OUTPUT_DIR/.cellbender_runtime_history.jsonl)",
+    )
+    history_group.add_argument(
+        "--plan-from-history",
+        action="store_true",
+        help="Set each sample's walltime and memory from a linear fit of "
+        "past runtimes and peak memory against nnz (or input size); "
+        "overrides --auto-resources tiers (requires h5py for nnz)",
+    )
+    history_group.add_argument(
+        "--history-min-runs",
+        type=int,
+        default=MIN_HISTORY_RUNS,
+        help="Successful runs needed before the history is used for planning "
+        f"(default: {MIN_HISTORY_RUNS})",
+    )
+    history_group.add_argument(
+        "--history-margin",
+        type=float,
+        default=HISTORY_MARGIN,
+        help="Factor applied on top of the fitted value plus two residual "
+        f"standard deviations (default: {HISTORY_MARGIN})",
+    )
 
-        logging.info(f"\nGenerated {len(lsf_scripts)} LSF scripts for multi run")
-        logging.info(f"Submission script created at: {submit_script_path}")
+    # Watch parameters
+    watch_group = parser.add_argument_group("Watch parameters")
+    watch_group.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and generate jobs for each CellRanger run under "
+        "INPUT_DIR as soon as it finishes (inotify where available, plus "
+        "polling)",
+    )
+    watch_group.add_argument(
+        "--watch-interval",
+        type=float,
+        default=60,
+        help="Seconds between polls of the run directories; also catches "
+        "changes inotify cannot see on shared filesystems (default: 60)",
+    )
+    watch_group.add_argument(
+        "--settle-time",
+        type=float,
+        default=300,
+        help="For runs without CellRanger pipestance files, seconds the raw "
+        "h5 files must be unchanged before the run counts as finished "
+        "(default: 300)",
+    )
+    watch_group.add_argument(
+        "--watch-submit",
+        action="store_true",
+        help="Run each generated submission script as soon as it is written",
+    )
+    watch_group.add_argument(
+        "--watch-state",
+        default=None,
+        help="File recording the runs already handled "
+        "(default: OUTPUT_DIR/.cellbender_watch_state.json)",
+    )
 
-    else:
-        # For non-multi runs, create a separate directory for each sample
-        for sample_info in sample_files:
-            sample_name = sample_info["sample_name"]
-            sample_output_dir = os.path.join(base_output_dir, f"{sample_name}_{date_stamp}")
-            os.makedirs(sample_output_dir, exist_ok=True)
+    # Instrumentation parameters
+    metrics_group = parser.add_argument_group("Instrumentation parameters")
+    metrics_group.add_argument(
+        "--metrics-file",
+        default=None,
+        help="Write per-stage timings and counters to this file",
+    )
+    metrics_group.add_argument(
+        "--metrics-format",
+        choices=["json", "prometheus"],
+        default=None,
+        help="Format of --metrics-file (default: prometheus for .prom files, "
+        "otherwise json)",
+    )
+    metrics_group.add_argument(
+        "--profile",
+        default=None,
+        metavar="PATH",
+        help="Run under cProfile, dump the stats to PATH and print the "
+        "slowest functions",
+    )
 
-            # Setup logging for this sample
-            sample_log_handler = logging.FileHandler(os.path.join(sample_output_dir, "prep-cellbender.log"))
-            logging.basicConfig(
-                level=logging.INFO,
-                format="%(asctime)s - %(levelname)s - %(message)s",
-                handlers=[sample_log_handler, logging.StreamHandler()],
-                force=True  # Reset handlers for each sample
+    args = parser.parse_args()
+    if args.array and args.pack > 0:
+        parser.error("--array and --pack cannot be combined")
+    if args.watch_submit and not args.watch:
+        parser.error("--watch-submit requires --watch")
+
+    discovery_stats = Counter()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        with pipeline_metrics.timed("total"):
+            if args.watch:
+                watch_runs(args, discovery_stats)
+            else:
+                prepare_jobs(args, discovery_stats)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print(f"\nProfile written to {args.profile}")
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+        if args.metrics_file:
+            report_format = args.metrics_format or (
+                "prometheus" if args.metrics_file.endswith(".prom") else "json"
             )
-
-            # Generate LSF script for this sample
-            lsf_script = generate_lsf_script_single(sample_info, sample_output_dir, params)
-
-            # Create a submission script for this sample
-            submit_script_path = os.path.join(sample_output_dir, "submit_cellbender_jobs.sh")
-            with open(submit_script_path, "w") as f:
-                f.write("#!/bin/bash\n\n")
-                f.write(f"# Submit CellBender job for sample: {sample_name}\n\n")
-                f.write(f"bsub < {lsf_script}\n")
-
-            os.chmod(submit_script_path, 0o755)
-
-            logging.info(f"Generated LSF script for sample {sample_name}")
-            logging.info(f"Submission script created at: {submit_script_path}")
-
-            # Close the log handler for this sample
-            sample_log_handler.close()
-            logging.getLogger().removeHandler(sample_log_handler)
-
-        print(f"\nGenerated LSF scripts for individual samples")
-        print("Each sample has its own directory with submission script")
+            report = pipeline_metrics.build_report(discovery_stats)
+            write_text_atomic(
+                args.metrics_file,
+                pipeline_metrics.format_report(report, report_format),
+            )
+            print(f"Metrics written to {args.metrics_file}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,163 @@
+"""Change notification and completion checks for watching CellRanger runs.
+
+Wake-ups come from inotify where the platform provides it (Linux, via
+libc), so a finished run is picked up within seconds. inotify only sees
+changes made through the local kernel, which misses writes from other
+nodes on shared filesystems, so the watch loop also re-checks run
+signatures on a fixed interval; without inotify that polling is all
+there is.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import logging
+import os
+import select
+import time
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_ONLYDIR = 0x01000000
+WATCH_MASK = (
+    IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+    | IN_DELETE | IN_ONLYDIR
+)
+EVENT_BUFFER_BYTES = 64 * 1024
+
+# Martian pipestance files in a CellRanger run directory: _lock exists
+# while the pipeline runs, _finalstate is written when it completes and
+# _errors when it fails
+PIPESTANCE_LOCK = "_lock"
+PIPESTANCE_FINAL = "_finalstate"
+PIPESTANCE_ERRORS = "_errors"
+
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+
+
+def open_inotify():
+    """Return a dict wrapping a non-blocking inotify instance, or None.
+
+    None means inotify is unavailable (non-Linux, or no libc support) and
+    callers should rely on polling alone.
+    """
+    library = ctypes.util.find_library("c")
+    if library is None:
+        return None
+    try:
+        libc = ctypes.CDLL(library, use_errno=True)
+        init = libc.inotify_init1
+        add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        return None
+    return {"fd": fd, "add_watch": add_watch, "watched": set(), "full": False}
+
+
+def add_watches(notifier, directories):
+    """Watch each directory not yet watched; missing directories are skipped.
+
+    When the kernel's watch limit is reached a warning is logged once and
+    the remaining directories are left to polling.
+    """
+    if notifier is None:
+        return
+    for directory in directories:
+        if directory in notifier["watched"] or notifier["full"]:
+            continue
+        wd = notifier["add_watch"](notifier["fd"], os.fsencode(directory), WATCH_MASK)
+        if wd >= 0:
+            notifier["watched"].add(directory)
+            continue
+        error = ctypes.get_errno()
+        if error == errno.ENOSPC:
+            notifier["full"] = True
+            logging.warning(
+                "inotify watch limit reached (fs.inotify.max_user_watches);"
+                " remaining directories are polled only"
+            )
+        elif error not in (errno.ENOENT, errno.ENOTDIR):
+            logging.debug(f"Cannot watch {directory}: {os.strerror(error)}")
+
+
+def wait_for_changes(notifier, timeout):
+    """Block until a watched directory changes or timeout seconds pass.
+
+    Returns True if woken by inotify. Events are drained, not decoded:
+    the caller rescans the runs it cares about either way. Watches on
+    deleted directories are dropped by the kernel, so the watched set is
+    cleared whenever a deletion could have happened and rebuilt on the
+    next add_watches call.
+    """
+    if notifier is None:
+        time.sleep(timeout)
+        return False
+    ready, _, _ = select.select([notifier["fd"]], [], [], timeout)
+    if not ready:
+        return False
+    while True:
+        try:
+            if not os.read(notifier["fd"], EVENT_BUFFER_BYTES):
+                break
+        except BlockingIOError:
+            break
+    notifier["watched"].clear()
+    return True
+
+
+def close_inotify(notifier):
+    """Close an inotify instance returned by open_inotify."""
+    if notifier is not None:
+        os.close(notifier["fd"])
+
+
+def run_state(run_dir, h5_paths, settle_seconds):
+    """Return RUNNING, FINISHED or FAILED for a CellRanger run directory.
+
+    Runs with Martian pipestance files are judged by them. Runs without
+    them (e.g. outs copied from elsewhere) count as finished once every
+    raw h5 has been left untouched for settle_seconds.
+    """
+    if os.path.exists(os.path.join(run_dir, PIPESTANCE_ERRORS)):
+        return FAILED
+    if os.path.exists(os.path.join(run_dir, PIPESTANCE_LOCK)):
+        return RUNNING
+    if os.path.exists(os.path.join(run_dir, PIPESTANCE_FINAL)):
+        return FINISHED
+    try:
+        newest = max(os.stat(path).st_mtime for path in h5_paths)
+    except (FileNotFoundError, ValueError):
+        return RUNNING
+    return FINISHED if time.time() - newest >= settle_seconds else RUNNING
+
+
+def load_watch_state(state_path):
+    """Load the run directory -> signature map of runs already handled."""
+    if not os.path.exists(state_path):
+        return {}
+    try:
+        with open(state_path, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        logging.warning(f"Ignoring unreadable watch state {state_path}")
+        return {}
+
+
+def save_watch_state(state_path, state):
+    """Write the watch state atomically."""
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    tmp_path = f"{state_path}.tmp.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+        f.write("\n")
+    os.replace(tmp_path, state_path)
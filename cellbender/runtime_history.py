@@ -0,0 +1,176 @@
+"""Runtime history of CellBender jobs and walltime/memory planning from it.
+
+Jobs generated with --record-timing write one small JSON record per
+sample ({sample}_cellbender_timing.json) with wall time, peak memory
+from /usr/bin/time, GPU and input size. prep-cellbender collects those
+records into a JSON-lines history store, which keeps them after output
+directories are cleaned up, and can fit a simple linear model of wall
+time and peak memory against input size to request resources for new
+samples.
+"""
+
+import json
+import logging
+import math
+import os
+from collections import defaultdict
+
+TIMING_SUFFIX = "_cellbender_timing.json"
+
+# Fits need at least this many successful runs
+MIN_HISTORY_RUNS = 5
+# Requests cover the fitted value plus this many residual standard
+# deviations, times the margin
+RESIDUAL_SDS = 2
+HISTORY_MARGIN = 1.1
+MIN_WALLTIME_MINUTES = 10
+WALLTIME_STEP_MINUTES = 5
+MIN_MEMORY_GB = 4
+
+
+def record_key(record):
+    """Return the key identifying one run in the history store."""
+    return f"{record.get('input_file')}@{record.get('start')}"
+
+
+def load_runtime_history(history_path):
+    """Load the JSON-lines history store into a dict keyed by record_key."""
+    history = {}
+    if not history_path or not os.path.exists(history_path):
+        return history
+    with open(history_path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning(f"Skipping malformed history line in {history_path}")
+                continue
+            history[record_key(record)] = record
+    return history
+
+
+def save_runtime_history(history_path, history):
+    """Write the history store atomically, oldest run first."""
+    os.makedirs(os.path.dirname(os.path.abspath(history_path)), exist_ok=True)
+    tmp_path = f"{history_path}.tmp.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        for record in sorted(history.values(), key=lambda r: r.get("start") or 0):
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+    os.replace(tmp_path, history_path)
+
+
+def collect_timing_records(output_dir, history):
+    """Add timing records found under output_dir to history.
+
+    Sample directories sit one or two levels down, as for fingerprints.
+    Returns the records that were not in history yet.
+    """
+    new_records = []
+    pending = [(output_dir, 0)]
+    while pending:
+        dir_path, depth = pending.pop()
+        try:
+            entries = list(os.scandir(dir_path))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.endswith(TIMING_SUFFIX):
+                try:
+                    with open(entry.path, "r") as f:
+                        record = json.load(f)
+                except (json.JSONDecodeError, OSError) as e:
+                    logging.warning(f"Ignoring unreadable timing record {entry.path}: {e}")
+                    continue
+                key = record_key(record)
+                if key not in history:
+                    history[key] = record
+                    new_records.append(record)
+            elif depth < 2 and entry.is_dir(follow_symlinks=False):
+                pending.append((entry.path, depth + 1))
+    return new_records
+
+
+def gpu_hours(record):
+    """Return the GPU-hours a run used (wall time times GPUs visible to it)."""
+    return (record.get("wall_seconds") or 0) * (record.get("gpus") or 1) / 3600
+
+
+def summarize_gpu_hours(records):
+    """Return total GPU-hours and a gpu name -> (runs, GPU-hours) dict."""
+    by_gpu = defaultdict(lambda: [0, 0.0])
+    for record in records:
+        totals = by_gpu[record.get("gpu_name") or record.get("gpu_model") or "unknown"]
+        totals[0] += 1
+        totals[1] += gpu_hours(record)
+    return sum(hours for _, hours in by_gpu.values()), {
+        name: tuple(totals) for name, totals in sorted(by_gpu.items())
+    }
+
+
+def fit_line(points):
+    """Least-squares fit of y = intercept + slope * x.
+
+    Returns (intercept, slope, residual standard deviation).
+    """
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    sxx = sum((x - mean_x) ** 2 for x, _ in points)
+    slope = (
+        sum((x - mean_x) * (y - mean_y) for x, y in points) / sxx if sxx else 0.0
+    )
+    intercept = mean_y - slope * mean_x
+    residuals = [y - intercept - slope * x for x, y in points]
+    dof = max(n - 2, 1)
+    return intercept, slope, math.sqrt(sum(r * r for r in residuals) / dof)
+
+
+def fit_runtime_model(records, feature, min_runs=MIN_HISTORY_RUNS):
+    """Fit wall minutes and peak memory (MB) against a record feature.
+
+    Only successful runs with the feature are used. Returns None when
+    fewer than min_runs remain; the memory fit is None when too few runs
+    recorded peak memory.
+    """
+    usable = [
+        record
+        for record in records
+        if record.get("exit_code") == 0
+        and record.get(feature) is not None
+        and record.get("wall_seconds") is not None
+    ]
+    if len(usable) < min_runs:
+        return None
+    with_memory = [record for record in usable if record.get("peak_rss_kb")]
+    return {
+        "feature": feature,
+        "runs": len(usable),
+        "walltime": fit_line(
+            [(record[feature], record["wall_seconds"] / 60) for record in usable]
+        ),
+        "memory": fit_line(
+            [(record[feature], record["peak_rss_kb"] / 1024) for record in with_memory]
+        )
+        if len(with_memory) >= min_runs
+        else None,
+    }
+
+
+def predict_upper(fit, value, margin):
+    """Return the fitted value plus RESIDUAL_SDS deviations, times margin."""
+    intercept, slope, sd = fit
+    return max(intercept + slope * value + RESIDUAL_SDS * sd, 0) * margin
+
+
+def predict_resources(model, value, margin=HISTORY_MARGIN):
+    """Predict walltime (H:MM) and memory (e.g. 24G) requests for a sample."""
+    minutes = predict_upper(model["walltime"], value, margin)
+    minutes = max(
+        MIN_WALLTIME_MINUTES,
+        math.ceil(minutes / WALLTIME_STEP_MINUTES) * WALLTIME_STEP_MINUTES,
+    )
+    resources = {"walltime": f"{minutes // 60}:{minutes % 60:02d}"}
+    if model["memory"] is not None:
+        memory_gb = math.ceil(predict_upper(model["memory"], value, margin) / 1024)
+        resources["memory"] = f"{max(MIN_MEMORY_GB, memory_gb)}G"
+    return resources
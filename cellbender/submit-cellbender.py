@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from collections import Counter
+from datetime import datetime
+
+from job_backends import (
+    DEFAULT_RETRY_CONFIG,
+    DONE,
+    FAILED,
+    PENDING,
+    RUNNING,
+    detect_gpus,
+    is_retryable,
+    load_retry_config,
+    make_backend,
+)
+from job_templates import SCHEDULERS, write_text_atomic
+
+QUEUED = "QUEUED"
+ACTIVE_STATES = (PENDING, RUNNING)
+FINAL_STATES = (DONE, FAILED)
+STATUS_COLUMNS = ["script", "job_id", "state", "attempts", "updated", "note"]
+
+
+def read_submission_script(path):
+    """Return the job scripts submitted by a generated submit_cellbender_jobs.sh."""
+    scripts = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#") or line.startswith("sleep"):
+                continue
+            scripts.append(line.split()[-1])
+    return scripts
+
+
+def collect_job_scripts(paths):
+    """Expand submission scripts into job scripts, keeping order and dropping repeats."""
+    scripts = []
+    for path in paths:
+        if path.endswith(".sh"):
+            scripts.extend(read_submission_script(path))
+        else:
+            scripts.append(path)
+    return list(dict.fromkeys(os.path.abspath(script) for script in scripts))
+
+
+def create_job(script):
+    """Create the monitor's record for one job script."""
+    return {
+        "script": script,
+        "job_id": "",
+        "state": QUEUED,
+        "attempts": 0,
+        "updated": "",
+        "note": "",
+    }
+
+
+def set_state(job, state, note=None):
+    """Update a job's state and timestamp."""
+    job["state"] = state
+    job["updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if note is not None:
+        job["note"] = note
+
+
+def first_matching_line(error_text, retry_config):
+    """Return the first error line matching a retry pattern, or the last line."""
+    lines = [line for line in error_text.splitlines() if line.strip()]
+    for line in lines:
+        if is_retryable(line, retry_config):
+            return line.strip()
+    return lines[-1].strip() if lines else ""
+
+
+def handle_failure(job, error_text, retry_config, max_retries):
+    """Requeue a failed job if its errors are retryable and retries remain."""
+    note = first_matching_line(error_text, retry_config)
+    if job["attempts"] <= max_retries and is_retryable(error_text, retry_config):
+        logging.warning(
+            f"Retrying {os.path.basename(job['script'])} (attempt"
+            f" {job['attempts']}): {note}"
+        )
+        set_state(job, QUEUED, f"retrying: {note}")
+    else:
+        logging.error(f"Job {job['job_id']} for {job['script']} failed: {note}")
+        set_state(job, FAILED, note)
+
+
+def write_status_table(status_path, jobs):
+    """Rewrite the tab-separated status table atomically."""
+    lines = ["\t".join(STATUS_COLUMNS)]
+    for job in jobs:
+        lines.append(
+            "\t".join(str(job[column]).replace("\t", " ") for column in STATUS_COLUMNS)
+        )
+    write_text_atomic(status_path, "\n".join(lines) + "\n")
+
+
+def summarize_states(jobs):
+    """Format job counts per state for the progress log."""
+    counts = Counter(job["state"] for job in jobs)
+    return ", ".join(
+        f"{counts[state]} {state.lower()}"
+        for state in (QUEUED, PENDING, RUNNING, DONE, FAILED)
+        if counts[state]
+    )
+
+
+async def submit_job(job, backend, semaphore, retry_config, max_retries):
+    """Submit one job, holding a slot of the submission semaphore."""
+    async with semaphore:
+        job["attempts"] += 1
+        try:
+            job_id = await backend["submit"](job["script"])
+        except (RuntimeError, OSError) as e:
+            handle_failure(job, str(e), retry_config, max_retries)
+            return
+    job["job_id"] = job_id
+    set_state(job, PENDING, "")
+    logging.info(f"Submitted {os.path.basename(job['script'])} as job {job_id}")
+
+
+async def monitor_jobs(
+    jobs,
+    backend,
+    retry_config,
+    max_retries,
+    status_path,
+    poll_interval=60,
+    max_submit=4,
+    max_active=0,
+):
+    """Submit jobs and poll them until every job is done or has failed.
+
+    Submissions run concurrently, at most max_submit at a time, and at
+    most max_active jobs are queued or running on the scheduler (0 means
+    no cap). Each interval makes one poll call covering all active jobs.
+    """
+    semaphore = asyncio.Semaphore(max_submit)
+    while True:
+        queued = [job for job in jobs if job["state"] == QUEUED]
+        if max_active > 0:
+            active = sum(job["state"] in ACTIVE_STATES for job in jobs)
+            queued = queued[: max(0, max_active - active)]
+        await asyncio.gather(
+            *(
+                submit_job(job, backend, semaphore, retry_config, max_retries)
+                for job in queued
+            )
+        )
+
+        active_jobs = {
+            job["job_id"]: job for job in jobs if job["state"] in ACTIVE_STATES
+        }
+        states = await backend["poll"](list(active_jobs))
+        for job_id, state in states.items():
+            job = active_jobs[job_id]
+            if state == job["state"]:
+                continue
+            if state == FAILED:
+                error_text = await backend["read_errors"](job)
+                handle_failure(job, error_text, retry_config, max_retries)
+            else:
+                set_state(job, state)
+
+        write_status_table(status_path, jobs)
+        logging.info(f"Jobs: {summarize_states(jobs)}")
+        if all(job["state"] in FINAL_STATES for job in jobs):
+            return
+        await asyncio.sleep(poll_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Submit generated CellBender job scripts and monitor them "
+        "until they finish, retrying transient failures"
+    )
+    parser.add_argument(
+        "scripts",
+        nargs="+",
+        help="submit_cellbender_jobs.sh files written by prep-cellbender.py, "
+        "or individual job scripts",
+    )
+    parser.add_argument(
+        "--scheduler",
+        choices=sorted(SCHEDULERS) + ["fake"],
+        default="lsf",
+        help="Scheduler to submit to; 'local' runs the jobs on this machine "
+        "and 'fake' simulates jobs for testing (default: lsf)",
+    )
+    parser.add_argument(
+        "--max-submit",
+        type=int,
+        default=4,
+        help="Maximum concurrent submission commands (default: 4)",
+    )
+    parser.add_argument(
+        "--max-active",
+        type=int,
+        default=0,
+        help="Maximum jobs pending or running at once (default: no limit)",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=None,
+        help="Seconds between scheduler polls (default: 60, or 2 for local)",
+    )
+    parser.add_argument(
+        "--retry-config",
+        default=DEFAULT_RETRY_CONFIG,
+        help="JSON file with default_retries and retry_on patterns "
+        "(default: cellranger/cluster/config/retry.json)",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=None,
+        help="Retries per job for retryable failures "
+        "(default: default_retries from the retry config)",
+    )
+    parser.add_argument(
+        "--status-file",
+        default=None,
+        help="Tab-separated status table, rewritten after every poll "
+        "(default: cellbender_job_status.tsv next to the first script given)",
+    )
+
+    local_group = parser.add_argument_group("Local scheduler parameters")
+    local_group.add_argument(
+        "--local-max-jobs",
+        type=int,
+        default=0,
+        help="Maximum jobs running at once on this machine (default: one "
+        "per GPU, or 1 without GPUs)",
+    )
+    local_group.add_argument(
+        "--local-gpus",
+        default=None,
+        help="Comma-separated GPU devices to hand out to jobs through "
+        "CUDA_VISIBLE_DEVICES; 'none' runs without GPU slots (default: "
+        "CUDA_VISIBLE_DEVICES, else the devices nvidia-smi lists)",
+    )
+
+    fake_group = parser.add_argument_group("Fake scheduler parameters")
+    fake_group.add_argument(
+        "--fake-runtime",
+        type=float,
+        nargs=2,
+        default=[1.0, 3.0],
+        metavar=("MIN", "MAX"),
+        help="Simulated job runtime range in seconds (default: 1 3)",
+    )
+    fake_group.add_argument(
+        "--fake-failure-rate",
+        type=float,
+        default=0.2,
+        help="Probability that a simulated job fails (default: 0.2)",
+    )
+    fake_group.add_argument(
+        "--fake-error",
+        default="signal: killed",
+        help="Error log text reported by failed simulated jobs "
+        "(default: 'signal: killed')",
+    )
+    fake_group.add_argument(
+        "--fake-seed", type=int, default=None, help="Random seed for the fake scheduler"
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+
+    scripts = collect_job_scripts(args.scripts)
+    if not scripts:
+        print("No job scripts found to submit")
+        return
+    missing = [script for script in scripts if not os.path.exists(script)]
+    if missing:
+        print(f"Error: job script not found: {missing[0]}")
+        sys.exit(1)
+
+    retry_config = load_retry_config(args.retry_config)
+    max_retries = (
+        retry_config["default_retries"] if args.retries is None else args.retries
+    )
+    status_path = args.status_file or os.path.join(
+        os.path.dirname(os.path.abspath(args.scripts[0])), "cellbender_job_status.tsv"
+    )
+
+    jobs = [create_job(script) for script in scripts]
+    poll_interval = args.poll_interval
+    if poll_interval is None:
+        poll_interval = 2 if args.scheduler == "local" else 60
+
+    local_options = None
+    if args.scheduler == "local":
+        if args.local_gpus is None:
+            gpus = detect_gpus()
+        elif args.local_gpus == "none":
+            gpus = []
+        else:
+            gpus = [device.strip() for device in args.local_gpus.split(",") if device.strip()]
+        local_options = {
+            "gpus": gpus,
+            "max_jobs": args.local_max_jobs or (0 if gpus else 1),
+        }
+        logging.info(
+            f"Running locally with GPUs: {', '.join(gpus) or 'none'};"
+            f" at most {local_options['max_jobs'] or len(gpus)} jobs at once"
+        )
+
+    async def run():
+        backend = make_backend(
+            args.scheduler,
+            local_options=local_options,
+            runtime=tuple(args.fake_runtime),
+            failure_rate=args.fake_failure_rate,
+            error_text=args.fake_error,
+            seed=args.fake_seed,
+        )
+        await monitor_jobs(
+            jobs,
+            backend,
+            retry_config,
+            max_retries,
+            status_path,
+            poll_interval=poll_interval,
+            max_submit=args.max_submit,
+            max_active=args.max_active,
+        )
+
+    logging.info(f"Submitting {len(jobs)} job scripts to {args.scheduler}")
+    asyncio.run(run())
+
+    failed = [job for job in jobs if job["state"] == FAILED]
+    print(f"\n{summarize_states(jobs)}; status table: {status_path}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -30,35 +30,18 @@ GENE_REF=                   	# name of gene ref
 SAMPLE_DIR=$PROJ_DIR/		# /proj/subdir/to/fastqs
 CHEM=auto			# chemistry type (e.g. fiveprime)
 CLUST_TEMPLATE=		        # /path/to/lsf.template cluster file
+MAX_PARALLEL=4			# samples run side by side
+CR_SCRIPTS=			# /path/to/repo/cellranger/scripts
 
 ################################################################################
 
 exec >> cr_${PIPELINE}_`date '+%F_%H%M'`.log
 exec 2>&1
 
-# needed because pipelines differ for name of reference genome
-if [[ $PIPELINE == "count" ]]
-then
-    GENOME_LABEL=transcriptome
-else
-    GENOME_LABEL=reference
-fi
-
 OUT_DIR=$PROJ_DIR/analysis/cellranger/cr_${PIPELINE}_`date '+%F_%H%M'`
 mkdir -p $OUT_DIR && cd $_
 MRO_DISK_SPACE_CHECK=disable
 
-# cellranger function
-crProcess () {
-    cellranger $PIPELINE \
-        --id=$1 \
-        --$GENOME_LABEL=$REF_DIR/$GENE_REF \
-        --fastqs=$SAMPLE_DIR/$1 \
-        --sample=$(ls $SAMPLE_DIR/$1 | head -1 | cut -f1 -d "_") \
-        --chemistry=$CHEM \
-    	--jobmode=$CLUST_TEMPLATE
-    }
-
 # # velocyto function
 # vcProcess () {
 #     velocyto run10x \
@@ -66,27 +49,23 @@ crProcess () {
 #         $REF_DIR/$GENE_REF/genes/genes.gtf
 #     }
 
-export -f crProcess
 # export -f vcProcess
 
-# cellranger execution
-for i in $(ls $SAMPLE_DIR)
-do
-    crProcess $i
-done
-
-# run cellranger summarizer
-cd $(ls -d */ | head -n 1)
-head -n 1 outs/metrics_summary.csv > ../combined_metrics.csv
-cd ../
-sed -i 's/^/Sample,/' combined_metrics.csv
-
-for i in $(/bin/ls -d */)
-do
-    LABEL=$(echo $i | sed 's/\///g')
-    METRICS=$(tail -n 1 ${i}outs/metrics_summary.csv)
-    echo "${LABEL},${METRICS}" >> combined_metrics.csv
-done
+# cellranger execution: one pipeline per sample dir, up to MAX_PARALLEL at a
+# time (the runner passes the reference as --transcriptome for count and
+# --reference otherwise); per-sample logs and the cellranger_samples.tsv
+# manifest are written here. If interrupted, re-run the same command from
+# $OUT_DIR to resume.
+python3 $CR_SCRIPTS/run-cellranger-samples.py \
+    --pipeline $PIPELINE \
+    --sample-dir $SAMPLE_DIR \
+    --reference $REF_DIR/$GENE_REF \
+    --chemistry $CHEM \
+    --jobmode $CLUST_TEMPLATE \
+    --max-parallel $MAX_PARALLEL
+
+# run cellranger summarizer (writes combined_metrics.csv)
+python3 $CR_SCRIPTS/summarize-cellranger-runs.py --run-dir $OUT_DIR
 
 # source $HOME/miniconda3/etc/profile.d/conda.sh
 # conda activate velocyto
@@ -0,0 +1,121 @@
+"""Fast reader for 10x metrics_summary.csv files.
+
+Multi per-sample files have a fixed long schema (Category, Library Type,
+Grouped By, Group Name, Metric Name, Metric Value). Each file is mapped
+into memory and the wanted rows are pulled out with one precompiled
+regex over the raw bytes, so no per-file DataFrame is built; callers
+collect plain column lists and build one table at the end. Files with
+any other header fall back to the csv module.
+"""
+
+import csv
+import io
+import mmap
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+MULTI_COLUMNS = [
+    'Category', 'Library Type', 'Grouped By', 'Group Name',
+    'Metric Name', 'Metric Value'
+]
+MULTI_HEADER = ','.join(MULTI_COLUMNS).encode()
+
+# One CSV field: quoted (with "" escapes) or bare up to the next comma
+FIELD = rb'("(?:[^"]|"")*"|[^,"\r\n]*)'
+
+
+def compile_metrics_pattern(metric_names=None, categories=None):
+    """Compile the row matcher for the wanted metric names and categories.
+
+    None for either argument matches every value. The names become one
+    alternation, so each file is scanned once whatever their number.
+    """
+    def choice(values):
+        if values is None:
+            return FIELD
+        escaped = sorted((re.escape(v.encode()) for v in values), key=len, reverse=True)
+        return b'(' + (b'|'.join(escaped) or b'(?!)') + b')'
+
+    return re.compile(
+        b'^' + choice(categories) + b',' + FIELD + b',' + FIELD + b',' + FIELD
+        + b',' + choice(metric_names) + b',' + FIELD + b'\r?$',
+        re.M
+    )
+
+
+def _unquote(value):
+    """Decode one raw CSV field, returning None for an empty field."""
+    if value.startswith(b'"'):
+        value = value[1:-1].replace(b'""', b'"')
+    return value.decode() if value else None
+
+
+def _read_with_csv(data, metric_names, categories):
+    """Parse any long-format metrics CSV with the csv module (fallback path)."""
+    reader = csv.DictReader(io.StringIO(data.decode()))
+    rows = []
+    for record in reader:
+        row = tuple(record.get(column) or None for column in MULTI_COLUMNS)
+        if categories is not None and row[0] not in categories:
+            continue
+        if metric_names is not None and row[4] not in metric_names:
+            continue
+        rows.append(row)
+    return rows
+
+
+def read_metrics_summary(file_path, pattern, metric_names=None, categories=None):
+    """Return the wanted rows of one long-format metrics_summary.csv.
+
+    pattern comes from compile_metrics_pattern(metric_names, categories);
+    the names are only needed again for the csv fallback. Rows are
+    tuples in MULTI_COLUMNS order, with None for empty fields.
+    """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            header_end = data.find(b'\n')
+            header = data[:header_end if header_end >= 0 else len(data)].rstrip(b'\r')
+            if header.lstrip(b'\xef\xbb\xbf') != MULTI_HEADER:
+                return _read_with_csv(data[:], metric_names, categories)
+            return [
+                tuple(_unquote(field) for field in match.groups())
+                for match in pattern.finditer(data, header_end + 1)
+            ]
+
+
+def read_count_metrics_summary(file_path):
+    """Read a cellranger count metrics_summary.csv (one wide row).
+
+    Returns (metric name, metric value) pairs in column order.
+    """
+    with open(file_path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        names = next(reader, [])
+        values = next(reader, [])
+    return [(name, value or None) for name, value in zip(names, values)]
+
+
+def read_metrics_columns(file_paths, labels, metric_names=None, categories=None, workers=8):
+    """Read many long-format metrics files into one dict of column lists.
+
+    labels gives the Sample value for each file. Files are read
+    concurrently; the columns are concatenated once at the end in file
+    order.
+    """
+    pattern = compile_metrics_pattern(metric_names, categories)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        per_file = list(executor.map(
+            lambda file_path: read_metrics_summary(file_path, pattern, metric_names, categories),
+            file_paths
+        ))
+
+    columns = {'Sample': []}
+    columns.update({column: [] for column in MULTI_COLUMNS})
+    for label, rows in zip(labels, per_file):
+        columns['Sample'].extend([label] * len(rows))
+        for column, values in zip(MULTI_COLUMNS, zip(*rows) if rows else ()):
+            columns[column].extend(values)
+    return columns
@@ -1,28 +1,214 @@
 import pandas as pd
 import glob
+import hashlib
 import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 import argparse
-import re
-
-def clean_complex_value(value):
-    """Handle complex string formats"""
-    if isinstance(value, str):
-        value = value.replace(',', '')
-        value = re.sub(r'[^0-9.]', '', value)
-        return float(value)
-    return value
-
-def clean_percentage(value):
-    """Convert percentage values to fractions and round to 3 sig figs"""
-    if isinstance(value, str):
-        if '%' in value:
-            value = re.sub(r'[^0-9.]', '', value)
-            # Convert to fraction and round to 4 sig figs
-            return round(float(value) / 100, 4)
-    return value
-
-def process_metrics_summaries(cellranger_outs_dir, output_dir=None):
+
+from metrics_reader import (
+    MULTI_COLUMNS,
+    compile_metrics_pattern,
+    read_count_metrics_summary,
+    read_metrics_columns,
+    read_metrics_summary,
+)
+
+CATEGORICAL_COLUMNS = ['Sample', 'Category', 'Library Type']
+PRIMARY_LIBRARY_TYPE = 'Gene Expression'
+# Pooled rows broken down below the library level (e.g. per Fastq ID) are
+# left out of the per-library table
+LIBRARY_GROUPINGS = ['Physical library ID']
+METRICS_CATEGORIES = ['Cells', 'Library']
+ALL_ROWS_PATTERN = compile_metrics_pattern()
+PROJECT_COLUMNS = ['Run ID', 'Run', 'Layout', 'Sample'] + MULTI_COLUMNS
+PROJECT_CATEGORICAL_COLUMNS = [
+    'Run ID', 'Run', 'Layout', 'Category', 'Library Type', 'Grouped By',
+    'Group Name', 'Metric Name'
+]
+
+def clean_metric_values(values):
+    """Convert a Series of 10x metric strings to floats in one vectorized pass.
+
+    Percentages become fractions rounded to 4 decimals; everything else has
+    commas and non-numeric characters stripped and is parsed as float.
+    """
+    text = values.astype(str)
+    numbers = pd.to_numeric(
+        text.str.replace(r'[^0-9.]', '', regex=True), errors='coerce'
+    )
+    is_percentage = text.str.contains('%', regex=False)
+    return numbers.where(~is_percentage, (numbers / 100).round(4))
+
+def read_metrics_files(metrics_files, metric_names, workers=8):
+    """Read metrics files into one DataFrame with categorical keys.
+
+    Files are memory-mapped and scanned for the wanted rows by
+    metrics_reader; the frame is built once from the collected columns.
+    """
+    columns = read_metrics_columns(
+        metrics_files,
+        [Path(file_path).parent.name for file_path in metrics_files],
+        metric_names=metric_names,
+        categories=METRICS_CATEGORIES,
+        workers=workers
+    )
+    combined_df = pd.DataFrame({col: columns[col] for col in ['Sample'] + MULTI_COLUMNS})
+    combined_df['Metric Value'] = clean_metric_values(combined_df['Metric Value'])
+    return combined_df.astype({col: 'category' for col in CATEGORICAL_COLUMNS})
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ingested_files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    ingested_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    path TEXT NOT NULL REFERENCES ingested_files(path),
+    row_number INTEGER NOT NULL,
+    category TEXT,
+    library_type TEXT,
+    grouped_by TEXT,
+    group_name TEXT,
+    metric_name TEXT,
+    metric_value TEXT,
+    PRIMARY KEY (path, row_number)
+);
+"""
+
+def open_metrics_store(store_path):
+    """Open (creating if needed) the SQLite store of ingested metrics files"""
+    os.makedirs(os.path.dirname(os.path.abspath(store_path)), exist_ok=True)
+    conn = sqlite3.connect(store_path)
+    conn.executescript(STORE_SCHEMA)
+    return conn
+
+def parse_metrics_file_for_store(file_path):
+    """Hash and parse one metrics_summary.csv into rows for the store"""
+    with open(file_path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return digest, read_metrics_summary(file_path, ALL_ROWS_PATTERN)
+
+def ingest_metrics_files(conn, metrics_files, workers=8):
+    """Ingest new or changed metrics files into the store.
+
+    Files whose size and mtime match the store are skipped without being
+    opened. Files whose stat changed are re-hashed, and only re-parsed
+    rows are replaced when the content hash differs. Returns the number
+    of files (re)parsed.
+    """
+    known = {
+        path: (size, mtime_ns, sha256)
+        for path, size, mtime_ns, sha256 in conn.execute(
+            'SELECT path, size, mtime_ns, sha256 FROM ingested_files'
+        )
+    }
+
+    candidates = []
+    for file_path in metrics_files:
+        path = os.path.abspath(file_path)
+        st = os.stat(path)
+        previous = known.get(path)
+        if previous and previous[:2] == (st.st_size, st.st_mtime_ns):
+            continue
+        candidates.append((path, st))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        parsed = list(executor.map(
+            lambda candidate: parse_metrics_file_for_store(candidate[0]),
+            candidates
+        ))
+
+    ingested = 0
+    with conn:
+        for (path, st), (digest, rows) in zip(candidates, parsed):
+            previous = known.get(path)
+            if previous is None or previous[2] != digest:
+                conn.execute('DELETE FROM metrics WHERE path = ?', (path,))
+                conn.executemany(
+                    'INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(path, i) + row for i, row in enumerate(rows)]
+                )
+                ingested += 1
+            conn.execute(
+                'INSERT OR REPLACE INTO ingested_files (path, size, mtime_ns, sha256) '
+                'VALUES (?, ?, ?, ?)',
+                (path, st.st_size, st.st_mtime_ns, digest)
+            )
+    return ingested
+
+def read_metrics_from_store(conn, metrics_files, metric_names):
+    """Load the needed rows for metrics_files from the store.
+
+    Returns the same frame as read_metrics_files: Sample, the metrics
+    columns and cleaned Metric Value, in file order.
+    """
+    paths = [os.path.abspath(file_path) for file_path in metrics_files]
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (path TEXT, file_order INTEGER)')
+    conn.execute('DELETE FROM wanted')
+    conn.executemany('INSERT INTO wanted VALUES (?, ?)', [(path, i) for i, path in enumerate(paths)])
+    placeholders = ', '.join('?' * len(metric_names))
+    combined_df = pd.read_sql_query(
+        f"""
+        SELECT m.path, m.category AS "Category", m.library_type AS "Library Type",
+               m.grouped_by AS "Grouped By", m.group_name AS "Group Name",
+               m.metric_name AS "Metric Name", m.metric_value AS "Metric Value"
+        FROM metrics m JOIN wanted w ON m.path = w.path
+        WHERE m.category IN ('Cells', 'Library') AND m.metric_name IN ({placeholders})
+        ORDER BY w.file_order, m.row_number
+        """,
+        conn,
+        params=list(metric_names)
+    )
+    combined_df.insert(0, 'Sample', combined_df.pop('path').map(lambda path: Path(path).parent.name))
+    combined_df['Metric Value'] = clean_metric_values(combined_df['Metric Value'])
+    return combined_df.astype({col: 'category' for col in CATEGORICAL_COLUMNS})
+
+def library_type_order(library_types):
+    """Order library types by first appearance, Gene Expression first"""
+    ordered = list(dict.fromkeys(str(library_type) for library_type in library_types))
+    return sorted(ordered, key=lambda library_type: library_type != PRIMARY_LIBRARY_TYPE)
+
+def individual_metrics_by_library(cells_df):
+    """Pivot per-sample Cells rows to one row per sample.
+
+    Each library type gets its own set of columns; Gene Expression
+    columns keep the bare metric names, other library types are
+    prefixed with the library type (e.g. "Antibody Capture: Median UMI
+    counts per cell").
+    """
+    cells_df = cells_df.astype({'Sample': str, 'Library Type': str})
+    blocks = []
+    for library_type in library_type_order(cells_df['Library Type']):
+        block = cells_df[cells_df['Library Type'] == library_type].drop_duplicates(
+            ['Sample', 'Metric Name']
+        ).pivot(index='Sample', columns='Metric Name', values='Metric Value')
+        if library_type != PRIMARY_LIBRARY_TYPE:
+            block = block.add_prefix(f'{library_type}: ')
+        blocks.append(block)
+    if not blocks:
+        return pd.DataFrame(index=pd.Index([], name='Sample'))
+    individual_metrics = pd.concat(blocks, axis=1)
+    individual_metrics.index.name = 'Sample'
+    return individual_metrics
+
+def pooled_metrics_by_library(library_df, pooled_metric_names):
+    """Build the wide pooled table: one row per metric, one column per library type"""
+    library_df = library_df[
+        library_df['Grouped By'].isna() | library_df['Grouped By'].isin(LIBRARY_GROUPINGS)
+    ].astype({'Library Type': str}).drop_duplicates(['Library Type', 'Metric Name'])
+    wide_df = library_df.pivot(index='Metric Name', columns='Library Type', values='Metric Value')
+    wide_df = wide_df.reindex(
+        index=[name for name in pooled_metric_names if name in wide_df.index],
+        columns=library_type_order(library_df['Library Type'])
+    )
+    wide_df.columns.name = None
+    return wide_df
+
+def process_metrics_summaries(cellranger_outs_dir, output_dir=None, workers=8, store_path=None):
     metrics_files = glob.glob(os.path.join(cellranger_outs_dir, "per_sample_outs", "*", "metrics_summary.csv"))
 
     if not metrics_files:
@@ -69,60 +255,54 @@ def process_metrics_summaries(cellranger_outs_dir, output_dir=None):
         'Valid probe barcodes'
     ]
 
-    # Process per-sample metrics
-    all_metrics = []
-    for file_path in metrics_files:
-        sample_name = Path(file_path).parent.name
-        df = pd.read_csv(file_path)
-        df['Sample'] = sample_name
-        all_metrics.append(df)
+    metric_names = set(individual_metric_names) | set(pooled_metric_names) | {'Estimated number of cells'}
+    if store_path:
+        # Only parse files that are new or changed since the last run
+        conn = open_metrics_store(store_path)
+        try:
+            ingested = ingest_metrics_files(conn, metrics_files, workers)
+            print(f"Ingested {ingested} new or changed of {len(metrics_files)} metrics files into {store_path}")
+            combined_df = read_metrics_from_store(conn, metrics_files, metric_names)
+        finally:
+            conn.close()
+    else:
+        # Read every file once, concurrently, with values already cleaned
+        combined_df = read_metrics_files(metrics_files, metric_names, workers)
 
-    combined_df = pd.concat(all_metrics, ignore_index=True)
+    # Pooled (Library) rows are repeated in every sample's file; keep each
+    # library type's rows once, from the first file that has them
+    library_df = combined_df[
+        (combined_df['Category'] == 'Library') &
+        (combined_df['Metric Name'].isin(metric_names))
+    ].drop_duplicates(['Library Type', 'Grouped By', 'Group Name', 'Metric Name'])
 
-    # Create individual metrics summary
-    individual_metrics = combined_df[
-        (combined_df['Category'] == 'Cells') & 
+    # Create individual metrics summary, one column set per library type
+    cells_df = combined_df[
+        (combined_df['Category'] == 'Cells') &
         (combined_df['Metric Name'].isin(individual_metric_names))
-    ].pivot(
-        index='Sample',
-        columns='Metric Name',
-        values='Metric Value'
-    )
-
-    # Clean numeric values in individual_metrics first
-    for col in individual_metrics.columns:
-        if individual_metrics[col].dtype == 'object':
-            if any('%' in str(x) for x in individual_metrics[col] if isinstance(x, str)):
-                individual_metrics[col] = individual_metrics[col].apply(clean_percentage)
-            else:
-                individual_metrics[col] = individual_metrics[col].apply(clean_complex_value)
-
-    # Get estimated number of cells from pooled metrics and clean it
-    estimated_cells = combined_df[
-        (combined_df['Category'] == 'Library') & 
-        (combined_df['Metric Name'] == 'Estimated number of cells')
-    ]['Metric Value'].iloc[0]
-    estimated_cells = clean_complex_value(estimated_cells)
+    ]
+    individual_metrics = individual_metrics_by_library(cells_df)
+
+    # Get estimated number of cells from the Gene Expression library's pooled
+    # metrics (or the first library that reports it)
+    estimated_cells_df = library_df[library_df['Metric Name'] == 'Estimated number of cells']
+    primary_df = estimated_cells_df[estimated_cells_df['Library Type'] == PRIMARY_LIBRARY_TYPE]
+    estimated_cells = (primary_df if len(primary_df) else estimated_cells_df)['Metric Value'].iloc[0]
 
     # Calculate Cells detected in this sample as fraction and round to 3 sig figs
     individual_metrics['Cells detected in this sample'] = (individual_metrics['Cells'] / estimated_cells).round(3)
 
-    # Process pooled metrics (using first file only)
-    df = pd.read_csv(metrics_files[0])
-    pooled_df = df[
-        (df['Category'] == 'Library') &
-        (df['Library Type'] == 'Gene Expression') &
-        (df['Metric Name'].isin(pooled_metric_names))
-    ][['Metric Name', 'Metric Value']]
-
-    # Clean up numeric values in pooled_df
-    if isinstance(pooled_df, pd.DataFrame):
-        pooled_df['Metric Value'] = pooled_df.apply(
-            lambda row: clean_percentage(row['Metric Value']) 
-            if isinstance(row['Metric Value'], str) and '%' in row['Metric Value']
-            else clean_complex_value(row['Metric Value']),
-            axis=1
-        )
+    # Pooled Gene Expression metrics in the original long layout
+    pooled_df = library_df[
+        (library_df['Library Type'] == PRIMARY_LIBRARY_TYPE) &
+        (library_df['Metric Name'].isin(pooled_metric_names))
+    ][['Metric Name', 'Metric Value']].reset_index(drop=True)
+
+    # Pooled metrics for every library type side by side
+    pooled_wide_df = pooled_metrics_by_library(
+        library_df[library_df['Metric Name'].isin(pooled_metric_names)],
+        pooled_metric_names
+    )
 
     # Save outputs
     if output_dir is None:
@@ -139,7 +319,103 @@ def process_metrics_summaries(cellranger_outs_dir, output_dir=None):
     pooled_df.to_csv(pooled_output, index=False)
     print(f"Saved pooled metrics to: {pooled_output}")
 
-    return individual_metrics, pooled_df
+    # Save pooled metrics per library type
+    pooled_wide_output = os.path.join(output_dir, 'pooled_metrics_by_library.csv')
+    pooled_wide_df.to_csv(pooled_wide_output)
+    print(f"Saved pooled metrics per library type to: {pooled_wide_output}")
+
+    return individual_metrics, pooled_df, pooled_wide_df
+
+def find_cellranger_runs(project_dir):
+    """Find every cr_* run directory under analysis/cellranger"""
+    return sorted(
+        path for path in glob.glob(os.path.join(project_dir, 'analysis', 'cellranger', 'cr_*'))
+        if os.path.isdir(path)
+    )
+
+def read_count_metrics(file_path):
+    """Read a cellranger count metrics_summary.csv (one wide row) as long rows"""
+    df = pd.DataFrame(
+        read_count_metrics_summary(file_path), columns=['Metric Name', 'Metric Value']
+    )
+    df['Category'] = 'Library'
+    df['Library Type'] = 'Gene Expression'
+    df['Grouped By'] = None
+    df['Group Name'] = None
+    return df[MULTI_COLUMNS]
+
+def collect_run_metrics(run_dir):
+    """Collect all metrics rows for one cr_* run, for count or multi layouts.
+
+    Each pipeline output directory below run_dir is inspected: multi runs
+    contribute every per_sample_outs/*/metrics_summary.csv, count runs
+    their outs/metrics_summary.csv. Values are left as strings.
+    """
+    run_id = os.path.basename(run_dir)
+    frames = []
+    for outs_dir in sorted(glob.glob(os.path.join(run_dir, '*', 'outs'))):
+        run = Path(outs_dir).parent.name
+        per_sample_files = sorted(glob.glob(
+            os.path.join(outs_dir, 'per_sample_outs', '*', 'metrics_summary.csv')
+        ))
+        if per_sample_files:
+            columns = read_metrics_columns(
+                per_sample_files,
+                [Path(file_path).parent.name for file_path in per_sample_files],
+                workers=1
+            )
+            df = pd.DataFrame(columns)
+            df.insert(0, 'Layout', 'multi')
+            df.insert(0, 'Run', run)
+            frames.append(df)
+        elif os.path.exists(os.path.join(outs_dir, 'metrics_summary.csv')):
+            df = read_count_metrics(os.path.join(outs_dir, 'metrics_summary.csv'))
+            df.insert(0, 'Sample', run)
+            df.insert(0, 'Layout', 'count')
+            df.insert(0, 'Run', run)
+            frames.append(df)
+
+    if not frames:
+        return pd.DataFrame(columns=PROJECT_COLUMNS)
+    run_df = pd.concat(frames, ignore_index=True)
+    run_df.insert(0, 'Run ID', run_id)
+    return run_df
+
+def aggregate_project_metrics(project_dir, output_path=None, output_format='parquet', workers=8):
+    """Aggregate metrics from every cr_* run in a project into one columnar file.
+
+    Runs are parsed across a process pool; the combined long table has one
+    row per (run, sample, metric) with a numeric Metric Value and the raw
+    string kept in Metric Text. Written as Parquet or Feather.
+    """
+    run_dirs = find_cellranger_runs(project_dir)
+    if not run_dirs:
+        raise FileNotFoundError(f"No cr_* run directories found in {project_dir}/analysis/cellranger/")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        frames = list(executor.map(collect_run_metrics, run_dirs))
+
+    project_df = pd.concat(frames, ignore_index=True)
+    if project_df.empty:
+        raise FileNotFoundError(f"No metrics_summary.csv files found under {project_dir}/analysis/cellranger/")
+
+    project_df['Metric Text'] = project_df['Metric Value']
+    project_df['Metric Value'] = clean_metric_values(project_df['Metric Value'])
+    project_df['Sample'] = project_df['Sample'].astype(str)
+    project_df = project_df.astype({col: 'category' for col in PROJECT_CATEGORICAL_COLUMNS})
+
+    if output_path is None:
+        output_path = os.path.join(
+            project_dir, 'analysis', 'cellranger', f'project_metrics.{output_format}'
+        )
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    if output_format == 'feather':
+        project_df.to_feather(output_path)
+    else:
+        project_df.to_parquet(output_path, index=False)
+    print(f"Saved metrics for {len(run_dirs)} runs to: {output_path}")
+
+    return project_df
 
 def main():
     parser = argparse.ArgumentParser(
@@ -147,12 +423,18 @@ def main():
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
 
-    parser.add_argument(
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument(
         '--cellranger-dir',
-        required=True,
         metavar='DIR',
         help='Path to CellRanger Multi output directory (containing per_sample_outs/)'
     )
+    input_group.add_argument(
+        '--project-dir',
+        metavar='DIR',
+        help='Project directory; aggregates every analysis/cellranger/cr_* run '
+             '(count and multi) into one Parquet/Feather table'
+    )
 
     parser.add_argument(
         '--output-dir',
@@ -160,6 +442,33 @@ def main():
         help='Custom output directory (default: creates "analysis" in cellranger directory)'
     )
 
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=8,
+        help='Number of metrics files (or runs with --project-dir) to read concurrently (default: 8)'
+    )
+
+    parser.add_argument(
+        '--metrics-store',
+        metavar='FILE',
+        help='SQLite store of ingested metrics files; only new or changed '
+             'metrics_summary.csv files are parsed on re-runs'
+    )
+
+    parser.add_argument(
+        '--output-file',
+        metavar='FILE',
+        help='Output table for --project-dir (default: analysis/cellranger/project_metrics.<format>)'
+    )
+
+    parser.add_argument(
+        '--format',
+        choices=['parquet', 'feather'],
+        default='parquet',
+        help='Output format for --project-dir (default: parquet)'
+    )
+
     parser.add_argument(
         '--quiet',
         action='store_true',
@@ -169,9 +478,22 @@ def main():
     args = parser.parse_args()
 
     try:
-        individual_metrics, pooled_metrics = process_metrics_summaries(
+        if args.project_dir:
+            project_metrics = aggregate_project_metrics(
+                args.project_dir,
+                args.output_file,
+                args.format,
+                args.workers
+            )
+            if not args.quiet:
+                print(project_metrics)
+            return
+
+        individual_metrics, pooled_metrics, pooled_by_library = process_metrics_summaries(
             args.cellranger_dir,
-            args.output_dir
+            args.output_dir,
+            args.workers,
+            args.metrics_store
         )
 
         if not args.quiet:
@@ -179,6 +501,8 @@ def main():
             print(individual_metrics)
             print("\nPooled metrics:")
             print(pooled_metrics)
+            print("\nPooled metrics per library type:")
+            print(pooled_by_library)
 
     except Exception as e:
         print(f"Error: {str(e)}")
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""Run one CellRanger pipeline per FASTQ sample directory, several at a time.
+
+Replaces the serial crProcess loop in cellranger-template.sh: each
+directory under --sample-dir is one sample, run with the same command
+line crProcess builds, with up to --max-parallel pipelines side by side.
+Progress is kept in a manifest so an interrupted launch can be resumed
+by running the same command again.
+"""
+
+import argparse
+import fcntl
+import os
+import re
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+MANIFEST_COLUMNS = [
+    'sample', 'sample_prefix', 'fastqs', 'status', 'exit_code',
+    'started', 'finished', 'log', 'command'
+]
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+INTERRUPTED = 'interrupted'
+
+# Illumina bcl2fastq/mkfastq naming: {prefix}_S1_L001_R1_001.fastq.gz
+FASTQ_PATTERN = re.compile(
+    r'^(?P<prefix>.+?)_S\d+(?:_L\d{3})?_(?:R|I)\d_\d{3}\.fastq(?:\.gz)?$'
+)
+
+
+def now():
+    """Timestamp for the manifest and progress lines."""
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def sample_prefix(fastq_dir):
+    """Derive the --sample prefix from the FASTQ names in fastq_dir.
+
+    Like crProcess, the first file in sorted order decides. Names that
+    follow the Illumina pattern keep underscores inside the prefix;
+    anything else falls back to crProcess's cut at the first underscore.
+    Returns the prefix and the set of all prefixes seen.
+    """
+    names = sorted(os.listdir(fastq_dir))
+    if not names:
+        return None, set()
+    prefixes = set()
+    for name in names:
+        match = FASTQ_PATTERN.match(name)
+        if match:
+            prefixes.add(match.group('prefix'))
+    first = FASTQ_PATTERN.match(names[0])
+    prefix = first.group('prefix') if first else names[0].split('_')[0]
+    return prefix, prefixes
+
+
+def genome_option(pipeline):
+    """Return the reference option name for a pipeline, as in the template."""
+    return 'transcriptome' if pipeline == 'count' else 'reference'
+
+
+def build_command(args, sample, prefix):
+    """Build the cellranger command line crProcess runs for one sample."""
+    command = [
+        args.cellranger,
+        args.pipeline,
+        f'--id={sample}',
+        f'--{genome_option(args.pipeline)}={args.reference}',
+        f'--fastqs={os.path.join(args.sample_dir, sample)}',
+        f'--sample={prefix}',
+        f'--chemistry={args.chemistry}',
+        f'--jobmode={args.jobmode}',
+    ]
+    if args.localcores:
+        command.append(f'--localcores={args.localcores}')
+    if args.localmem:
+        command.append(f'--localmem={args.localmem}')
+    if args.extra_args:
+        command.extend(shlex.split(args.extra_args))
+    return command
+
+
+def read_manifest(manifest_path):
+    """Read a manifest into a dict of rows keyed by sample."""
+    rows = {}
+    if not os.path.exists(manifest_path):
+        return rows
+    with open(manifest_path, 'r') as f:
+        header = f.readline().rstrip('\n').split('\t')
+        for line in f:
+            values = line.rstrip('\n').split('\t')
+            row = dict(zip(header, values))
+            if row.get('sample'):
+                rows[row['sample']] = row
+    return rows
+
+
+def write_manifest(manifest_path, rows):
+    """Rewrite the manifest atomically."""
+    lines = ['\t'.join(MANIFEST_COLUMNS)]
+    for row in rows.values():
+        lines.append('\t'.join(
+            str(row.get(column, '')).replace('\t', ' ') for column in MANIFEST_COLUMNS
+        ))
+    tmp_path = f'{manifest_path}.tmp.{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, manifest_path)
+
+
+def plan_samples(args, previous):
+    """Build manifest rows for every sample directory.
+
+    Samples marked done in a previous manifest keep their row; everything
+    else (new, failed, interrupted or left running by a killed launch) is
+    pending. CellRanger resumes an existing pipestance directory from its
+    last completed stage.
+    """
+    rows = {}
+    for sample in sorted(os.listdir(args.sample_dir)):
+        fastq_dir = os.path.join(args.sample_dir, sample)
+        if not os.path.isdir(fastq_dir):
+            continue
+        if previous.get(sample, {}).get('status') == DONE:
+            rows[sample] = previous[sample]
+            continue
+
+        prefix, prefixes = sample_prefix(fastq_dir)
+        if prefix is None:
+            print(f'Skipping {sample}: no FASTQ files in {fastq_dir}')
+            continue
+        if len(prefixes) > 1:
+            print(
+                f'Warning: {sample} has FASTQs for several sample prefixes'
+                f' ({", ".join(sorted(prefixes))}); using {prefix}'
+            )
+        rows[sample] = {
+            'sample': sample,
+            'sample_prefix': prefix,
+            'fastqs': fastq_dir,
+            'status': PENDING,
+            'exit_code': '',
+            'started': '',
+            'finished': '',
+            'log': os.path.join(args.log_dir, f'cellranger_{sample}.log'),
+            'command': ' '.join(
+                shlex.quote(part) for part in build_command(args, sample, prefix)
+            ),
+        }
+    return rows
+
+
+def run_samples(rows, out_dir, manifest_path, max_parallel):
+    """Run every pending sample, at most max_parallel at a time.
+
+    Each pipeline runs in out_dir (where CellRanger creates its --id
+    directory) with stdout and stderr in the sample's log. The manifest
+    is rewritten after every state change. On SIGINT or SIGTERM running
+    pipelines are terminated and marked interrupted.
+    """
+    lock = threading.Lock()
+    stopping = threading.Event()
+    processes = {}
+
+    def update(sample, **values):
+        with lock:
+            rows[sample].update(values)
+            write_manifest(manifest_path, rows)
+
+    def run(sample):
+        row = rows[sample]
+        with open(row['log'], 'a') as log:
+            log.write(f'[{now()}] {row["command"]}\n')
+            log.flush()
+            with lock:
+                if stopping.is_set():
+                    return
+                try:
+                    process = subprocess.Popen(
+                        shlex.split(row['command']),
+                        cwd=out_dir,
+                        stdout=log,
+                        stderr=subprocess.STDOUT,
+                    )
+                except OSError as e:
+                    process = None
+                    log.write(f'[{now()}] Could not start the pipeline: {e}\n')
+                else:
+                    processes[sample] = process
+            if process is None:
+                update(sample, status=FAILED, exit_code='', started=now(), finished=now())
+                print(f'[{now()}] {sample}: {FAILED} (could not start, see {row["log"]})')
+                return
+            update(sample, status=RUNNING, started=now(), finished='', exit_code='')
+            print(f'[{now()}] Started {sample} (pid {process.pid})')
+            exit_code = process.wait()
+        with lock:
+            processes.pop(sample, None)
+        if stopping.is_set():
+            status = INTERRUPTED
+        else:
+            status = DONE if exit_code == 0 else FAILED
+        update(sample, status=status, exit_code=exit_code, finished=now())
+        print(f'[{now()}] {sample}: {status} (exit code {exit_code})')
+
+    def stop(signum, frame):
+        stopping.set()
+        with lock:
+            for process in processes.values():
+                process.terminate()
+
+    previous_handlers = {
+        signum: signal.signal(signum, stop) for signum in (signal.SIGINT, signal.SIGTERM)
+    }
+    try:
+        pending = [sample for sample, row in rows.items() if row['status'] != DONE]
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            list(executor.map(run, pending))
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+    return not stopping.is_set()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run a CellRanger pipeline for every FASTQ sample '
+                    'directory, several samples at a time, with per-sample '
+                    'logs and a resumable manifest'
+    )
+    parser.add_argument(
+        '--pipeline',
+        required=True,
+        help='CellRanger pipeline, e.g. count or vdj'
+    )
+    parser.add_argument(
+        '--sample-dir',
+        required=True,
+        help='Directory with one FASTQ directory per sample (SAMPLE_DIR)'
+    )
+    parser.add_argument(
+        '--reference',
+        required=True,
+        help='Reference directory, passed as --transcriptome for count and '
+             '--reference otherwise (REF_DIR/GENE_REF)'
+    )
+    parser.add_argument(
+        '--chemistry',
+        default='auto',
+        help='Chemistry (default: auto)'
+    )
+    parser.add_argument(
+        '--jobmode',
+        default='local',
+        help='Martian job mode: local, or a cluster template such as '
+             'lsf.template (default: local)'
+    )
+    parser.add_argument(
+        '--out-dir',
+        default='.',
+        help='Directory the pipestance directories are created in '
+             '(default: current directory)'
+    )
+    parser.add_argument(
+        '--max-parallel',
+        type=int,
+        default=4,
+        help='Maximum pipelines running at once (default: 4)'
+    )
+    parser.add_argument(
+        '--localcores',
+        type=int,
+        default=None,
+        help='--localcores for each pipeline; with --jobmode local, keep '
+             'max-parallel x localcores within the node'
+    )
+    parser.add_argument(
+        '--localmem',
+        type=int,
+        default=None,
+        help='--localmem (GB) for each pipeline'
+    )
+    parser.add_argument(
+        '--extra-args',
+        default='',
+        help='Further cellranger arguments, as one quoted string'
+    )
+    parser.add_argument(
+        '--cellranger',
+        default='cellranger',
+        help='cellranger executable (default: cellranger on PATH)'
+    )
+    parser.add_argument(
+        '--manifest',
+        default=None,
+        help='Manifest TSV of samples, commands and status; re-running with '
+             'the same manifest skips samples already done '
+             '(default: OUT_DIR/cellranger_samples.tsv)'
+    )
+    parser.add_argument(
+        '--log-dir',
+        default=None,
+        help='Directory for the per-sample logs (default: OUT_DIR)'
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Write the manifest and print the commands without running them'
+    )
+
+    args = parser.parse_args()
+    # Pipelines run in OUT_DIR, so paths given relative to here must be absolute
+    args.sample_dir = os.path.abspath(args.sample_dir)
+    args.reference = os.path.abspath(args.reference)
+    if os.path.exists(args.jobmode):
+        args.jobmode = os.path.abspath(args.jobmode)
+    if os.sep in args.cellranger:
+        args.cellranger = os.path.abspath(args.cellranger)
+    out_dir = os.path.abspath(args.out_dir)
+    manifest_path = args.manifest or os.path.join(out_dir, 'cellranger_samples.tsv')
+    args.log_dir = os.path.abspath(args.log_dir or out_dir)
+    os.makedirs(args.log_dir, exist_ok=True)
+
+    if not os.path.isdir(args.sample_dir):
+        print(f'Error: sample directory not found: {args.sample_dir}')
+        sys.exit(1)
+
+    # Only one launcher may drive a manifest at a time
+    lock_file = open(f'{manifest_path}.lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print(f'Error: another launcher is already using {manifest_path}')
+        sys.exit(1)
+
+    previous = read_manifest(manifest_path)
+    rows = plan_samples(args, previous)
+    write_manifest(manifest_path, rows)
+    done = sum(row['status'] == DONE for row in rows.values())
+    print(
+        f'{len(rows)} samples, {done} already done, {len(rows) - done} to run'
+        f' with up to {args.max_parallel} in parallel; manifest: {manifest_path}'
+    )
+
+    if args.dry_run:
+        for row in rows.values():
+            if row['status'] != DONE:
+                print(row['command'])
+        return
+
+    completed = run_samples(rows, out_dir, manifest_path, args.max_parallel)
+    failed = [sample for sample, row in rows.items() if row['status'] == FAILED]
+    if failed:
+        print(f'Failed samples (see logs in {args.log_dir}): {", ".join(failed)}')
+    if not completed:
+        print('Interrupted; run the same command again to resume')
+        sys.exit(130)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""Combine the metrics of every CellRanger run in a directory into one CSV.
+
+Replaces the shell summarisers at the end of cellranger-template.sh and
+multi.lsf. Each metrics_summary.csv is read once (with the parser shared
+with postprocess-cellranger-multi.py) and combined_metrics.csv is written
+in one pass:
+
+- count runs (RUN/outs/metrics_summary.csv) give one row labelled RUN
+  with the file's columns;
+- multi runs give one row per RUN/outs/per_sample_outs/SAMPLE, labelled
+  RUN_SAMPLE, with the sample's Cells metrics as columns (Grouped By and
+  Group Name, when set, are prefixed to the metric name, and library
+  types other than Gene Expression to the whole column name, e.g.
+  "Antibody Capture: Median UMI counts per cell").
+
+For multi runs the library-level metrics of each run are also written to
+library_summary.csv, one row per library type and metric.
+"""
+
+import argparse
+import csv
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics_reader import (
+    compile_metrics_pattern,
+    read_count_metrics_summary,
+    read_metrics_summary,
+)
+
+MULTI_PATTERN = compile_metrics_pattern(categories=['Cells', 'Library'])
+PRIMARY_LIBRARY_TYPE = 'Gene Expression'
+
+
+def find_metrics_files(run_dir):
+    """List (layout, run, label, path) for every metrics file under run_dir.
+
+    Only directories with an outs/ directory are treated as runs, so logs
+    and other files next to the runs are ignored.
+    """
+    found = []
+    for run in sorted(os.listdir(run_dir)):
+        outs_dir = os.path.join(run_dir, run, 'outs')
+        per_sample_dir = os.path.join(outs_dir, 'per_sample_outs')
+        if os.path.isdir(per_sample_dir):
+            for sample in sorted(os.listdir(per_sample_dir)):
+                path = os.path.join(per_sample_dir, sample, 'metrics_summary.csv')
+                if os.path.isfile(path):
+                    found.append(('multi', run, f'{run}_{sample}', path))
+        elif os.path.isfile(os.path.join(outs_dir, 'metrics_summary.csv')):
+            found.append(('count', run, run, os.path.join(outs_dir, 'metrics_summary.csv')))
+    return found
+
+
+def read_run_metrics(layout, path):
+    """Read one metrics file into (metric, value) pairs and library rows."""
+    if layout == 'count':
+        return read_count_metrics_summary(path), []
+
+    metrics = []
+    library_rows = []
+    for row in read_metrics_summary(path, MULTI_PATTERN):
+        category, library_type, grouped_by, group_name, metric_name, value = row
+        if category == 'Cells':
+            name = ' '.join(part for part in (grouped_by, group_name, metric_name) if part)
+            if library_type and library_type != PRIMARY_LIBRARY_TYPE:
+                name = f'{library_type}: {name}'
+            metrics.append((name, value))
+        elif grouped_by is None and group_name is None:
+            library_rows.append((library_type, metric_name, value))
+    return metrics, library_rows
+
+
+def combine_metrics(run_dir, workers=8):
+    """Read every run's metrics files concurrently.
+
+    Returns the combined header, one dict of metrics per label, and the
+    library-level rows of each multi run (from its first sample, as the
+    values are the same in every sample's file).
+    """
+    found = find_metrics_files(run_dir)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        parsed = list(executor.map(lambda item: read_run_metrics(item[0], item[3]), found))
+
+    count_columns = {}
+    multi_columns = set()
+    rows = []
+    library_rows = []
+    seen_runs = set()
+    for (layout, run, label, _), (metrics, library) in zip(found, parsed):
+        rows.append((label, dict(metrics)))
+        if layout == 'count':
+            count_columns.update(dict.fromkeys(name for name, _ in metrics))
+        else:
+            multi_columns.update(name for name, _ in metrics)
+            if run not in seen_runs:
+                library_rows.extend((run,) + row for row in library)
+        seen_runs.add(run)
+
+    # Count columns keep the file's order; multi metric names are sorted,
+    # Gene Expression first and then each prefixed library type
+    header = list(count_columns) + sorted(
+        multi_columns - set(count_columns),
+        key=lambda name: (name.split(': ')[0] if ': ' in name else '', name)
+    )
+    return header, rows, library_rows
+
+
+def write_csv_atomic(path, header, rows):
+    """Write a CSV through a temp file and rename it into place."""
+    tmp_path = f'{path}.tmp.{os.getpid()}'
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Combine the metrics_summary.csv files of every CellRanger '
+                    'count or multi run in a directory into combined_metrics.csv'
+    )
+    parser.add_argument(
+        '--run-dir',
+        default='.',
+        help='Directory containing the CellRanger run directories '
+             '(default: current directory)'
+    )
+    parser.add_argument(
+        '--output',
+        default=None,
+        help='Combined metrics CSV (default: RUN_DIR/combined_metrics.csv)'
+    )
+    parser.add_argument(
+        '--library-summary',
+        default=None,
+        help='Library-level metrics CSV for multi runs '
+             '(default: RUN_DIR/library_summary.csv)'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=8,
+        help='Number of metrics files to read concurrently (default: 8)'
+    )
+
+    args = parser.parse_args()
+    run_dir = os.path.abspath(args.run_dir)
+    output = args.output or os.path.join(run_dir, 'combined_metrics.csv')
+
+    header, rows, library_rows = combine_metrics(run_dir, args.workers)
+    if not rows:
+        print(f'Error: no metrics_summary.csv files found under {run_dir}/*/outs/')
+        sys.exit(1)
+
+    write_csv_atomic(
+        output,
+        ['Sample'] + header,
+        ([label] + [metrics.get(name) for name in header] for label, metrics in rows)
+    )
+    print(f'Combined metrics for {len(rows)} samples saved to {output}')
+
+    if library_rows:
+        library_output = args.library_summary or os.path.join(run_dir, 'library_summary.csv')
+        write_csv_atomic(library_output, ['Sample', 'Library Type', 'Metric', 'Value'], library_rows)
+        print(f'Library-level metrics saved to {library_output}')
+
+
+if __name__ == '__main__':
+    main()